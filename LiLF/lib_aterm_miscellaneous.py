@@ -3,7 +3,7 @@ Miscellaneous functions
 """
 import numpy as np
 import pickle
-from shapely.geometry import Point, Polygon
+from shapely.geometry import Polygon
 from shapely.prepared import prep
 from astropy.io import fits as pyfits
 from PIL import Image, ImageDraw
@@ -19,16 +19,14 @@ def read_vertices(filename):
     return vertices
 
 
-def make_template_image(image_name, reference_ra_deg, reference_dec_deg,
+def make_template_header(reference_ra_deg, reference_dec_deg,
     ximsize=512, yimsize=512, cellsize_deg=0.000417, freqs=None, times=None,
-    antennas=None, aterm_type='tec', fill_val=0):
+    antennas=None, aterm_type='tec'):
     """
-    Make a blank image and save it to disk
+    Make the header of a blank image without allocating its data
 
     Parameters
     ----------
-    image_name : str
-        Filename of output image
     reference_ra_deg : float, optional
         RA for center of output mask image
     reference_dec_deg : float, optional
@@ -45,8 +43,11 @@ def make_template_image(image_name, reference_ra_deg, reference_dec_deg,
         Antennas to use to construct extra axes (for IDG a-term images)
     aterm_type : str
         One of 'tec' or 'gain'
-    fill_val : int
-        Value with which to fill the data
+
+    Returns
+    -------
+    header : astropy.io.fits.Header
+        Header with the axes set to the full output shape
     """
     if freqs is not None and times is not None and antennas is not None:
         nants = len(antennas)
@@ -67,9 +68,11 @@ def make_template_image(image_name, reference_ra_deg, reference_dec_deg,
         nfreqs = 1
         freqs = [150e6]
 
-    hdu = pyfits.PrimaryHDU(np.ones(shape_out, dtype=np.float32)*fill_val)
-    hdulist = pyfits.HDUList([hdu])
-    header = hdulist[0].header
+    # Use a dummy array with the right number of axes and then set their lengths
+    hdu = pyfits.PrimaryHDU(np.zeros([1]*len(shape_out), dtype=np.float32))
+    header = hdu.header
+    for i, n in enumerate(reversed(shape_out)):
+        header['NAXIS{}'.format(i+1)] = n
 
     # Add RA, Dec info
     i = 1
@@ -149,9 +152,44 @@ def make_template_image(image_name, reference_ra_deg, reference_dec_deg,
     # Add telescope
     header['TELESCOP'] = 'LOFAR'
 
-    hdulist[0].header = header
-    hdulist.writeto(image_name, overwrite=True)
-    hdulist.close()
+    return header
+
+
+def make_template_image(image_name, reference_ra_deg, reference_dec_deg,
+    ximsize=512, yimsize=512, cellsize_deg=0.000417, freqs=None, times=None,
+    antennas=None, aterm_type='tec', fill_val=0):
+    """
+    Make a blank image and save it to disk
+
+    Parameters
+    ----------
+    image_name : str
+        Filename of output image
+    fill_val : int
+        Value with which to fill the data
+
+    See make_template_header() for the other parameters
+    """
+    header = make_template_header(reference_ra_deg, reference_dec_deg, ximsize=ximsize,
+                                  yimsize=yimsize, cellsize_deg=cellsize_deg, freqs=freqs,
+                                  times=times, antennas=antennas, aterm_type=aterm_type)
+    shape_out = [header['NAXIS{}'.format(i)] for i in range(header['NAXIS'], 0, -1)]
+    hdu = pyfits.PrimaryHDU(np.ones(shape_out, dtype=np.float32)*fill_val, header=header)
+    hdu.writeto(image_name, overwrite=True)
+
+
+def _intersects_xy(poly, x, y):
+    """
+    Vectorized test of which (x, y) points lie inside or on the border of a polygon
+    """
+    try:
+        # shapely >= 2.0
+        from shapely import intersects_xy
+        return intersects_xy(poly, x, y)
+    except ImportError:
+        from shapely import vectorized
+        prepared_polygon = prep(poly)
+        return vectorized.contains(prepared_polygon, x, y) | vectorized.touches(poly, x, y)
 
 
 def rasterize(verts, data, blank_value=0):
@@ -173,7 +211,6 @@ def rasterize(verts, data, blank_value=0):
         Array with rasterized polygon
     """
     poly = Polygon(verts)
-    prepared_polygon = prep(poly)
 
     # Mask everything outside of the polygon plus its border (outline) with zeros
     # (inside polygon plus border are ones)
@@ -184,11 +221,9 @@ def rasterize(verts, data, blank_value=0):
     # Now check the border precisely
     mask = Image.new('L', (data.shape[0], data.shape[1]), 0)
     ImageDraw.Draw(mask).polygon(verts, outline=1, fill=0)
-    masked_ind = np.where(np.array(mask).transpose())
-    points = [Point(xm, ym) for xm, ym in zip(masked_ind[0], masked_ind[1])]
-    outside_points = [v for v in points if prepared_polygon.disjoint(v)]
-    for outside_point in outside_points:
-        data[int(outside_point.y), int(outside_point.x)] = 0
+    xm, ym = np.where(np.array(mask).transpose())
+    outside = ~_intersects_xy(poly, xm.astype(float), ym.astype(float))
+    data[ym[outside], xm[outside]] = 0
 
     if blank_value != 0:
         data[data==0] = blank_value
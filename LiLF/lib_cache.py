@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Local cache of calibrator solutions.
+#
+# Solutions are stored once per content (objects/<sha256>) and indexed by
+# (obsid, calibrator, antenna set, frequency setup) in index.json.
+# Entries are published atomically, retrieved with hardlinks (or reflink/copy
+# across filesystems) and evicted least-recently-used beyond max_size.
+# A remote backend can be plugged in to share the solutions among nodes.
+
+import os, json, time, shutil, hashlib, fcntl, subprocess, tempfile, glob
+from casacore import tables
+
+from LiLF.lib_log import logger
+
+cal_files = ['cal-pa.h5', 'cal-amp.h5', 'cal-iono.h5']
+
+
+def solution_key(obsid, calibrator, antennaset, freqsetup):
+    """
+    Return the cache key of a set of calibrator solutions
+    """
+    return 'id%i_%s_%s_%s' % (int(obsid), calibrator.lower(), antennaset.upper(), freqsetup)
+
+
+def ms_setup(pathMS):
+    """
+    Return (obsid, antennaset, freqsetup) of an MS, the frequency setup being the
+    observed band (common to all SBs of the observation)
+    """
+    with tables.table(pathMS+'/OBSERVATION', ack=False) as t:
+        obsid = int(t.getcell('LOFAR_OBSERVATION_ID', 0))
+        antennaset = t.getcell('LOFAR_ANTENNA_SET', 0)
+        freqsetup = '%.3f-%.3fMHz' % (t.getcell('LOFAR_OBSERVATION_FREQUENCY_MIN', 0),
+                                      t.getcell('LOFAR_OBSERVATION_FREQUENCY_MAX', 0))
+    return obsid, antennaset, freqsetup
+
+
+def calibrator_name(dirname):
+    """
+    Get the calibrator name (3c196, 3c295, 3c380) from a calibrator directory name
+    """
+    for cal in ['3c196', '3c295', '3c380']:
+        if cal in os.path.basename(dirname).lower(): return cal
+    return 'unknown'
+
+
+def _sha256(filename, blocksize=2**20):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _link_or_copy(src, dst):
+    """
+    Hardlink src to dst, if on different filesystems try a reflink, then a plain copy
+    """
+    if os.path.lexists(dst): os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        if subprocess.call(['cp', '--reflink=auto', src, dst], stderr=subprocess.DEVNULL) != 0:
+            shutil.copy2(src, dst)
+
+
+class LocalDirBackend(object):
+    """
+    Remote storage in a directory (e.g. a shared filesystem), one subdirectory per key
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def has(self, key):
+        return os.path.isdir(os.path.join(self.root, key))
+
+    def get(self, key, dest_dir):
+        for f in glob.glob(os.path.join(self.root, key, 'cal-*.h5')):
+            shutil.copy2(f, dest_dir)
+
+    def put(self, key, files):
+        tmp = os.path.join(self.root, '.tmp-%s-%i' % (key, os.getpid()))
+        os.makedirs(tmp, exist_ok=True)
+        for f in files:
+            shutil.copy2(f, tmp)
+        shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+        os.rename(tmp, os.path.join(self.root, key))
+
+
+class ScpBackend(object):
+    """
+    Remote storage on a host:/path reachable with ssh/scp, one subdirectory per key
+    """
+    def __init__(self, host, root):
+        self.host = host
+        self.root = root
+
+    def has(self, key):
+        return subprocess.call(['ssh', self.host, 'test -d %s/%s' % (self.root, key)]) == 0
+
+    def get(self, key, dest_dir):
+        if subprocess.call('scp -q %s:%s/%s/cal-*.h5 %s' % (self.host, self.root, key, dest_dir), shell=True) != 0:
+            logger.error('Cache: cannot fetch %s from %s:%s' % (key, self.host, self.root))
+
+    def put(self, key, files):
+        if subprocess.call(['ssh', self.host, 'rm -rf %s/%s; mkdir -p %s/%s' % (self.root, key, self.root, key)]) != 0 or \
+           subprocess.call(['scp', '-q'] + list(files) + ['%s:%s/%s' % (self.host, self.root, key)]) != 0:
+            logger.error('Cache: cannot push %s to %s:%s' % (key, self.host, self.root))
+
+
+def get_backend(remote):
+    """
+    Return the backend for a remote: '' (none), 'host:/path' (ssh/scp) or '/path' (directory)
+    """
+    if remote == '': return None
+    if ':' in remote and not remote.startswith('/'):
+        host, root = remote.split(':', 1)
+        return ScpBackend(host, root)
+    return LocalDirBackend(remote)
+
+
+class SolutionCache(object):
+    """
+    Usage:
+    cache = SolutionCache('/path/to/cache', max_size=20, backend=get_backend('host:/path'))
+    cache.publish(key, ['cal-pa.h5', 'cal-amp.h5', 'cal-iono.h5'])
+    cache.retrieve(key, 'cal-dir')
+    """
+    def __init__(self, cache_dir, max_size=20, backend=None):
+        """
+        cache_dir: local cache directory
+        max_size: max size in GB of the local cache
+        backend: remote backend (see get_backend())
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size*1024**3
+        self.backend = backend
+        os.makedirs(os.path.join(self.cache_dir, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(self.cache_dir, 'tmp'), exist_ok=True)
+        self.index_file = os.path.join(self.cache_dir, 'index.json')
+
+    def _lock(self):
+        """
+        Exclusive lock on the index, released when the returned file is closed
+        """
+        f = open(os.path.join(self.cache_dir, 'index.lock'), 'w')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _read_index(self):
+        if not os.path.exists(self.index_file): return {}
+        with open(self.index_file, 'r') as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        tmp = self.index_file+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.index_file)
+
+    def _object(self, sha):
+        return os.path.join(self.cache_dir, 'objects', sha[:2], sha)
+
+    def keys(self):
+        return list(self._read_index().keys())
+
+    def find(self, obsid, antennaset, freqsetup, calibrator=None):
+        """
+        Return the key of cached solutions for an observation setup (any calibrator if None), or None
+        """
+        keys = [solution_key(obsid, calibrator, antennaset, freqsetup)] if calibrator is not None else \
+               [solution_key(obsid, cal, antennaset, freqsetup) for cal in ['3c196', '3c295', '3c380']]
+        local = self.keys()
+        for key in keys:
+            if key in local: return key
+        if self.backend is not None:
+            for key in keys:
+                if self.backend.has(key): return key
+        return None
+
+    def publish(self, key, files):
+        """
+        Add solution files to the cache under key (and to the remote backend, if any)
+        """
+        shas = [(f, _sha256(f)) for f in files]
+        with self._lock():
+            # objects are renamed in place, so each of them appears atomically
+            entry = {'files': {}, 'size': 0}
+            for f, sha in shas:
+                obj = self._object(sha)
+                if not os.path.exists(obj):
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    fd, tmp = tempfile.mkstemp(dir=os.path.join(self.cache_dir, 'tmp'))
+                    os.close(fd)
+                    shutil.copy2(f, tmp)
+                    os.chmod(tmp, 0o444) # objects are hardlinked, prevent modifications
+                    os.rename(tmp, obj)
+                entry['files'][os.path.basename(f)] = sha
+                entry['size'] += os.path.getsize(obj)
+            entry['last_used'] = time.time()
+
+            index = self._read_index()
+            index[key] = entry
+            self._evict(index, keep=key)
+            self._write_index(index)
+        logger.info('Cache: published %s' % key)
+
+        if self.backend is not None:
+            self.backend.put(key, files)
+
+    def retrieve(self, key, dest_dir):
+        """
+        Place the solutions of key in dest_dir, fetching them from the remote backend if needed.
+        Return True if found.
+        """
+        os.makedirs(dest_dir, exist_ok=True)
+        with self._lock():
+            index = self._read_index()
+            if key in index and all([os.path.exists(self._object(sha)) for sha in index[key]['files'].values()]):
+                for name, sha in index[key]['files'].items():
+                    _link_or_copy(self._object(sha), os.path.join(dest_dir, name))
+                index[key]['last_used'] = time.time()
+                self._write_index(index)
+                logger.info('Cache: retrieved %s' % key)
+                return True
+
+        if self.backend is not None and self.backend.has(key):
+            logger.info('Cache: fetching %s from remote' % key)
+            tmp = tempfile.mkdtemp(dir=os.path.join(self.cache_dir, 'tmp'))
+            try:
+                self.backend.get(key, tmp)
+                files = sorted(glob.glob(tmp+'/cal-*.h5'))
+                # a failed or partial transfer is not published
+                if sorted([os.path.basename(f) for f in files]) != sorted(cal_files):
+                    logger.error('Cache: incomplete solutions for %s on remote' % key)
+                    return False
+                self.publish_local(key, files)
+            finally:
+                shutil.rmtree(tmp)
+            return self.retrieve(key, dest_dir)
+
+        return False
+
+    def publish_local(self, key, files):
+        """
+        Like publish() but without pushing to the remote backend
+        """
+        backend, self.backend = self.backend, None
+        try:
+            self.publish(key, files)
+        finally:
+            self.backend = backend
+
+    def _evict(self, index, keep=None):
+        """
+        Remove least recently used entries until the cache fits in max_size, then delete unreferenced objects
+        """
+        def size(index):
+            shas = set([sha for e in index.values() for sha in e['files'].values()])
+            return sum([os.path.getsize(self._object(sha)) for sha in shas if os.path.exists(self._object(sha))])
+
+        for key in sorted(index, key=lambda k: index[k]['last_used']):
+            if size(index) <= self.max_size: break
+            if key == keep: continue
+            logger.info('Cache: evicting %s' % key)
+            del index[key]
+
+        used = set([sha for e in index.values() for sha in e['files'].values()])
+        for obj in glob.glob(os.path.join(self.cache_dir, 'objects', '*', '*')):
+            if os.path.basename(obj) not in used:
+                os.remove(obj)
+
+
+def from_parset(parset):
+    """
+    Return the SolutionCache configured in the [cache] section of the parset, or None if disabled
+    """
+    cache_dir = parset.get('cache', 'cache_dir')
+    if cache_dir == '': return None
+    return SolutionCache(os.path.expanduser(cache_dir), max_size=parset.getfloat('cache', 'max_size'),
+                         backend=get_backend(parset.get('cache', 'remote')))
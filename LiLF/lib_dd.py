@@ -1,10 +1,10 @@
 import os, sys, glob
 import numpy as np
+from scipy.spatial import cKDTree
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 import pyregion
 from pyregion.parser_helper import Shape
-import lsmtool
 
 from LiLF.lib_log import logger
 from LiLF import lib_img, lib_util
@@ -208,35 +208,38 @@ class Grouper( object ):
     
     def run(self):
         """
-        Run the algorithm
+        Run the algorithm. All neighbourhoods are found with a single batched ball query on a KD-tree
+        and the flux-weighted mean shift is computed for all sources at once.
         """
+        fluxes = np.asarray(self.fluxes, dtype=float)
+        n = len(self.coords)
+        self_idx = np.arange(n)
 
         for it in range(self.n_iterations):
             logger.info("Grouper: Starting iteration %i" % it)
-            for i, x in enumerate(self.coords):
-                ### Step 1. For each datapoint x in X, find the neighbouring points N(x) of x.
-                idx_neighbours = self.neighbourhood_points(x, self.coords, max_distance = self.look_distance)
-                
-                ### Step 2. For each datapoint x in X, calculate the mean shift m(x).
-                distances = self.euclid_distance(self.coords[idx_neighbours], x)
-                weights = self.gaussian_kernel(distances)
-                weights *= self.fluxes[idx_neighbours]**2 # multiply by flux**1.5 to make bright sources more important
-                numerator = np.sum(weights[:,np.newaxis] * self.coords[idx_neighbours], axis=0)
-                denominator = np.sum(weights)
-                new_x = numerator / denominator
-                
-                ### Step 3. For each datapoint x in X, update x <- m(x).
-                self.coords[i] = new_x
-
+            ### Step 1. For each datapoint x in X, find the neighbouring points N(x) of x.
+            pairs = cKDTree(self.coords).query_pairs(self.look_distance, output_type='ndarray')
+            idx_x = np.concatenate([pairs[:,0], pairs[:,1], self_idx])
+            idx_neighbours = np.concatenate([pairs[:,1], pairs[:,0], self_idx])
+            distances = np.sqrt(np.sum((self.coords[idx_x] - self.coords[idx_neighbours])**2, axis=1))
+            close = distances < self.look_distance
+            idx_x, idx_neighbours, distances = idx_x[close], idx_neighbours[close], distances[close]
+
+            ### Step 2. For each datapoint x in X, calculate the mean shift m(x).
+            weights = self.gaussian_kernel(distances)
+            weights *= fluxes[idx_neighbours]**2 # multiply by flux**1.5 to make bright sources more important
+            denominator = np.bincount(idx_x, weights=weights, minlength=n)
+            new_coords = np.empty(self.coords.shape)
+            for ax in range(self.coords.shape[1]):
+                new_coords[:,ax] = np.bincount(idx_x, weights=weights*self.coords[idx_neighbours,ax], minlength=n) / denominator
+
+            ### Step 3. For each datapoint x in X, update x <- m(x).
+            self.coords = new_coords
             self.past_coords.append(np.copy(self.coords))
 
-            #if it>1: 
-            #    print (np.max(self.euclid_distance(self.coords,self.past_coords[-2])))
-
             # if things changes little, brak
             if it > 1 and np.max(self.euclid_distance(self.coords, self.past_coords[-2])) < self.grouping_distance/2.:
                 break
-            
 
     def grouping(self):
         """
@@ -328,18 +331,186 @@ class Grouper( object ):
         logger.info('Plotting: grouping_clusters.png')
         fig.savefig('grouping_clusters.png', bbox_inches='tight')
 
-def cut_skymodel(skymodel_in, skymodel_out, d, do_skydb=True, do_regions=False):
+class SkymodelIndex(object):
+    """
+    In-memory index of a makesourcedb skymodel, parsed once and queried for many directions.
+    Columns are stored as arrays (ra, dec in deg + the original text rows) and positions in a KD-tree of unit vectors,
+    so box and cone cutouts do not reload or re-filter the full skymodel.
+    """
+
+    def __init__(self, skymodel):
+        self.skymodel = skymodel
+        self.format_line = None
+        self.patch_lines = {} # patch name -> patch line (with position)
+        rows, ras, decs, patches = [], [], [], []
+
+        with open(skymodel) as f:
+            for line in f:
+                line = line.strip()
+                if line == '': continue
+                if self.format_line is None and (line.lower().startswith('format') or
+                                                  (line.startswith('#') and line.lower().endswith('format'))):
+                    self.format_line = line
+                    self.columns = self._parse_format(line)
+                    idx_name, idx_patch = self.columns.index('name'), self.columns.index('patch')
+                    idx_ra, idx_dec = self.columns.index('ra'), self.columns.index('dec')
+                    continue
+                if line.startswith('#'): continue
+                if self.format_line is None:
+                    raise ValueError('Missing format line in skymodel %s' % skymodel)
+
+                values = self._split(line)
+                if values[idx_name] == '':
+                    self.patch_lines[values[idx_patch]] = line
+                    continue
+                rows.append(line)
+                ras.append(self._parse_ra(values[idx_ra]))
+                decs.append(self._parse_dec(values[idx_dec]))
+                patches.append(values[idx_patch] if len(values) > idx_patch else '')
+
+        self.rows = np.array(rows, dtype=object)
+        self.ra = np.array(ras, dtype=float)
+        self.dec = np.array(decs, dtype=float)
+        self.patches = np.array(patches, dtype=object)
+        self.tree = cKDTree(self._xyz(self.ra, self.dec))
+        logger.debug('SkymodelIndex: %i sources in %s' % (len(self.rows), skymodel))
+
+    def __len__(self):
+        return len(self.rows)
+
+    @staticmethod
+    def _split(line):
+        """
+        Split a line on the commas outside quotes and brackets (e.g. "[0.1, -0.2]" or "patch='[<Angle ...>, <Angle ...>]'")
+        """
+        values, depth, quote, start = [], 0, None, 0
+        for i, c in enumerate(line):
+            if quote is not None:
+                if c == quote: quote = None
+            elif c in '\'"': quote = c
+            elif c == '[': depth += 1
+            elif c == ']': depth -= 1
+            elif c == ',' and depth == 0:
+                values.append(line[start:i].strip())
+                start = i+1
+        values.append(line[start:].strip())
+        return values
+
+    @staticmethod
+    def _parse_format(line):
+        """
+        Return lowercase column names from a "FORMAT = ..." or "# (...) = format" line
+        """
+        if line.startswith('#'):
+            line = line[line.index('(')+1:line.rindex(')')]
+        else:
+            line = line.split('=', 1)[1]
+        return [c.split('=')[0].strip().lower() for c in SkymodelIndex._split(line)]
+
+    @staticmethod
+    def _parse_ra(ra):
+        """ hh:mm:ss.s or degrees -> deg """
+        if ':' in ra:
+            h, m, s = [float(x) for x in ra.split(':')]
+            sign = -1 if ra.strip().startswith('-') else 1
+            return 15.*sign*(abs(h) + m/60. + s/3600.)
+        return float(ra.replace('deg',''))
+
+    @staticmethod
+    def _parse_dec(dec):
+        """ dd.mm.ss.s or dd:mm:ss.s or degrees -> deg """
+        if ':' in dec: parts = dec.split(':')
+        elif dec.count('.') > 1: parts = dec.split('.', 2)
+        else: return float(dec.replace('deg',''))
+        d, m, s = [float(x) for x in parts]
+        sign = -1 if dec.strip().startswith('-') else 1
+        return sign*(abs(d) + m/60. + s/3600.)
+
+    @staticmethod
+    def _xyz(ra, dec):
+        ra, dec = np.radians(ra), np.radians(dec)
+        return np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)]).T
+
+    def cone(self, position, radius):
+        """
+        Return the indexes of sources within radius [deg] from position [ra, dec] in deg
+        """
+        chord = 2*np.sin(np.radians(min(radius, 180.))/2.)
+        return np.sort(np.array(self.tree.query_ball_point(self._xyz(position[0], position[1]), chord), dtype=int))
+
+    def box(self, position, size):
+        """
+        Return the indexes of sources within a square of size [deg] around position [ra, dec] in deg
+        (same selection as the Ra/Dec cut used by cut_skymodel)
+        """
+        half_ra = (size/2.)/np.cos(np.radians(position[1]))
+        # a cone containing the box, then the exact cut
+        idx = self.cone(position, np.sqrt(half_ra**2 + (size/2.)**2))
+        dra = (self.ra[idx] - position[0] + 180.) % 360. - 180.
+        ddec = self.dec[idx] - position[1]
+        return idx[(np.abs(dra) < half_ra) & (np.abs(ddec) < size/2.)]
+
+    def write(self, idx, skymodel_out):
+        """
+        Write the sources "idx" (and their patches) in makesourcedb format
+        """
+        with open(skymodel_out, 'w') as f:
+            f.write(self.format_line+'\n\n')
+            for patch in sorted(set(self.patches[idx])):
+                if patch in self.patch_lines: f.write(self.patch_lines[patch]+'\n')
+            for row in self.rows[idx]:
+                f.write(row+'\n')
+
+    def write_ds9(self, idx, regionfile):
+        """
+        Write the sources "idx" as ds9 points
+        """
+        with open(regionfile, 'w') as f:
+            f.write('fk5\n')
+            for ra, dec in zip(self.ra[idx], self.dec[idx]):
+                f.write('point(%f,%f) # point=cross\n' % (ra, dec))
+
+
+def cut_skymodels(skymodel_in, skymodels_out, directions, s=None, do_skydb=True, do_regions=False, index=None, ncpu=None):
+    """
+    Extract for each direction the sources in the square around the calibrator of the given size.
+    The full skymodel is parsed once (or an existing SkymodelIndex is used), text skymodels are written concurrently
+    and the makesourcedb conversions are run in parallel by the scheduler.
+
+    skymodels_out: list of output text skymodels (skydb: same name with .skydb, regions: same name with .reg)
+    s: scheduler, required if do_skydb
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if index is None: index = SkymodelIndex(skymodel_in)
+    if ncpu is None: ncpu = s.max_processors if s is not None else 1
+
+    def cut(args):
+        skymodel_out, d = args
+        idx = index.box(d.position, d.size)
+        index.write(idx, skymodel_out)
+        if do_regions: index.write_ds9(idx, os.path.splitext(skymodel_out)[0]+'.reg')
+        return len(idx)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(ncpu, len(directions)))) as executor:
+        nsources = list(executor.map(cut, zip(skymodels_out, directions)))
+    for d, n in zip(directions, nsources):
+        logger.debug('%s: %i sources in cutout.' % (d.name, n))
+
+    if do_skydb:
+        for skymodel_out in skymodels_out:
+            skydb = os.path.splitext(skymodel_out)[0]+'.skydb'
+            lib_util.check_rm(skydb)
+            s.add('makesourcedb outtype="blob" format="<" in="%s" out="%s"' % (skymodel_out, skydb),
+                  log='makesourcedb_cl.log', commandType='general')
+        s.run(check=True)
+
+    return index
+
+
+def cut_skymodel(skymodel_in, skymodel_out, d, s=None, do_skydb=True, do_regions=False, index=None):
     """
     Load full skymodel and extract sources in the square around the calibrator of the given size
+    index: a SkymodelIndex of skymodel_in to reuse across directions (returned)
     """
-    lsm = lsmtool.load(skymodel_in)
-    # select all sources within a sqare of patch size
-    lsm.select('Ra > %f' % (d.position[0]-(d.size/2)/np.cos(d.position[1]* np.pi / 180.)))
-    lsm.select('Ra < %f' % (d.position[0]+(d.size/2)/np.cos(d.position[1]* np.pi / 180.)))
-    lsm.select('Dec > %f' % (d.position[1]-d.size/2))
-    lsm.select('Dec < %f' % (d.position[1]+d.size/2))
-    if do_regions: lsm.write('ddcal/masks/regions-c%02i/%s.reg' % (cmaj,d.name), format='ds9', clobber=True)
-    lsm.write(dir_skymodel, format='makesourcedb', clobber=True)
-    lib_util.check_rm(dir_skydb)
-    s.add('makesourcedb outtype="blob" format="<" in="%s" out="%s"' % (dir_skymodel, dir_skydb), log='makesourcedb_cl.log', commandType='general' )
-    s.run(check=True)
+    return cut_skymodels(skymodel_in, [skymodel_out], [d], s=s, do_skydb=do_skydb, do_regions=do_regions, index=index)
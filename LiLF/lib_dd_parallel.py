@@ -6,11 +6,10 @@ from astropy import wcs as pywcs
 import astropy.units as u
 import pyregion
 from pyregion.parser_helper import Shape
-from matplotlib.path import Path
 from scipy.ndimage import binary_dilation, generate_binary_structure
 from scipy.ndimage.measurements import label, center_of_mass
 try:
-    from scipy.spatial import Voronoi, voronoi_plot_2d
+    from scipy.spatial import Voronoi, voronoi_plot_2d, cKDTree
 except:
     logger.error("Load latest scipy with 'use Pythonlibs'")
     sys.exit(1)
@@ -107,7 +106,7 @@ class Direction(object):
             self.position_facet = [float(ra), float(dec)]
 
 
-def make_voronoi_reg(directions, fitsfile, outdir_reg='regions', out_mask='facet.fits', png=None):
+def make_voronoi_reg(directions, fitsfile, outdir_reg='regions', out_mask='facet.fits', png=None, tile_rows=256):
     """
     Take a list of coordinates and an image and voronoi tesselate the sky.
     It saves ds9 regions + fits mask of the facets
@@ -117,16 +116,9 @@ def make_voronoi_reg(directions, fitsfile, outdir_reg='regions', out_mask='facet
     outdir_reg : dir where to save regions
     out_mask : output mask with different numbers in each facet
     png : output png file that shows the tassellation
+    tile_rows : number of image rows labelled at once
     """
 
-    def closest_node(node, nodes):
-        """
-        Return closest values to node from nodes
-        """
-        nodes = np.asarray(nodes)
-        dist_2 = np.sum((nodes - node)**2, axis=1)
-        return np.argmin(dist_2)
-
     logger.debug("Image used for tasselation reference: "+fitsfile)
     fits = pyfits.open(fitsfile)
     hdr, data = lib_img.flatten(fits)
@@ -164,26 +156,26 @@ def make_voronoi_reg(directions, fitsfile, outdir_reg='regions', out_mask='facet
     box = np.array([[x1,y1],[x2,y2]])
     impoly = voronoi_finite_polygons_2d_box(vor, box)
 
-    # create fits mask (each region one number)
-    x, y = np.meshgrid(np.arange(x2), np.arange(y2)) # make a canvas with coordinates
-    x, y = x.flatten(), y.flatten()
-    pixels = np.vstack((x,y)).T 
+    # create fits mask (each region one number): every pixel belongs to the facet of the closest centre
+    seeds = np.array((x_fs[idx_for_facet], y_fs[idx_for_facet])).transpose()
+    facet_nums = np.array([nums[i] for i in idx_for_facet])
+    tree = cKDTree(seeds)
     data_facet = np.zeros(shape=data.shape)
-    for num, poly in zip(nums,impoly):
-        p = Path(poly)
-        pixels_region = p.contains_points(pixels)
-        data_facet[ pixels_region.reshape(y2,x2) ] = num
+    for row in range(0, y2, tile_rows):
+        y, x = np.mgrid[row:min(row+tile_rows, y2), 0:x2]
+        _, idx_closest = tree.query(np.vstack((x.flatten(), y.flatten())).T)
+        data_facet[row:row+tile_rows] = facet_nums[idx_closest].reshape(x.shape)
 
     # put all values in each island equal to the closest region
     struct = generate_binary_structure(2, 2)
     data = binary_dilation(data, structure=struct, iterations=3).astype(data.dtype) # expand masks
     blobs, number_of_blobs = label(data.astype(int).squeeze(), structure=[[1,1,1],[1,1,1],[1,1,1]])
-    center_of_masses = center_of_mass(data, blobs, list(range(number_of_blobs+1)))
-    for blob in range(1,number_of_blobs+1):
-        # get closer facet
-        facet_num = closest_node(center_of_masses[blob], np.array([y_fs[idx_for_facet],x_fs[idx_for_facet]]).T)
-        # put all pixel of that mask to that facet value
-        data_facet[ blobs == blob ] = nums[facet_num]
+    if number_of_blobs > 0:
+        center_of_masses = np.array(center_of_mass(data, blobs, list(range(1,number_of_blobs+1)))) # y, x
+        _, idx_closest = tree.query(center_of_masses[:,::-1])
+        # blob number -> facet value (0 is outside any blob)
+        blob_facet = np.concatenate([[0], facet_nums[idx_closest]])
+        data_facet = np.where(blobs > 0, blob_facet[blobs], data_facet)
 
     # save fits mask
     pyfits.writeto(out_mask, data_facet, hdr, overwrite=True)
@@ -411,35 +403,38 @@ class Grouper( object ):
     
     def run(self):
         """
-        Run the algorithm
+        Run the algorithm. All neighbourhoods are found with a single batched ball query on a KD-tree
+        and the flux-weighted mean shift is computed for all sources at once.
         """
+        fluxes = np.asarray(self.fluxes, dtype=float)
+        n = len(self.coords)
+        self_idx = np.arange(n)
 
         for it in range(self.n_iterations):
             logger.info("Grouper: Starting iteration %i" % it)
-            for i, x in enumerate(self.coords):
-                ### Step 1. For each datapoint x in X, find the neighbouring points N(x) of x.
-                idx_neighbours = self.neighbourhood_points(x, self.coords, max_distance = self.look_distance)
-                
-                ### Step 2. For each datapoint x in X, calculate the mean shift m(x).
-                distances = self.euclid_distance(self.coords[idx_neighbours], x)
-                weights = self.gaussian_kernel(distances)
-                weights *= self.fluxes[idx_neighbours]**2 # multiply by flux**1.5 to make bright sources more important
-                numerator = np.sum(weights[:,np.newaxis] * self.coords[idx_neighbours], axis=0)
-                denominator = np.sum(weights)
-                new_x = numerator / denominator
-                
-                ### Step 3. For each datapoint x in X, update x <- m(x).
-                self.coords[i] = new_x
-
+            ### Step 1. For each datapoint x in X, find the neighbouring points N(x) of x.
+            pairs = cKDTree(self.coords).query_pairs(self.look_distance, output_type='ndarray')
+            idx_x = np.concatenate([pairs[:,0], pairs[:,1], self_idx])
+            idx_neighbours = np.concatenate([pairs[:,1], pairs[:,0], self_idx])
+            distances = np.sqrt(np.sum((self.coords[idx_x] - self.coords[idx_neighbours])**2, axis=1))
+            close = distances < self.look_distance
+            idx_x, idx_neighbours, distances = idx_x[close], idx_neighbours[close], distances[close]
+
+            ### Step 2. For each datapoint x in X, calculate the mean shift m(x).
+            weights = self.gaussian_kernel(distances)
+            weights *= fluxes[idx_neighbours]**2 # multiply by flux**1.5 to make bright sources more important
+            denominator = np.bincount(idx_x, weights=weights, minlength=n)
+            new_coords = np.empty(self.coords.shape)
+            for ax in range(self.coords.shape[1]):
+                new_coords[:,ax] = np.bincount(idx_x, weights=weights*self.coords[idx_neighbours,ax], minlength=n) / denominator
+
+            ### Step 3. For each datapoint x in X, update x <- m(x).
+            self.coords = new_coords
             self.past_coords.append(np.copy(self.coords))
 
-            #if it>1: 
-            #    print (np.max(self.euclid_distance(self.coords,self.past_coords[-2])))
-
             # if things changes little, brak
-            if it>1 and np.max(self.euclid_distance(self.coords, self.past_coords[-2])) < self.grouping_distance/2.: 
+            if it > 1 and np.max(self.euclid_distance(self.coords, self.past_coords[-2])) < self.grouping_distance/2.:
                 break
-            
 
     def grouping(self):
         """
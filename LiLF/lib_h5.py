@@ -15,10 +15,15 @@ def repoint(h5parmFile, dirname, solsetname='sol000'):
     ss = h5.getSolset(solsetname)
 
     # rename each axes (must re-create the array as otherwise it truncates the dir name to the previous max string length)
+    # if the new name fits in the current string length only the value is overwritten
     for tab in ss.getSoltabs():
         if 'dir' in tab.getAxesNames():
-            tab.obj._v_file.remove_node('/'+tab.getAddress(), 'dir')
-            tab.obj._v_file.create_array('/'+tab.getAddress(), 'dir', obj=[dirname.encode()])
+            dir_array = tab.obj.dir
+            if dir_array.shape == (1,) and dir_array.atom.itemsize >= len(dirname.encode()):
+                dir_array[0] = dirname.encode()
+            else:
+                tab.obj._v_file.remove_node('/'+tab.getAddress(), 'dir')
+                tab.obj._v_file.create_array('/'+tab.getAddress(), 'dir', obj=[dirname.encode()])
 
     # rename directions table
     sourceTable = ss.obj.source
@@ -30,12 +35,90 @@ def repoint(h5parmFile, dirname, solsetname='sol000'):
     sourceTable.close()
     h5.close()
 
+def _recover_add_axis(h5parmFile, solsetname, soltabname, axisName):
+    """
+    Recover a soltab from an interrupted _add_axis_inplace(), before it is opened with losoto:
+    an unfinished swap is rolled back to the old arrays ("<node>_old"), complete new arrays ("<node>_tmp")
+    are used only if the old ones are lost, and incomplete new arrays are removed.
+    """
+    import tables
+    with tables.open_file(h5parmFile, 'r+') as h5file:
+        group = h5file.get_node('/%s/%s' % (solsetname, soltabname))
+        nodes = ['val', 'weight']
+        if not any([node+'_old' in group or node+'_tmp' in group for node in nodes]): return
+        logger.warning('%s: recovering %s from an interrupted update.' % (h5parmFile, soltabname))
+        if any([node+'_old' in group for node in nodes]):
+            if axisName in group: h5file.remove_node(group, axisName)
+            for node in nodes:
+                if node+'_old' in group:
+                    if node in group: h5file.remove_node(group, node)
+                    h5file.rename_node(group, node, node+'_old')
+        for node in nodes:
+            if node+'_tmp' in group:
+                if node in group: h5file.remove_node(group, node+'_tmp')
+                else: h5file.rename_node(group, node, node+'_tmp')
+
+
+def _add_axis_inplace(st, axisName, axisVals, first=False, max_mem=256*1024**2):
+    """
+    Add an axis to the "val" and "weight" arrays of a soltab working directly on the HDF5 file.
+    New arrays are created with the same atom/filters and a matching chunk layout, filled slab by slab
+    (along the first axis of the old array) and then swapped in place of the old ones,
+    so memory is bounded by max_mem and the rest of the file is untouched.
+
+    first: if True add a leading singleton axis (axisVals must have length 1),
+           otherwise add a trailing axis where the values are copied for each element of axisVals.
+    """
+    group = st.obj
+    h5file = group._v_file
+    n = len(axisVals)
+    assert not first or n == 1
+
+
+    for node in ['val', 'weight']:
+        old = getattr(group, node)
+        if first:
+            shape = (1,)+old.shape
+            chunkshape = (1,)+old.chunkshape if old.chunkshape is not None else None
+        else:
+            shape = old.shape+(n,)
+            chunkshape = old.chunkshape+(n,) if old.chunkshape is not None else None
+        new = h5file.create_carray(group, node+'_tmp', atom=old.atom, shape=shape, filters=old.filters, chunkshape=chunkshape)
+        for attr in old.attrs._f_list('user'):
+            new.attrs[attr] = old.attrs[attr]
+        axes = old.attrs['AXES'].decode() if isinstance(old.attrs['AXES'], bytes) else old.attrs['AXES']
+        new.attrs['AXES'] = (axisName+','+axes if first else axes+','+axisName).encode()
+
+        # fill slab by slab
+        slab_bytes = max(1, int(np.prod(old.shape[1:]))*old.atom.size*n)
+        step = max(1, int(max_mem//slab_bytes))
+        for start in range(0, old.shape[0], step):
+            slab = old[start:start+step]
+            if first:
+                new[0, start:start+step] = slab
+            else:
+                new[start:start+step] = np.repeat(slab[..., np.newaxis], n, axis=-1)
+
+    # swap in: the old arrays are removed only once the new ones and the axis are in place
+    for node in ['val', 'weight']:
+        h5file.rename_node(group, node+'_old', node)
+    h5file.flush()
+    for node in ['val', 'weight']:
+        h5file.rename_node(group, node, node+'_tmp')
+    h5file.create_array(group, axisName, obj=np.array([v.encode() if isinstance(v, str) else v for v in axisVals]))
+    h5file.flush()
+    for node in ['val', 'weight']:
+        h5file.remove_node(group, node+'_old')
+    h5file.flush()
+
+
 def addpol(h5parmFile, soltabname, solsetname='sol000'):
     """
     add pol axes on a soltab
     """
     # open h5parm
     logger.info('%s: add pol axis to %s.' % (h5parmFile, soltabname))
+    _recover_add_axis(h5parmFile, solsetname, soltabname, 'pol')
     h5 = h5parm(h5parmFile, readonly=False)
     ss = h5.getSolset(solsetname)
     st = ss.getSoltab(soltabname)
@@ -44,24 +127,9 @@ def addpol(h5parmFile, soltabname, solsetname='sol000'):
         h5.close()
         logger.warning('%s: polarisation axis already present in %s.' % (h5parmFile, soltabname))
         return
-    
-    # create values for new soltab
-    typ = st.getType()
-    axesNames = st.getAxesNames()+['pol']
-    axesVals = [st.getAxisValues(axisName) for axisName in st.getAxesNames()]+[np.array(['XX','YY'])]
-    vals = st.getValues(retAxesVals = False)
-    vals = np.array([vals,vals])
-    vals = np.moveaxis(vals, 0, -1)
-    weights = st.getValues(weight = True, retAxesVals = False)
-    weights = np.array([weights,weights])
-    weights = np.moveaxis(weights, 0, -1)
-
-    # remove old soltab
-    st.delete()
-
-    # make new soltab
-    soltabout = ss.makeSoltab(soltype = typ, soltabName = soltabname, axesNames=axesNames, \
-                axesVals=axesVals, vals=vals, weights=weights)
+
+    # copy values for each pol on the same file
+    _add_axis_inplace(st, 'pol', ['XX','YY'])
 
     # write h5parm
     h5.close()
@@ -73,6 +141,7 @@ def adddir(h5parmFile, soltabname, solsetname='sol000', dirname='[pointing]'):
     """
     # open h5parm
     logger.info('%s: add dir axis to %s.' % (h5parmFile, soltabname))
+    _recover_add_axis(h5parmFile, solsetname, soltabname, 'dir')
     h5 = h5parm(h5parmFile, readonly=False)
     ss = h5.getSolset(solsetname)
     st = ss.getSoltab(soltabname)
@@ -82,24 +151,92 @@ def adddir(h5parmFile, soltabname, solsetname='sol000', dirname='[pointing]'):
         logger.warning('%s: direction axis already present in %s.' % (h5parmFile, soltabname))
         return
 
-    # create values for new soltab
-    typ = st.getType()
-    axesNames = ['dir'] + st.getAxesNames()
     if dirname not in ss.getSou().keys():
         logger.error(f'Direction {dirname} is not in Solset!')
-    axesVals = [np.array([dirname])] + [st.getAxisValues(axisName) for axisName in st.getAxesNames()]
-    vals = st.getValues(retAxesVals=False)
-    vals = np.array([vals])
-    # vals = np.moveaxis(vals, 0, -1)
-    weights = st.getValues(weight=True, retAxesVals=False)
-    weights = np.array([weights])
-    # weights = np.moveaxis(weights, 0, -1)
-    # remove old soltab
-    st.delete()
-
-    # make new soltab
-    soltabout = ss.makeSoltab(soltype=typ, soltabName=soltabname, axesNames=axesNames, \
-                              axesVals=axesVals, vals=vals, weights=weights)
+
+    # leading singleton axis on the same file
+    _add_axis_inplace(st, 'dir', [dirname], first=True)
 
     # write h5parm
     h5.close()
+
+
+# LoSoTo operations that only read the h5parm (plots are written on disk)
+_readonly_ops = ['PLOT']
+
+def losoto_readonly(parsetFile):
+    """
+    Return True if all the steps of a LoSoTo parset only read the h5parm
+    """
+    from configparser import ConfigParser
+    config = ConfigParser(inline_comment_prefixes=('#',';'))
+    with open(parsetFile) as f:
+        config.read_string('[_global]\n'+f.read())
+    ops = [config.get(step, 'operation').strip('\'" ').upper() for step in config.sections() if config.has_option(step, 'operation')]
+    return len(ops) > 0 and all(op in _readonly_ops for op in ops)
+
+
+def collect_h5parms(h5parmFiles, h5Out, solsetname='sol000'):
+    """
+    In-process version of H5parm_collector.py: merge the soltabs of h5parmFiles into the open h5parm h5Out
+    """
+    from itertools import chain
+
+    h5s = [h5parm(h5parmFile, readonly=True) for h5parmFile in h5parmFiles]
+    solsetOut = h5Out.getSolset(solsetname) if solsetname in h5Out.getSolsetNames() else h5Out.makeSolset(solsetname)
+
+    pointingNames, pointingDirections = [], []
+    antennaNames, antennaPositions = [], []
+    for insoltab in h5s[0].getSolset(solsetname).getSoltabNames():
+        soltabs = []
+        for h5 in h5s:
+            solset = h5.getSolset(solsetname)
+            soltabs.append(solset.getSoltab(insoltab))
+            for k, v in list(solset.getSou().items()):
+                if k not in pointingNames:
+                    pointingNames.append(k)
+                    pointingDirections.append(v)
+            for k, v in list(solset.getAnt().items()):
+                if k not in antennaNames:
+                    antennaNames.append(k)
+                    antennaPositions.append(v)
+
+        axes = soltabs[0].getAxesNames()
+        allAxesVals = {axis: np.array(sorted(set(chain(*[st.getAxisValues(axis) for st in soltabs])))) for axis in axes}
+        allShape = [len(allAxesVals[axis]) for axis in axes]
+        allVals = np.full(allShape, np.nan)
+        allWeights = np.zeros(allShape)
+        for st in soltabs:
+            coords = [np.searchsorted(allAxesVals[axis], st.getAxisValues(axis)) for axis in axes]
+            allVals[np.ix_(*coords)] = st.obj.val
+            allWeights[np.ix_(*coords)] = st.obj.weight
+        allWeights[allWeights != 0] = 1.
+        allWeights[np.isnan(allVals)] = 0.
+
+        solsetOut.makeSoltab(soltabs[0].getType(), insoltab, axesNames=axes, axesVals=[allAxesVals[axis] for axis in axes],
+                             vals=allVals, weights=allWeights)
+
+    solsetOut.obj._f_get_child('antenna').append(list(zip(*(antennaNames, antennaPositions))))
+    solsetOut.obj._f_get_child('source').append(list(zip(*(pointingNames, pointingDirections))))
+    for h5 in h5s: h5.close()
+
+
+def run_losoto_parset(H, parsetFile):
+    """
+    In-process version of "losoto h5parm parset" on the open h5parm H
+    """
+    from losoto.lib_losoto import LosotoParser, getStepSoltabs
+    import losoto.operations as operations
+
+    parser = LosotoParser(parsetFile)
+    for step in parser.sections():
+        if step == '_global': continue # skip global setting
+        op = parser.getstr(step, 'Operation')
+        if not hasattr(operations, op.lower()):
+            raise ValueError('%s: unknown LoSoTo operation %s.' % (parsetFile, op))
+        returncode = 0
+        for soltab in getStepSoltabs(parser, step, H):
+            returncode += getattr(operations, op.lower())._run_parser(soltab, parser, step)
+        if returncode != 0:
+            raise RuntimeError('%s: step "%s" incomplete.' % (parsetFile, step))
+        logger.debug('%s: step "%s" (%s) done.' % (parsetFile, step, op))
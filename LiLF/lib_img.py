@@ -1,10 +1,13 @@
-import os, sys, glob
+import os, sys, glob, warnings
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import astropy.io.fits as pyfits
 import casacore.images as pim
 from casacore import quanta
 import lsmtool
 import pyregion
+from scipy import ndimage
 from scipy.ndimage.measurements import label
 from LiLF import make_mask, lib_util
 from LiLF.lib_log import logger
@@ -57,7 +60,7 @@ class Image(object):
 
 
     def makeMask(self, threshpix=5, atrous_do=False, rmsbox=(100,10), remove_extended_cutoff=0., only_beam=False, maskname=None,
-                 write_srl=False, write_gaul=False, write_ds9=False, mask_combine=None):
+                 write_srl=False, write_gaul=False, write_ds9=False, mask_combine=None, engine='bdsf'):
         """
         Create a mask of the image where only believable flux is
 
@@ -67,13 +70,15 @@ class Image(object):
 
         maskname: if give, then use a specific maskname
         only_beam: set to 0 outside the beam
+        engine: 'bdsf' or 'numpy' (faster, island mask only - see make_mask.make_mask)
         """
         if maskname is None: maskname = self.maskname
 
         if not os.path.exists(maskname):
             logger.info('%s: Making mask (%s)...' % (self.imagename, maskname))
             make_mask.make_mask(image_name=self.imagename, mask_name=maskname, threshpix=threshpix, atrous_do=atrous_do,
-                                rmsbox=rmsbox, write_srl=write_srl, write_gaul=write_gaul, write_ds9=write_ds9, mask_combine=mask_combine)
+                                rmsbox=rmsbox, write_srl=write_srl, write_gaul=write_gaul, write_ds9=write_ds9, mask_combine=mask_combine,
+                                engine=engine)
 
         if remove_extended_cutoff > 0:
 
@@ -139,11 +144,27 @@ class Image(object):
         lib_util.check_rm(self.skydb)
         os.system('makesourcedb outtype="blob" format="<" in="'+self.skymodel_cut+'" out="'+self.skydb+'"')
 
-    def getNoise(self, boxsize=None):
+    def getNoise(self, boxsize=None, method='bdsf', ncpu=None):
         """
         Return the rms of all the non-masked pixels in an image
         boxsize : limit to central box of this pixelsize
-        """   
+        method : 'bdsf' to mask sources with a full PyBDSF run (writes self.maskname),
+                 'native' to mask them with a fast sigma-clipped tile estimate (see get_noise_native)
+        ncpu : threads used by the native method (default: all)
+        """
+        if method == 'native':
+            with pyfits.open(self.imagename) as fits:
+                header, data = flatten(fits)
+                # exclude the user region, as makeMask() does for the bdsf method
+                if self.userReg is not None:
+                    data[pyregion.open(self.userReg).get_mask(header=header, shape=data.shape)] = np.nan
+                if boxsize is not None:
+                    ys,xs = data.shape
+                    data = data[ys//2-boxsize//2:ys//2+boxsize//2,xs//2-boxsize//2:xs//2+boxsize//2]
+                return get_noise_native(data, ncpu=ncpu)
+        elif method != 'bdsf':
+            raise ValueError('Unknown noise method: %s' % method)
+
         self.makeMask()
 
         with pyfits.open(self.imagename) as fits:
@@ -152,8 +173,8 @@ class Image(object):
                 mask = np.squeeze(mask[0].data)
                 if boxsize is not None:
                     ys,xs = data.shape
-                    data = data[ys/2-boxsize/2:ys/2+boxsize/2,xs/2-boxsize/2:xs/2+boxsize/2]
-                    mask = mask[ys/2-boxsize/2:ys/2+boxsize/2,xs/2-boxsize/2:xs/2+boxsize/2]
+                    data = data[ys//2-boxsize//2:ys//2+boxsize//2,xs//2-boxsize//2:xs//2+boxsize//2]
+                    mask = mask[ys//2-boxsize//2:ys//2+boxsize//2,xs//2-boxsize//2:xs//2+boxsize//2]
     
                 return np.nanstd(data[mask==0])
 
@@ -192,6 +213,70 @@ class Image(object):
                 raise RuntimeError('Cannot find frequency in image %s' % self.imagename)
 
 
+def _clipped_mad_tiles(tiles, niter=5, kappa=3.):
+    """
+    Iterative sigma-clipped MAD along the last axis of "tiles".
+    Return the rms (MAD*1.4826) for each tile.
+    """
+    tiles = tiles.copy()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning) # all-NaN tiles outside the primary beam
+        for i in range(niter):
+            med = np.nanmedian(tiles, axis=-1, keepdims=True)
+            dev = np.abs(tiles - med)
+            rms = 1.4826 * np.nanmedian(dev, axis=-1, keepdims=True)
+            clip = dev > kappa * rms
+            if not clip.any(): break
+            tiles[clip] = np.nan
+        return rms[...,0]
+
+
+def get_noise_native(data, tile=100, threshpix=5, threshisl=4, niter=5, kappa=3., ncpu=None):
+    """
+    Fast alternative to the bdsf-masked rms of Image.getNoise().
+    An rms map is estimated as the sigma-clipped MAD of tiles of tile x tile pixels, sources are masked using
+    islands above threshisl*rms which contain at least a pixel above threshpix*rms (as bdsf thresh_isl/thresh_pix)
+    and the std of the remaining pixels is returned.
+
+    data : 2D image
+    tile : tile size in pixels
+    ncpu : number of threads used for the tile statistics (default: all)
+    """
+    if ncpu is None: ncpu = multiprocessing.cpu_count()
+    data = np.asarray(data, dtype=np.float32)
+    ys, xs = data.shape
+    nty, ntx = int(np.ceil(ys/tile)), int(np.ceil(xs/tile))
+
+    # pad with NaNs to a multiple of the tile size and reshape to (nty, ntx, tile*tile)
+    padded = np.full((nty*tile, ntx*tile), np.nan, dtype=np.float32)
+    padded[:ys,:xs] = data
+    tiles = padded.reshape(nty, tile, ntx, tile).swapaxes(1,2).reshape(nty, ntx, tile*tile)
+
+    # one chunk of tile rows per thread, numpy releases the GIL in the reductions
+    chunks = np.array_split(np.arange(nty), min(ncpu, nty))
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        rms_tiles = np.concatenate(list(executor.map(lambda rows: _clipped_mad_tiles(tiles[rows[0]:rows[-1]+1], niter, kappa), chunks)))
+
+    # tiles fully blanked or without noise get the median rms
+    bad = ~np.isfinite(rms_tiles) | (rms_tiles <= 0)
+    if bad.all(): return np.nanstd(data)
+    rms_tiles[bad] = np.median(rms_tiles[~bad])
+    rms_map = np.repeat(np.repeat(rms_tiles, tile, axis=0), tile, axis=1)[:ys,:xs]
+
+    # coarse island mask
+    with np.errstate(invalid='ignore'):
+        snr = data/rms_map
+        blobs, number_of_blobs = label(snr > threshisl, structure=[[1,1,1],[1,1,1],[1,1,1]])
+    if number_of_blobs > 0:
+        peaks = np.asarray(ndimage.maximum(snr, labels=blobs, index=np.arange(1, number_of_blobs+1)))
+        keep = np.concatenate([[False], peaks > threshpix])
+        mask = keep[blobs]
+    else:
+        mask = np.zeros_like(data, dtype=bool)
+
+    return np.nanstd(data[~mask])
+
+
 def flatten(f, channel = 0, freqaxis = 0):
     """
     Flatten a fits file so that it becomes a 2D image. Return new header and data
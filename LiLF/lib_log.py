@@ -1,4 +1,6 @@
-import os, sys, logging, time
+import os, sys, logging, time, json, socket, atexit, copy
+import logging.handlers
+from queue import Queue
 
 class _ColorStreamHandler(logging.StreamHandler):
 
@@ -27,13 +29,27 @@ class _ColorStreamHandler(logging.StreamHandler):
         logging.StreamHandler.__init__(self, stream)
 
     def format(self, record):
-        color = self._get_color(record.levelno)
-        record.msg = color + record.msg + self.DEFAULT
+        # colour a copy, the record is shared with the other handlers
+        record = copy.copy(record)
+        record.msg = self._get_color(record.levelno) + str(record.msg) + self.DEFAULT
         return logging.StreamHandler.format(self, record)
 
+class _JsonFormatter(logging.Formatter):
+    """
+    Format event records as one json object per line
+    """
+    def format(self, record):
+        e = {'time': record.created, 'event': record.getMessage(), 'host': socket.gethostname(), 'pid': record.process}
+        e.update(getattr(record, 'event', {}))
+        return json.dumps(e, default=str)
+
 class Logger():
 
-    def __init__(self, logfile = "pipeline.logging", log_dir = "logs"):
+    def __init__(self, logfile = "pipeline.logging", log_dir = "logs", events_file = None):
+        """
+        events_file: file where to append the json-lines events (see event()),
+                     if None it is taken from the env variable LILF_EVENTS ('1' for <logfile>.events.jsonl), '' to disable
+        """
 
         # hopefully kill other loggers
         logger = logging.getLogger()
@@ -44,7 +60,12 @@ class Logger():
         self.log_dir = log_dir
         self.backup(logfile, log_dir)
         self.set_logger(logfile, log_dir)
-        
+
+        if events_file is None: events_file = os.environ.get('LILF_EVENTS', '')
+        if events_file == '1': events_file = os.path.splitext(logfile)[0]+'.events.jsonl'
+        if events_file != '': self.set_events(events_file)
+        context['pipeline'] = os.path.splitext(os.path.basename(logfile))[0]
+
 
     def backup(self, logfile, log_dir):
 
@@ -86,6 +107,74 @@ class Logger():
 
         logger.info('Logging initialised in %s (file: %s)' % (os.getcwd(), logfile))
 
+    def set_events(self, events_file):
+        """
+        Write the events in events_file (appending, to keep the history of multiple runs).
+        Records are passed through a queue to a listener thread, so logging an event never waits on the disk.
+        """
+        _start_events(events_file)
+        logger.info('Events written in %s' % events_file)
+
     
 # this is used by all libraries for logging
 logger = logging.getLogger("LiLF")
+
+# structured events, enabled with Logger(events_file=...)
+events = logging.getLogger("LiLF.events")
+events.setLevel(logging.INFO)
+events.propagate = False
+# fields added to every event (e.g. pipeline, current step)
+context = {}
+# threads writing the events
+listeners = []
+
+def _start_events(events_file):
+    handlerFile = logging.FileHandler(os.path.abspath(events_file))
+    handlerFile.setFormatter(_JsonFormatter())
+    queue = Queue()
+    events.handlers = [logging.handlers.QueueHandler(queue)]
+    listener = logging.handlers.QueueListener(queue, handlerFile)
+    listener.start()
+    listeners.append(listener)
+
+def restart_events():
+    """
+    In a forked child (e.g. a multiprocessing.Process), where the threads writing the events of the parent do not
+    exist: write the events to the same files with new threads. Call stop_events() before the child exits.
+    """
+    events_files = [l.handlers[0].baseFilename for l in listeners]
+    del listeners[:]
+    events.handlers = []
+    for events_file in events_files:
+        _start_events(events_file)
+
+def stop_events():
+    """
+    Write the queued events and stop the threads writing them (e.g. at the end of a child process, whose exit
+    skips the atexit handlers)
+    """
+    for l in listeners:
+        if l._thread is not None: l.stop()
+
+atexit.register(stop_events)
+
+class events_paused(object):
+    """
+    Stop the threads writing the events, e.g. around os.fork() which can deadlock the child of a multi-threaded
+    process. Events logged meanwhile are queued and written when the threads restart.
+    """
+    def __enter__(self):
+        self.stopped = [l for l in listeners if l._thread is not None]
+        for l in self.stopped: l.stop()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for l in self.stopped: l.start()
+        return False
+
+def event(name, **fields):
+    """
+    Log a structured event, e.g. event('job_end', ms='SB000.MS', wall=10.2). Nothing is done if events are disabled.
+    """
+    if not events.handlers: return
+    # the context is copied now, the record is formatted later by the listener thread
+    events.info(name, extra={'event': dict(context, **fields)})
@@ -1,12 +1,12 @@
 #!/usr/bin/python
 
-import os, sys, shutil
+import os, sys, shutil, multiprocessing
 
 from casacore import tables
 import numpy as np
 import pyregion
 from pyregion.parser_helper import Shape
-from LiLF import lib_util
+from LiLF import lib_util, lib_log
 
 from astropy.coordinates import get_sun, SkyCoord, EarthLocation, AltAz
 from astropy.time import Time
@@ -14,6 +14,9 @@ from astropy import units as u
 
 from LiLF.lib_log import logger
 
+# python scripts with a main(argv) that AllMSs.run() can call in forked processes instead of new interpreters
+inprocess_scripts = ['BLsmooth.py', 'reweight.py', 'flagonmindata.py', 'mslin2circ.py', 'addcol2ms.py']
+
 # remove ires warning
 from astropy.utils import iers
 iers.conf.auto_download = False  
@@ -114,13 +117,18 @@ class AllMSs(object):
         return int(round(self.getBandwidth()/(size)))
 
 
-    def run(self, command, log, commandType='', maxThreads=None):
+    def run(self, command, log, commandType='', maxThreads=None, inprocess=None):
         """
         Run command 'command' of type 'commandType', and use 'log' for logger,
         for each MS of AllMSs.
         The command and log file path can be customised for each MS using keywords (see: 'MS.concretiseString()').
         Beware: depending on the value of 'Scheduler.max_threads' (see: lib_util.py), the commands are run in parallel.
+        inprocess: run the scripts in inprocess_scripts with run_inprocess() (default: env variable LILF_INPROCESS=1)
         """
+        if inprocess is None: inprocess = os.environ.get('LILF_INPROCESS', '0') == '1'
+        if inprocess and commandType == 'python' and command.split()[0] in inprocess_scripts:
+            return self.run_inprocess(command, log, maxThreads=maxThreads)
+
         # add max num of threads given the total jobs to run
         # e.g. in a 64 processors machine running on 16 MSs, would result in numthreads=4
         if commandType == 'DP3': command += ' numthreads='+str(self.getNThreads())
@@ -129,7 +137,7 @@ class AllMSs(object):
             commandCurrent = MSObject.concretiseString(command)
             logCurrent     = MSObject.concretiseString(log)
 
-            self.scheduler.add(cmd = commandCurrent, log = logCurrent, commandType = commandType)
+            self.scheduler.add(cmd = commandCurrent, log = logCurrent, commandType = commandType, ms = MSObject.pathMS)
 
             # Provide debug output.
             #lib_util.printLineBold("commandCurrent:")
@@ -139,6 +147,47 @@ class AllMSs(object):
 
         self.scheduler.run(check = True, maxThreads = maxThreads)
 
+    def run_inprocess(self, command, log, maxThreads=None):
+        """
+        Like run() for one of the inprocess_scripts: the script is loaded once and its main() is called with the
+        arguments of the command in a forked process per MS, avoiding the interpreter startup and the imports.
+        """
+        import shlex, time
+
+        module = lib_util.load_script(command.split()[0])
+        if module is None or not hasattr(module, 'main'):
+            return self.run(command, log, commandType='python', maxThreads=maxThreads, inprocess=False)
+
+        jobs = []
+        for MSObject in self.mssListObj:
+            argv = shlex.split(MSObject.concretiseString(command))[1:]
+            logCurrent = self.scheduler.log_dir + '/' + MSObject.concretiseString(log) if log != '' else os.devnull
+            logger.debug('Running python (in process): %s' % ' '.join([command.split()[0]]+argv))
+            jobs.append((argv, logCurrent, MSObject.pathMS))
+        if self.scheduler.dry: return
+
+        # processes are forked from this (main) thread only, up to nprocs at a time
+        nprocs = self.scheduler.maxThreads if maxThreads is None else min(maxThreads, self.scheduler.maxThreads)
+        returncodes = {}
+        running = {} # pid -> (job index, start time, event fields)
+        pending = list(enumerate(jobs))
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < nprocs:
+                i, (argv, logCurrent, ms) = pending.pop(0)
+                fields = {'type': 'python', 'log': os.path.basename(logCurrent), 'ms': ms}
+                lib_log.event('job_start', **fields)
+                running[lib_util.fork_inprocess(module, argv, logCurrent)] = (i, time.time(), fields)
+            pid, status, rusage = os.wait4(-1, 0)
+            if pid not in running: continue
+            i, start, fields = running.pop(pid)
+            returncodes[i] = lib_util.end_inprocess(status, rusage, start, **fields)
+
+        for i, (argv, logCurrent, ms) in enumerate(jobs):
+            if returncodes.get(i, 1) != 0:
+                logger.error('python run problem on:\n'+logCurrent)
+                raise RuntimeError('python run problem on:\n'+logCurrent)
+            if logCurrent != os.devnull: self.scheduler.check_run(logCurrent, 'python')
+
     def addcol(self, newcol, fromcol, usedysco='auto', log='$nameMS_addcol.log'):
         """
         # TODO: it might be that if col exists and is dysco, forcing no dysco will not work. Maybe force TiledColumnStMan in such cases?
@@ -192,6 +241,15 @@ class AllMSs(object):
             pl.savefig(png)
 
 
+def _copy_rows(pathMS, pathMSout, startrow, nrow):
+    """
+    Deep copy the rows startrow:startrow+nrow of an MS (with its subtables) in a new MS
+    """
+    with tables.table(pathMS, ack = False) as t:
+        with t.selectrows(np.arange(startrow, startrow+nrow)) as tsel:
+            tsel.copy(pathMSout, deep = True).close()
+
+
 class MS(object):
 
     def __init__(self, pathMS):
@@ -385,7 +443,7 @@ class MS(object):
         Return the time interval of this observation
         """
         with tables.table(self.pathMS, ack = False) as t:
-            return ( t.getcol("TIME")[0], t.getcol("TIME")[-1] )
+            return ( t.getcell("TIME", 0), t.getcell("TIME", t.nrows()-1) )
 
 
     def getNtime(self):
@@ -396,6 +454,53 @@ class MS(object):
             return len(np.unique(t.getcol("TIME")))
 
 
+    def getTimeChunks(self, nchunks, blocksize=1000000):
+        """
+        Divide the MS in nchunks contiguous row ranges with about the same number of time slots.
+        The MS must be sorted in time (as written by DP3), the TIME column is read in blocks
+        and only the first row of each time slot is kept.
+        Return a list of (startrow, nrow, starttime, endtime)
+        """
+        with tables.table(self.pathMS, ack = False) as t:
+            nrows = t.nrows()
+            timestarts = [] # first row of each time slot
+            last = None
+            for startrow in range(0, nrows, blocksize):
+                time = t.getcol('TIME', startrow=startrow, nrow=blocksize)
+                if np.any(time[1:] < time[:-1]) or (last is not None and time[0] < last):
+                    raise ValueError('%s is not sorted in time.' % self.pathMS)
+                new = np.empty(len(time), dtype=bool)
+                new[0] = (time[0] != last)
+                new[1:] = (time[1:] != time[:-1])
+                timestarts.append(startrow + np.flatnonzero(new))
+                last = time[-1]
+            timestarts = np.append(np.concatenate(timestarts), nrows)
+
+            chunks = []
+            for times in np.array_split(np.arange(len(timestarts)-1), nchunks):
+                if len(times) == 0: continue
+                startrow, endrow = timestarts[times[0]], timestarts[times[-1]+1]
+                chunks.append((int(startrow), int(endrow-startrow), t.getcell('TIME', startrow), t.getcell('TIME', endrow-1)))
+
+        return chunks
+
+
+    def splitRows(self, chunks, max_io=4):
+        """
+        Copy contiguous row ranges in new MSs, without query or sorting.
+        chunks: list of (pathMSout, startrow, nrow)
+        max_io: number of MSs written at the same time
+        """
+        for pathMSout, startrow, nrow in chunks:
+            lib_util.check_rm(pathMSout)
+        if max_io > 1 and len(chunks) > 1:
+            with multiprocessing.get_context('fork').Pool(min(max_io, len(chunks))) as pool:
+                pool.starmap(_copy_rows, [(self.pathMS, pathMSout, startrow, nrow) for pathMSout, startrow, nrow in chunks])
+        else:
+            for pathMSout, startrow, nrow in chunks:
+                _copy_rows(self.pathMS, pathMSout, startrow, nrow)
+
+
     def getTimeInt(self):
         """
         Get time interval in seconds
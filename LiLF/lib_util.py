@@ -6,7 +6,6 @@ import numpy as np
 import multiprocessing, subprocess
 from threading import Thread
 from queue import Queue
-import pyregion
 import gc
 
 if (sys.version_info > (3, 0)):
@@ -14,11 +13,15 @@ if (sys.version_info > (3, 0)):
 else:
     from ConfigParser import ConfigParser
 
-# load here to be sure to have "Agg" at the beginning
-import matplotlib as mpl
-mpl.use("Agg")
+# be sure to have "Agg" at the beginning, without importing matplotlib if it is not needed
+if 'matplotlib' in sys.modules:
+    import matplotlib as mpl
+    mpl.use("Agg")
+else:
+    os.environ['MPLBACKEND'] = 'Agg'
 
 from LiLF.lib_log import logger
+from LiLF import lib_log
 
 def getParset(parsetFile='../lilf.config'):
     """
@@ -40,6 +43,8 @@ def getParset(parsetFile='../lilf.config'):
     if not config.has_section('flag'): config.add_section('flag')
     if not config.has_section('model'): config.add_section('model')
     if not config.has_section('PiLL'): config.add_section('PiLL')
+    if not config.has_section('cache'): config.add_section('cache')
+    if not config.has_section('LiLF'): config.add_section('LiLF')
 
     ### LOFAR ###
 
@@ -50,6 +55,12 @@ def getParset(parsetFile='../lilf.config'):
     add_default('PiLL', 'project', '')
     add_default('PiLL', 'target', '')
     add_default('PiLL', 'obsid', '') # unique ID
+    add_default('PiLL', 'concurrent', 'False') # run the pipelines of different fields at the same time
+    add_default('PiLL', 'max_cpu', '0') # cpus shared by all concurrent pipelines (0: all)
+    add_default('PiLL', 'max_mem', '0') # GB of memory shared by all concurrent pipelines (0: all)
+    add_default('PiLL', 'cpu_per_pipeline', '0') # cpus given to each concurrent pipeline (0: max_cpu/4)
+    add_default('PiLL', 'mem_per_pipeline', '0') # GB of memory reserved by each concurrent pipeline (0: max_mem/4)
+    add_default('PiLL', 'min_disk', '50') # GB of free disk (beyond the expected usage of running pipelines) to start a new one
     # preprocess
     add_default('LOFAR_preprocess', 'fix_table', 'True') # fix bug in some old observations
     add_default('LOFAR_preprocess', 'renameavg', 'True')
@@ -69,6 +80,8 @@ def getParset(parsetFile='../lilf.config'):
     add_default('LOFAR_timesplit', 'cal_dir', '') # by default the repository is tested, otherwise ../obsid_3[c|C]*
     add_default('LOFAR_timesplit', 'ngroups', '1')
     add_default('LOFAR_timesplit', 'initc', '0')
+    add_default('LOFAR_timesplit', 'max_io', '4')
+    add_default('LOFAR_timesplit', 'direct_timesplit', 'False') # skip the intermediate mss/mss.MS and concatenate each time chunk
     # quick-self
     add_default('LOFAR_quick-self', 'data_dir', './data-bkp/')
     # dd-parallel
@@ -79,6 +92,7 @@ def getParset(parsetFile='../lilf.config'):
     add_default('LOFAR_dd-serial', 'minCalFlux60', '1')
     add_default('LOFAR_dd-serial', 'removeExtendedCutoff', '0.0005')
     add_default('LOFAR_dd-serial', 'target_dir', '') # ra,dec
+    add_default('LOFAR_dd-serial', 'noise_method', 'bdsf') # bdsf, native (see lib_img.Image.getNoise)
     # ddfacet
     add_default('LOFAR_ddfacet', 'maxniter', '10')
     add_default('LOFAR_ddfacet', 'calFlux', '2.0')
@@ -104,6 +118,8 @@ def getParset(parsetFile='../lilf.config'):
 
     ### General ###
 
+    # options common to all pipelines
+    add_default('LiLF', 'mask_engine', 'bdsf') # bdsf, numpy (see make_mask.make_mask), used by all masks
     # flag
     add_default('flag', 'stations', '') # LOFAR
     add_default('flag', 'antennas', '') # uGMRT
@@ -112,6 +128,10 @@ def getParset(parsetFile='../lilf.config'):
     add_default('model', 'fits_model', '')
     add_default('model', 'apparent', 'False')
     add_default('model', 'userReg', '')
+    # cache of calibrator solutions (see lib_cache)
+    add_default('cache', 'cache_dir', '') # local cache directory (empty: no cache)
+    add_default('cache', 'max_size', '20') # GB
+    add_default('cache', 'remote', '') # remote copy of the cache, "host:/path" or "/path"
 
     return config
 
@@ -261,12 +281,16 @@ def lofar_nu2num(nu):
 
     return np.int(np.floor((1024./nu_clk) * (nu - (n-1) * nu_clk/2.)))
 
-def run_losoto(s, c, h5s, parsets, plots_dir=None) -> object:
+def run_losoto(s, c, h5s, parsets, plots_dir=None, concurrent=False, inprocess=False, readonly=None) -> object:
     """
     s : scheduler
     c : cycle name, e.g. "final"
     h5s : lists of H5parm files or string of 1 h5parm
     parsets : lists of parsets to execute
+    concurrent : run consecutive read-only parsets (e.g. plots) at the same time, each on a snapshot copy of the h5parm
+    inprocess : run the collector and the parsets in this process on a single open h5parm
+    readonly : dependency hints, dict {parset: bool} - True if the parset does not modify the h5parm.
+               Parsets not in the dict are inspected (only PLOT operations -> read-only)
     """
 
     logger.info("Running LoSoTo...")
@@ -283,21 +307,66 @@ def run_losoto(s, c, h5s, parsets, plots_dir=None) -> object:
             s.run(check = True)
             h5s[i] = newh5
 
+    if inprocess:
+        from LiLF import lib_h5
+        from losoto.h5parm import h5parm
+
     # concat/move
+    H = None
     if len(h5s) > 1:
         check_rm(h5out)
-        s.add('H5parm_collector.py -V -s sol000 -o '+h5out+' '+' '.join(h5s), log='losoto-'+c+'.log', commandType="python", processors='max')
-        s.run(check = True)
+        if inprocess:
+            H = h5parm(h5out, readonly=False)
+            lib_h5.collect_h5parms(h5s, H)
+        else:
+            s.add('H5parm_collector.py -V -s sol000 -o '+h5out+' '+' '.join(h5s), log='losoto-'+c+'.log', commandType="python", processors='max')
+            s.run(check = True)
     else:
         os.system('cp -r %s %s' % (h5s[0], h5out) )
 
     check_rm('plots')
     os.makedirs('plots')
 
+    # group parsets: consecutive read-only parsets can run together, the others are barriers
+    stages = []
     for parset in parsets:
-        logger.debug('-- executing '+parset+'...')
-        s.add('losoto -V '+h5out+' '+parset, log='losoto-'+c+'.log', logAppend=True, commandType="python", processors='max')
-        s.run(check = True)
+        if concurrent:
+            if readonly is not None and parset in readonly: is_ro = readonly[parset]
+            else:
+                from LiLF import lib_h5
+                is_ro = lib_h5.losoto_readonly(parset)
+        else: is_ro = False
+        if is_ro and len(stages) > 0 and stages[-1][0]:
+            stages[-1][1].append(parset)
+        else:
+            stages.append((is_ro, [parset]))
+
+    for is_ro, stage_parsets in stages:
+        if len(stage_parsets) > 1:
+            # parallel on snapshots: the h5parm must be closed and complete
+            if H is not None:
+                H.close()
+                H = None
+            snapshots = []
+            for i, parset in enumerate(stage_parsets):
+                logger.debug('-- executing '+parset+' (concurrent)...')
+                snapshot = h5out.replace('.h5','-snap%02i.h5' % i)
+                shutil.copy(h5out, snapshot)
+                snapshots.append(snapshot)
+                s.add('losoto -V '+snapshot+' '+parset, log='losoto-'+c+'-snap%02i.log' % i, logAppend=False, commandType="python", processors=1)
+            s.run(check = True)
+            for snapshot in snapshots: os.remove(snapshot)
+        else:
+            parset = stage_parsets[0]
+            logger.debug('-- executing '+parset+'...')
+            if inprocess:
+                if H is None: H = h5parm(h5out, readonly=False)
+                lib_h5.run_losoto_parset(H, parset)
+            else:
+                s.add('losoto -V '+h5out+' '+parset, log='losoto-'+c+'.log', logAppend=True, commandType="python", processors='max')
+                s.run(check = True)
+
+    if H is not None: H.close()
 
     if plots_dir is None:
         check_rm('plots-' + c)
@@ -308,6 +377,427 @@ def run_losoto(s, c, h5s, parsets, plots_dir=None) -> object:
         check_rm('plots')
 
 
+def get_scratch(min_free=0, shm=False):
+    """
+    Return a fast local scratch directory: LILF_SCRATCH if set, otherwise the first writable among /dev/shm (only if shm),
+    /localwork.ssd, /localwork and the system temporary dir, with at least min_free GB free.
+    """
+    import tempfile
+    dirs = [os.environ.get('LILF_SCRATCH', '')] + (['/dev/shm'] if shm else []) + ['/localwork.ssd', '/localwork', tempfile.gettempdir()]
+    for d in dirs:
+        if d == '' or not os.path.isdir(d) or not os.access(d, os.W_OK): continue
+        if shutil.disk_usage(d).free/1024.**3 < min_free: continue
+        return d
+    return tempfile.gettempdir()
+
+
+def _du(path):
+    return sum([os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files])
+
+
+class ScratchCache(object):
+    """
+    Base of the caches on local scratch: one subdirectory per key, described in index.json, and the least recently
+    used entries (not in use) evicted beyond max_size GB
+    """
+    name = 'Scratch cache'
+
+    def __init__(self, root, max_size=100):
+        self.root = os.path.abspath(root)
+        self.max_size = max_size*1024**3
+        os.makedirs(self.root, exist_ok=True)
+        self.index_file = os.path.join(self.root, 'index.json')
+
+    def _lock(self):
+        import fcntl
+        f = open(os.path.join(self.root, 'index.lock'), 'w')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _read_index(self):
+        import json
+        if not os.path.exists(self.index_file): return {}
+        with open(self.index_file) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        import json
+        with open(self.index_file+'.tmp', 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(self.index_file+'.tmp', self.index_file)
+
+    @staticmethod
+    def _in_use(entry):
+        """
+        True if the entry is used by a running process other than this one
+        """
+        if entry['pid'] is None or entry['pid'] == os.getpid(): return False
+        try:
+            os.kill(entry['pid'], 0)
+            return True
+        except OSError:
+            return False
+
+    def _evict(self, index, keep=None):
+        """
+        Remove the least recently used entries (not in use) until the cache fits in max_size
+        """
+        for key in sorted(index, key=lambda k: index[k]['last_used']):
+            if sum([e['size'] for e in index.values()]) <= self.max_size: break
+            if key == keep or self._in_use(index[key]): continue
+            logger.info('%s: evicting %s' % (self.name, key[:8]))
+            check_rm(os.path.join(self.root, key))
+            del index[key]
+
+
+class ReorderCache(ScratchCache):
+    """
+    Keep the files reordered by wsclean on local scratch and reuse them (-save-reordered/-reuse-reordered, wsclean>=3.3)
+    in the following runs on unchanged data. Entries are keyed on the MSs, the content of the data/flag/weight columns
+    (see fingerprint()) and the parameters that define the reordered parts; the least recently used are evicted beyond
+    max_size GB. Enable it with the env variable LILF_REORDER_CACHE ('1' to place it in get_scratch(), or a dir),
+    the size in GB is set by LILF_REORDER_BUDGET (default 100).
+    """
+    name = 'Reorder cache'
+    # parameters that change the reordered files
+    reorder_parms = ['data_column', 'channels_out', 'channel_range', 'interval', 'intervals_out', 'pol', 'field',
+                     'spws', 'even_timesteps', 'odd_timesteps', 'use_idg', 'grid_with_beam', 'apply_primary_beam']
+
+    @classmethod
+    def from_env(cls):
+        """
+        Return the cache configured by the env variables, or None if disabled
+        """
+        root = os.environ.get('LILF_REORDER_CACHE', '')
+        if root == '' or root == '0': return None
+        if root == '1': root = os.path.join(get_scratch(), 'lilf-reorder-%s' % os.environ.get('USER', 'user'))
+        return cls(root, max_size=float(os.environ.get('LILF_REORDER_BUDGET', 100)))
+
+    def key(self, MSs_files, kwargs):
+        """
+        Return the key of the reordered files of a wsclean run
+        """
+        mss = MSs_files.split()
+        datacol = kwargs.get('data_column')
+        if datacol is None: # wsclean default
+            with tables.table(mss[0], ack=False) as t:
+                datacol = 'CORRECTED_DATA' if 'CORRECTED_DATA' in t.colnames() else 'DATA'
+        params = dict([(p, str(kwargs[p])) for p in self.reorder_parms if kwargs.get(p) is not None])
+        params['mss'] = [os.path.abspath(ms) for ms in mss]
+        params['data_column'] = datacol
+        return fingerprint(columns=[(ms, col) for ms in mss for col in [datacol, 'FLAG', 'WEIGHT_SPECTRUM']], params=params)
+
+    def begin(self, key):
+        """
+        Return the wsclean parameters to reuse the reordered files of key if available, otherwise to save them
+        ('' if another process is saving them)
+        """
+        with self._lock():
+            index = self._read_index()
+            entry_dir = os.path.join(self.root, key)
+            if key in index and index[key]['complete'] and os.path.isdir(entry_dir):
+                index[key]['last_used'] = time.time()
+                index[key]['pid'] = os.getpid()
+                self._write_index(index)
+                return '-reuse-reordered -temp-dir %s' % entry_dir
+            if key in index and self._in_use(index[key]): return ''
+            check_rm(entry_dir)
+            os.makedirs(entry_dir)
+            index[key] = {'complete': False, 'size': 0, 'last_used': time.time(), 'start': time.time(),
+                          'reorder_time': 0., 'reused': 0, 'saved': 0., 'pid': os.getpid()}
+            self._write_index(index)
+            return '-save-reordered -temp-dir %s' % entry_dir
+
+    def end(self, key, ok=True):
+        """
+        Record the outcome of a run started with begin(key), report the time saved and evict old entries
+        """
+        with self._lock():
+            index = self._read_index()
+            if key not in index or index[key]['pid'] != os.getpid(): return
+            entry = index[key]
+            entry_dir = os.path.join(self.root, key)
+            entry['pid'] = None
+            if entry['complete']:
+                entry['reused'] += 1
+                entry['saved'] += entry['reorder_time']
+                logger.info('Reorder cache: reused %s, saved ~%.0f s (%.0f s in total).' % (key[:8], entry['reorder_time'], entry['saved']))
+                lib_log.event('reorder_reuse', key=key, saved=entry['reorder_time'])
+            elif ok:
+                # the reordered data (not the model, "-m.tmp") are written at the beginning of the run
+                mtimes = [os.path.getmtime(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir) if not f.endswith('-m.tmp')]
+                entry['reorder_time'] = max(mtimes)-entry['start'] if len(mtimes) > 0 else 0.
+                entry['size'] = _du(entry_dir)
+                entry['complete'] = True
+                logger.debug('Reorder cache: saved %s (%.1f GB, reorder time ~%.0f s).' % (key[:8], entry['size']/1024.**3, entry['reorder_time']))
+            else:
+                check_rm(entry_dir)
+                del index[key]
+            self._evict(index, keep=key)
+            self._write_index(index)
+
+
+class DDFCache(ScratchCache):
+    """
+    Manage the cache directories of DDFacet on local scratch (/dev/shm if large enough, see get_scratch()).
+    Each set of parameters defining the facets, PSF and beam gets its own directory, which the following runs with
+    the same parameters reuse: if only the data column changed the dirty images are recomputed but the PSF and
+    facet caches are kept, if flags/weights/uvw changed the whole cache is reset. An explicit Cache_Reset or
+    Cache_Dirty is never changed.
+    Directories used by a running process are never shared or evicted, the least recently used are evicted beyond
+    max_size GB, and at exit those left by interrupted runs (and all those created on /dev/shm) are removed.
+    Enable it with the env variable LILF_DDF_CACHE ('1' to place it in get_scratch(), or a dir), the size in GB
+    is set by LILF_DDF_CACHE_BUDGET (default 50).
+    """
+    name = 'DDF cache'
+    # parameters not changing the PSF and facet caches
+    volatile_parms = ['Data_ColName', 'Output', 'Deconv', 'Mask', 'Predict', 'Cache', 'Log', 'Debug', 'Parallel',
+                      'Misc', 'SSD', 'SSD2', 'HMP', 'GAClean', 'Hogbom']
+
+    def __init__(self, root, max_size=50):
+        ScratchCache.__init__(self, root, max_size)
+        self.created = []
+        import atexit
+        atexit.register(self.cleanup)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Return the cache configured by the env variables, or None if disabled
+        """
+        root = os.environ.get('LILF_DDF_CACHE', '')
+        if root == '' or root == '0': return None
+        max_size = float(os.environ.get('LILF_DDF_CACHE_BUDGET', 50))
+        if root == '1': root = os.path.join(get_scratch(min_free=max_size, shm=True), 'lilf-ddfcache-%s' % os.environ.get('USER', 'user'))
+        return cls(root, max_size=max_size)
+
+    def get_mss(self, kwargs):
+        """
+        Return the MSs of a DDF run: Data_MS is a comma-separated list or a text file with one MS per line
+        """
+        data_ms = str(kwargs['Data_MS'])
+        if os.path.isfile(data_ms):
+            with open(data_ms) as f:
+                return [l.strip() for l in f if l.strip() != '']
+        return data_ms.split(',')
+
+    def begin(self, kwargs):
+        """
+        Return (key, dict of the Cache_* parameters for DDF)
+        """
+        mss = self.get_mss(kwargs)
+        params = dict([(p, str(v)) for p, v in kwargs.items() if v is not None and p.split('_')[0] not in self.volatile_parms
+                       and p not in self.volatile_parms])
+        params['mss'] = [os.path.abspath(ms) for ms in mss]
+        key = fingerprint(params=params)
+        weight_col = kwargs.get('Weight_ColName', 'WEIGHT_SPECTRUM')
+        uv_fp = fingerprint(columns=[(ms, col) for ms in mss for col in ['UVW', 'FLAG', weight_col]])
+        data_fp = fingerprint(columns=[(ms, kwargs.get('Data_ColName', 'CORRECTED_DATA')) for ms in mss])
+
+        with self._lock():
+            index = self._read_index()
+            if key in index and self._in_use(index[key]):
+                # no sharing with a running process, use a private directory
+                key = '%s.%i' % (key, os.getpid())
+            entry_dir = os.path.join(self.root, key)
+            cache_parms = {'Cache_Dir': entry_dir}
+            if key in index and os.path.isdir(entry_dir):
+                entry = index[key]
+                # an explicit Cache_Reset/Cache_Dirty of the caller is always passed through
+                if entry['uv'] != uv_fp or not entry['complete']: # changed visibilities or interrupted run
+                    if not 'Cache_Reset' in kwargs: cache_parms['Cache_Reset'] = 1
+                elif int(kwargs.get('Cache_Reset', 0)) != 1:
+                    if entry['data'] != data_fp and not 'Cache_Dirty' in kwargs: cache_parms['Cache_Dirty'] = 'reset'
+                    logger.info('DDF cache: reusing PSF and facets of %s.' % key[:8])
+                    lib_log.event('ddf_cache_reuse', key=key)
+            else:
+                check_rm(entry_dir)
+                os.makedirs(entry_dir)
+                self.created.append(key)
+                index[key] = {'size': 0, 'created': time.time()}
+            index[key].update({'last_used': time.time(), 'pid': os.getpid(), 'uv': uv_fp, 'data': data_fp, 'complete': False})
+            self._write_index(index)
+        return key, cache_parms
+
+    def end(self, key, ok=True):
+        """
+        Record the outcome of a run started with begin() and evict old entries, a failed run removes its directory
+        """
+        with self._lock():
+            index = self._read_index()
+            if key not in index or index[key]['pid'] != os.getpid(): return
+            entry_dir = os.path.join(self.root, key)
+            if ok:
+                index[key].update({'pid': None, 'complete': True, 'size': _du(entry_dir)})
+            else:
+                check_rm(entry_dir)
+                del index[key]
+            self._evict(index, keep=key)
+            self._write_index(index)
+
+    def cleanup(self):
+        """
+        Remove the directories of the runs of this process which did not end, and all those it created on /dev/shm
+        """
+        if not os.path.exists(self.index_file): return
+        volatile = self.root.startswith('/dev/shm')
+        with self._lock():
+            index = self._read_index()
+            for key in list(index.keys()):
+                if index[key]['pid'] == os.getpid() or (volatile and key in self.created):
+                    check_rm(os.path.join(self.root, key))
+                    del index[key]
+            self._write_index(index)
+
+
+def _meminfo(key='MemAvailable'):
+    """
+    Return a value of /proc/meminfo in GB (0 if not available)
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith(key+':'): return int(line.split()[1])/1024.**2
+    except IOError:
+        pass
+    return 0.
+
+
+class WscleanPlanner(object):
+    """
+    Choose the memory and parallelisation parameters of wsclean from the visibility volume and the image size,
+    record them with the measured run time and reuse the fastest known ones for the same field, imaging setup
+    and node type. Enable it with the env variable LILF_WSCLEAN_PLANS ('1' for ~/.lilf/wsclean_plans.db, or the
+    path of the database). Parameters given explicitly to run_wsclean() are never changed.
+    """
+    tuned_parms = ['abs_mem', 'parallel_gridding', 'parallel_deconvolution', 'deconvolution_channels']
+
+    def __init__(self, filename, s):
+        import sqlite3
+        self.filename = os.path.abspath(filename)
+        self.max_processors = s.max_processors
+        self.node = '%s-%icpu-%iGB' % (s.get_cluster(), multiprocessing.cpu_count(), round(_meminfo('MemTotal')))
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self.conn = sqlite3.connect(self.filename, timeout=600)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS plans (signature TEXT, field TEXT, node TEXT, plan TEXT, '
+                              'nvis REAL, npix REAL, wall REAL, time REAL)')
+
+    @classmethod
+    def from_env(cls, s):
+        """
+        Return the planner configured by the env variable, or None if disabled
+        """
+        filename = os.environ.get('LILF_WSCLEAN_PLANS', '')
+        if filename == '' or filename == '0': return None
+        if filename == '1': filename = os.path.expanduser('~/.lilf/wsclean_plans.db')
+        return cls(filename, s)
+
+    def estimate(self, MSs_files, kwargs):
+        """
+        Return the field (phase centre), the number of visibilities (rows x channels x correlations),
+        the image size in pixels, the number of output channels and of polarisations
+        """
+        mss = MSs_files.split()
+        nvis = 0
+        for ms in mss:
+            with tables.table(ms, ack=False) as t:
+                nrows = t.nrows()
+            with tables.table(ms+'/SPECTRAL_WINDOW', ack=False) as t:
+                nchan = t.getcell('NUM_CHAN', 0)
+            with tables.table(ms+'/POLARIZATION', ack=False) as t:
+                ncorr = t.getcell('NUM_CORR', 0)
+            if kwargs.get('channel_range') is not None:
+                chan_start, chan_end = [int(c) for c in str(kwargs['channel_range']).split()]
+                nchan = min(nchan, chan_end) - chan_start
+            nvis += nrows*nchan*ncorr
+        with tables.table(mss[0]+'/FIELD', ack=False) as t:
+            ra, dec = np.degrees(t.getcell('PHASE_DIR', 0)[0])
+        field = '%.2f_%.2f' % (ra % 360, dec)
+
+        size = kwargs.get('size', 1)
+        if type(size) is int: size = [size, size]
+        if type(size) is str: size = [int(v) for v in size.split()]
+        pol = str(kwargs.get('pol', 'I'))
+        npol = len(pol.split(',')) if ',' in pol else len(pol)
+        return field, nvis, size, int(kwargs.get('channels_out', 1)), npol
+
+    def candidates(self, nvis, size, channels_out, npol, kwargs):
+        """
+        Return the plans to compare: the one expected from the sizes first, then variations of the gridding parallelism
+        """
+        plan = {}
+        # share of the node memory (several pipelines can run on the same node, see LILF_MAX_CPU)
+        mem = _meminfo('MemAvailable')*min(1., self.max_processors/float(multiprocessing.cpu_count()))
+        if mem > 0: plan['abs_mem'] = '%i' % max(1, int(0.8*mem))
+        # images are gridded in parallel if there are enough of them and the (padded, complex) grids fit in memory
+        grid = size[0]*size[1]*1.2**2*16/1024.**3
+        ngrid = int(min(channels_out*npol, max(1, self.max_processors//8), 0.5*mem/grid if mem > 0 else 1))
+        if ngrid > 1 and 'use_idg' not in kwargs: plan['parallel_gridding'] = ngrid
+        # large images are deconvolved in tiles of ~2k pixels
+        side = max(size)
+        if side > 4096 and float(kwargs.get('niter', 0)) > 0:
+            plan['parallel_deconvolution'] = int(np.ceil(side/np.ceil(side/2048.)))
+        # many channels are deconvolved on a few and interpolated with the fitted polynomial
+        if kwargs.get('fit_spectral_pol') is not None:
+            nchan = max(4, int(kwargs['fit_spectral_pol']))
+            if channels_out > nchan: plan['deconvolution_channels'] = nchan
+
+        plans = [plan]
+        if 'parallel_gridding' in plan:
+            plans.append(dict([(k, v) for k, v in plan.items() if k != 'parallel_gridding']))
+            if 2*plan['parallel_gridding'] <= min(channels_out*npol, self.max_processors) and 2*plan['parallel_gridding']*grid < 0.5*mem:
+                plans.append(dict(plan, parallel_gridding=2*plan['parallel_gridding']))
+        # never change what is given explicitly
+        for plan in plans:
+            for parm in list(plan.keys()):
+                if parm in kwargs or (parm == 'abs_mem' and 'mem' in kwargs): del plan[parm]
+        return plans
+
+    def plan(self, MSs_files, kwargs, reorder=''):
+        """
+        Return (signature, plan), the plan being a dict of wsclean parameters: the first candidate never run for this
+        signature, otherwise the fastest known one.
+        reorder: use of the reordered files of ReorderCache ('-save-reordered', '-reuse-reordered' or ''),
+                 which changes the run time independently of the plan
+        """
+        import json
+        field, nvis, size, channels_out, npol = self.estimate(MSs_files, kwargs)
+        setup = dict([(p, str(kwargs.get(p))) for p in ['scale', 'use_idg', 'multiscale', 'niter', 'fit_spectral_pol',
+                                                         'baseline_averaging', 'use_wgridder'] + self.tuned_parms])
+        setup.update({'field': field, 'node': self.node, 'size': size, 'channels_out': channels_out, 'npol': npol,
+                      'nvis': int(np.round(np.log2(max(nvis, 1)))), 'reorder': reorder})
+        signature = fingerprint(params=setup)
+
+        # abs_mem follows the memory available at each run, it is not part of the comparison
+        ident = lambda plan: json.dumps(dict([(k, v) for k, v in plan.items() if k != 'abs_mem']), sort_keys=True)
+        walls = {}
+        for plan, wall in self.conn.execute('SELECT plan, wall FROM plans WHERE signature=?', (signature,)):
+            walls.setdefault(plan, []).append(wall)
+        plans = self.candidates(nvis, size, channels_out, npol, kwargs)
+        chosen = None
+        for plan in plans:
+            if ident(plan) not in walls:
+                chosen = plan
+                break
+        if chosen is None:
+            chosen = json.loads(min(walls, key=lambda plan: np.median(walls[plan])))
+            if 'abs_mem' in plans[0]: chosen['abs_mem'] = plans[0]['abs_mem']
+        self._current = (signature, field, ident(chosen), nvis, size[0]*size[1])
+        logger.debug('wsclean plan for %.2e visibilities, %ix%i pixels: %s' % (nvis, size[0], size[1], str(chosen)))
+        return signature, chosen
+
+    def record(self, wall):
+        """
+        Store the run time of the last plan
+        """
+        signature, field, plan, nvis, npix = self._current
+        with self.conn:
+            self.conn.execute('INSERT INTO plans VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (signature, field, self.node, plan, nvis, npix, wall, time.time()))
+        lib_log.event('wsclean_plan', signature=signature, field=field, node=self.node, plan=plan, nvis=nvis, npix=npix, wall=wall)
+
+
 def run_wsclean(s, logfile, MSs_files, do_predict=False, **kwargs):
     """
     s : scheduler
@@ -318,12 +808,27 @@ def run_wsclean(s, logfile, MSs_files, do_predict=False, **kwargs):
     wsc_parms = []
     reordering_processors = np.min([len(MSs_files),s.max_processors])
 
+    # reuse the reordered files of a previous run on the same data
+    cache = ReorderCache.from_env()
+    reorder_key = None
+    reorder_parms = ''
+    if cache is not None and 'no_reorder' not in kwargs and 'temp_dir' not in kwargs:
+        reorder_key = cache.key(MSs_files, kwargs)
+        reorder_parms = cache.begin(reorder_key)
+
+    # memory and parallelisation sized on the data
+    planner = WscleanPlanner.from_env(s)
+    if planner is not None:
+        # runs saving or reusing the reordered files are compared only among themselves
+        signature, plan = planner.plan(MSs_files, kwargs, reorder=reorder_parms.split(' ')[0])
+        kwargs = dict(kwargs, **plan)
+
     # basic parms
-    wsc_parms.append( '-j '+str(s.max_processors)+' -reorder -parallel-reordering 4 ' )
+    wsc_parms.append( '-j '+str(s.max_processors)+' -reorder -parallel-reordering 4 '+reorder_parms )
     if 'use_idg' in kwargs.keys():
         if s.get_cluster() == 'Hamburg_fat' and socket.gethostname() in ['node31', 'node32', 'node33', 'node34', 'node35']:
             wsc_parms.append( '-idg-mode hybrid' )
-            wsc_parms.append( '-mem 10' )
+            if not 'mem' in kwargs and not 'abs_mem' in kwargs: wsc_parms.append( '-mem 10' )
         else:
             wsc_parms.append( '-idg-mode cpu' )
 
@@ -353,7 +858,12 @@ def run_wsclean(s, logfile, MSs_files, do_predict=False, **kwargs):
     # create command string
     command_string = 'wsclean '+' '.join(wsc_parms)
     s.add(command_string, log=logfile, commandType='wsclean', processors='max')
-    s.run(check=True)
+    start = time.time()
+    try:
+        s.run(check=True)
+    finally:
+        if reorder_key is not None: cache.end(reorder_key, ok=sys.exc_info()[0] is None)
+    if planner is not None: planner.record(time.time()-start)
 
     # Predict in case update_model_required cannot be used
     if do_predict == True:
@@ -369,10 +879,16 @@ def run_wsclean(s, logfile, MSs_files, do_predict=False, **kwargs):
         wsc_parms.append( MSs_files )
         # Test without reorder as it apperas to be faster
         # wsc_parms.insert(0, ' -reorder -parallel-reordering 4 ')
+        # unless the reordered files are still available
+        if reorder_key is not None:
+            wsc_parms.insert(0, '-reorder '+cache.begin(reorder_key))
         command_string = 'wsclean -predict ' \
                          '-j '+str(s.max_processors)+' '+' '.join(wsc_parms)
         s.add(command_string, log=logfile, commandType='wsclean', processors='max')
-        s.run(check=True)
+        try:
+            s.run(check=True)
+        finally:
+            if reorder_key is not None: cache.end(reorder_key, ok=sys.exc_info()[0] is None)
 
 def run_DDF(s, logfile, **kwargs):
     """
@@ -387,7 +903,11 @@ def run_DDF(s, logfile, **kwargs):
     ddf_parms.append( '--Log-Boring 1 --Debug-Pdb never --Parallel-NCPU %i --Misc-IgnoreDeprecationMarking=1 ' % (s.max_processors) )
 
     # cache dir
-    if not 'Cache_Dir' in list(kwargs.keys()):
+    cache = DDFCache.from_env() if not 'Cache_Dir' in list(kwargs.keys()) else None
+    if cache is not None:
+        cache_key, cache_parms = cache.begin(kwargs)
+        kwargs = dict(kwargs, **cache_parms)
+    elif not 'Cache_Dir' in list(kwargs.keys()):
         ddf_parms.append( '--Cache-Dir .' )
 
     # user defined parms
@@ -404,7 +924,10 @@ def run_DDF(s, logfile, **kwargs):
     # create command string
     command_string = 'DDF.py '+' '.join(ddf_parms)
     s.add(command_string, log=logfile, commandType='DDFacet', processors='max')
-    s.run(check=True)
+    try:
+        s.run(check=True)
+    finally:
+        if cache is not None: cache.end(cache_key, ok=sys.exc_info()[0] is None)
 
 
 class Region_helper():
@@ -418,6 +941,7 @@ class Region_helper():
         Path to ds9 region file.
     """
     def __init__(self, filename):
+        import pyregion
         self.filename = filename
         self.reg_list = pyregion.open(filename)
         min_ra, max_ra, min_dec, max_dec = [], [], [], []
@@ -472,6 +996,169 @@ class Skip(Exception):
     pass
 
 
+# peak RSS (kB) of the commands run by the Scheduler since the last reset, see Walker
+children_maxrss = [0]
+
+def call_accounted(cmd, **fields):
+    """
+    Like subprocess.call(cmd, shell=True) but keep track of the peak memory of the command (and its own children)
+    fields: added to the job_start/job_end events (see lib_log.event())
+    """
+    lib_log.event('job_start', **fields)
+    start = time.time()
+    p = subprocess.Popen(cmd, shell = True)
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status
+    children_maxrss[0] = max(children_maxrss[0], rusage.ru_maxrss)
+    lib_log.event('job_end', returncode=p.returncode, wall=time.time()-start, cpu=rusage.ru_utime+rusage.ru_stime,
+                  maxrss=rusage.ru_maxrss, read=rusage.ru_inblock*512, written=rusage.ru_oublock*512, **fields)
+    return p.returncode
+
+
+def load_script(name):
+    """
+    Import one of the LiLF scripts (e.g. 'BLsmooth.py') as a module, looking first in the PATH then in LiLF/scripts.
+    Return None if not found.
+    """
+    import importlib.util
+    modname = 'lilf_script_'+os.path.splitext(os.path.basename(name))[0]
+    if modname in sys.modules: return sys.modules[modname]
+    path = shutil.which(name) or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts', name)
+    if not os.path.exists(path): return None
+    spec = importlib.util.spec_from_file_location(modname, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[modname] = module
+    return module
+
+
+def fork_inprocess(module, argv, logfile):
+    """
+    Fork a process running module.main(argv) with stdout/stderr appended to logfile, return its pid.
+    The module is already loaded, so there is no interpreter startup nor imports to pay.
+    Must be called from the main thread, ideally with no other threads running (the events threads are paused here),
+    as locks held by other threads at the time of the fork could deadlock the child.
+    """
+    import threading, traceback
+    if threading.current_thread() is not threading.main_thread():
+        raise RuntimeError('fork_inprocess() must be called from the main thread.')
+    with lib_log.events_paused():
+        pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            fd = os.open(logfile, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            os.close(fd)
+            # new streams, what is left in the buffers of the parent must not end up in the log
+            sys.stdout = os.fdopen(1, 'w', buffering=1)
+            sys.stderr = os.fdopen(2, 'w', buffering=1)
+            sys.argv = [module.__file__] + list(argv)
+            module.main(list(argv))
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+    return pid
+
+
+def end_inprocess(status, rusage, start, **fields):
+    """
+    Account for a process of fork_inprocess() reaped with os.wait4(), return its exit code.
+    fields: added to the job_end event (see lib_log.event())
+    """
+    returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status
+    children_maxrss[0] = max(children_maxrss[0], rusage.ru_maxrss)
+    lib_log.event('job_end', returncode=returncode, wall=time.time()-start, cpu=rusage.ru_utime+rusage.ru_stime,
+                  maxrss=rusage.ru_maxrss, read=rusage.ru_inblock*512, written=rusage.ru_oublock*512, **fields)
+    return returncode
+
+
+def call_inprocess(module, argv, logfile, **fields):
+    """
+    Run module.main(argv) in a forked process (see fork_inprocess()) and return the exit code.
+    fields: added to the job_start/job_end events (see lib_log.event())
+    """
+    lib_log.event('job_start', **fields)
+    start = time.time()
+    pid = fork_inprocess(module, argv, logfile)
+    _, status, rusage = os.wait4(pid, 0)
+    return end_inprocess(status, rusage, start, **fields)
+
+
+def get_usage():
+    """
+    Return a snapshot of the resources used so far by this process and its (terminated) children:
+    wall time, cpu time (s), peak RSS of the children (kB) and bytes written to storage (None if unknown)
+    """
+    import resource
+    ru_self = resource.getrusage(resource.RUSAGE_SELF)
+    ru_child = resource.getrusage(resource.RUSAGE_CHILDREN)
+    written = None
+    try:
+        # on linux this includes the children that terminated
+        with open('/proc/self/io') as f:
+            io = dict([l.split(':') for l in f if ':' in l])
+        written = int(io['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return {'wall': time.time(), 'cpu': ru_self.ru_utime+ru_self.ru_stime+ru_child.ru_utime+ru_child.ru_stime,
+            'maxrss': ru_child.ru_maxrss, 'written': written}
+
+
+def fingerprint(inputs=None, columns=None, params=None, content=False):
+    """
+    Return a fingerprint of the inputs of a step.
+    inputs: list of files/dirs (glob patterns allowed), fingerprinted by size and mtime of every file (or by their content if content=True)
+    columns: list of (MS, column), fingerprinted by number of rows, column description and the storage files of the column
+    params: any json-serialisable object (e.g. a dict of parameters)
+    """
+    import hashlib, json
+    h = hashlib.sha1()
+
+    def add_file(filename):
+        st = os.stat(filename)
+        h.update(('%s %i %i\n' % (filename, st.st_size, st.st_mtime_ns)).encode())
+        if content:
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    h.update(block)
+
+    for pattern in (inputs or []):
+        for path in (sorted(glob.glob(pattern)) or [pattern]):
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for f in sorted(files):
+                        add_file(os.path.join(root, f))
+            elif os.path.exists(path):
+                add_file(path)
+            else:
+                h.update(('%s missing\n' % path).encode())
+
+    for pathMS, column in (columns or []):
+        with tables.table(pathMS, ack=False) as t:
+            if column not in t.colnames():
+                h.update(('%s %s missing\n' % (pathMS, column)).encode())
+                continue
+            dminfo = t.getdminfo(column)
+            h.update(json.dumps([pathMS, column, t.nrows(), t.getcoldesc(column), dminfo], sort_keys=True, default=str).encode())
+        # data written in the column changes its storage manager files (table.f<seqnr>*)
+        for f in sorted(glob.glob('%s/table.f%i*' % (pathMS, dminfo['SEQNR']))):
+            add_file(f)
+
+    if params is not None:
+        h.update(json.dumps(params, sort_keys=True, default=str).encode())
+
+    return h.hexdigest()
+
+
 class Walker():
     """
     An object of this class may be used to re-run a pipeline without repeating steps that were completed previously.
@@ -480,6 +1167,13 @@ class Walker():
     with w.if_todo("stepname"):
         Do whatever...
 
+    A step can declare its inputs, it is then re-run if they changed since it was done, and so are the steps that depend on it:
+    with w.if_todo("stepname", inputs=['cal-pa.h5'], columns=[(ms, 'DATA')], params={'niter':10}, depends=['otherstep']):
+        Do whatever...
+
+    Done steps are listed in the text file (remove a line to re-run a step), their fingerprints are kept in filename.db.
+    The time and resources used by every step are added to the history in filename.db, see scripts/walker_report.py.
+
     Adopted from https://stackoverflow.com/questions/12594148/skipping-execution-of-with-block
     """
     def __init__(self, filename):
@@ -487,18 +1181,72 @@ class Walker():
         self.filename = os.path.abspath(filename)
         self.__skip__ = False
         self.__step__ = None
+        self.__inputs__ = None
+        self.__usage__ = None
+        self._conn = None
+        self._pid = None
 
-    def if_todo(self, stepname):
+        # the text file is read once and is authoritative on which steps are done
+        with open(self.filename, "r") as f:
+            self._listed = set([stepname_done.rstrip() for stepname_done in f if stepname_done.rstrip() != ''])
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS steps (name TEXT PRIMARY KEY, fingerprint TEXT, done REAL)')
+            for name in set([r[0] for r in self.conn.execute('SELECT name FROM steps')]) - self._listed:
+                self.conn.execute('DELETE FROM steps WHERE name=?', (name,))
+            # steps done before fingerprints were recorded
+            self.conn.executemany('INSERT OR IGNORE INTO steps (name, fingerprint, done) VALUES (?, NULL, 0)',
+                                  [(name,) for name in self._listed])
+            self.conn.execute('CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY, start REAL, host TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS history (run INTEGER, step TEXT, start REAL, wall REAL, '
+                              'cpu REAL, maxrss INTEGER, written INTEGER)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS history_step ON history (step)')
+            self.run = self.conn.execute('INSERT INTO runs (start, host) VALUES (?, ?)',
+                                         (time.time(), socket.gethostname())).lastrowid
+
+    @property
+    def conn(self):
+        # connections cannot be shared across a fork
+        if self._conn is None or self._pid != os.getpid():
+            import sqlite3
+            self._conn = sqlite3.connect(self.filename+'.db', timeout=600)
+            self._pid = os.getpid()
+        return self._conn
+
+    def _get(self, stepname):
+        return self.conn.execute('SELECT fingerprint, done FROM steps WHERE name=?', (stepname,)).fetchone()
+
+    def if_todo(self, stepname, inputs=None, columns=None, params=None, depends=None):
         """
         This is basically a way to get a context manager to accept an argument. Will return "self" as context manager
         if called as context manager.
+        inputs, columns, params: inputs of the step, see fingerprint()
+        depends: names of the steps this one depends on, if any of them was re-run this step is re-run too
         """
         self.__skip__ = False
         self.__step__ = stepname
-        with open(self.filename, "r") as f:
-            for stepname_done in f:
-                if stepname == stepname_done.rstrip():
-                    self.__skip__ = True
+        self.__inputs__ = None
+        if inputs is not None or columns is not None or params is not None:
+            self.__inputs__ = {'inputs':inputs, 'columns':columns, 'params':params}
+
+        state = self._get(stepname)
+        if state is None:
+            return self
+        fp, done = state
+        if self.__inputs__ is not None:
+            fp_now = fingerprint(**self.__inputs__)
+            if fp is None:
+                # adopt the current inputs for a step done before it declared them
+                with self.conn:
+                    self.conn.execute('UPDATE steps SET fingerprint=? WHERE name=?', (fp_now, stepname))
+            elif fp != fp_now:
+                logger.info('Walker: inputs of %s changed, re-run.' % stepname)
+                return self
+        for dep in (depends or []):
+            state_dep = self._get(dep)
+            if state_dep is not None and state_dep[1] > done:
+                logger.info('Walker: %s was re-run, re-run %s.' % (dep, stepname))
+                return self
+        self.__skip__ = True
         return self
 
     def __enter__(self):
@@ -512,21 +1260,54 @@ class Walker():
             frame.f_trace = self.trace
         else:
             logger.log(20, '>> start >> {}'.format(self.__step__))
+            children_maxrss[0] = 0
+            self.__usage__ = get_usage()
+            lib_log.context['step'] = self.__step__
+            lib_log.event('step_start')
 
 
     def trace(self, frame, event, arg):
         raise Skip()
 
+    def _step_usage(self):
+        """
+        Resources used since the start of the current step
+        """
+        start, end = self.__usage__, get_usage()
+        # the peak RSS of the children cannot be reset: use the commands run by the Scheduler during the step,
+        # or the overall peak if it was reached during the step
+        maxrss = children_maxrss[0]
+        if end['maxrss'] > start['maxrss']: maxrss = max(maxrss, end['maxrss'])
+        written = end['written']-start['written'] if start['written'] is not None else None
+        return {'wall': end['wall']-start['wall'], 'cpu': end['cpu']-start['cpu'], 'maxrss': maxrss, 'written': written}
+
     def __exit__(self, type, value, traceback):
         """
         Catch "Skip" errors, if not skipped, write to file after exited without exceptions.
         """
         if type is None:
-            with open(self.filename, "a") as f:
-                f.write(self.__step__ + '\n')
+            usage = self._step_usage()
+            # fingerprint after the step, so that steps modifying their own inputs are not re-run
+            fp = fingerprint(**self.__inputs__) if self.__inputs__ is not None else None
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO steps (name, fingerprint, done) VALUES (?, ?, ?)',
+                                  (self.__step__, fp, time.time()))
+                self.conn.execute('INSERT INTO history (run, step, start, wall, cpu, maxrss, written) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                  (self.run, self.__step__, self.__usage__['wall'], usage['wall'], usage['cpu'],
+                                   usage['maxrss'], usage['written']))
+            if self.__step__ not in self._listed:
+                with open(self.filename, "a") as f:
+                    f.write(self.__step__ + '\n')
+                self._listed.add(self.__step__)
+            lib_log.event('step_end', **usage)
+            lib_log.context.pop('step', None)
             logger.info('<< done << {}'.format(self.__step__))
+            logger.debug('{}: wall {:.1f} s, cpu {:.1f} s, peak rss {:.2f} GB'.format(self.__step__, usage['wall'],
+                         usage['cpu'], usage['maxrss']/1024.**2))
             return  # No exception
+        lib_log.context.pop('step', None)
         if issubclass(type, Skip):
+            lib_log.event('step_skip', step=self.__step__)
             logger.warning('>> skip << {}'.format(self.__step__))
             return True  # Suppress special SkipWithBlock exception
 
@@ -556,9 +1337,14 @@ class Scheduler():
                 logger.critical('Qsub set to %s and cluster is %s.' % (str(qsub), self.cluster))
                 sys.exit(1)
 
+        # a cpu budget can be imposed by a parent process (e.g. PiLL running several fields at once)
+        max_cpu = int(os.environ.get('LILF_MAX_CPU', 0))
+
         if (maxThreads is None):
             if (self.cluster == "Hamburg"):
                 self.maxThreads = 32
+            elif max_cpu > 0:
+                self.maxThreads = max_cpu
             else:
                 self.maxThreads = multiprocessing.cpu_count()
         else:
@@ -567,6 +1353,8 @@ class Scheduler():
         if (max_processors == None):
             if   (self.cluster == "Hamburg"):
                 self.max_processors = 6
+            elif max_cpu > 0:
+                self.max_processors = max_cpu
             else:
                 self.max_processors = multiprocessing.cpu_count()
         else:
@@ -577,6 +1365,7 @@ class Scheduler():
                      str(self.qsub) + ", max_processors: " + str(self.max_processors) + ").")
 
         self.action_list = []
+        self.job_list    = []  # description of the actions for the events
         self.log_list    = []  # list of 2-tuples of the type: (log filename, type of action)
 
 
@@ -602,7 +1391,7 @@ class Scheduler():
             return "Unknown"
 
 
-    def add(self, cmd = '', log = '', logAppend = True, commandType = '', processors = None):
+    def add(self, cmd = '', log = '', logAppend = True, commandType = '', processors = None, ms = None):
         """
         Add a command to the scheduler list
         cmd:         the command to run
@@ -610,7 +1399,9 @@ class Scheduler():
         logAppend:  if True append, otherwise replace
         commandType: can be a list of known command types as "BBS", "DP3", ...
         processors:  number of processors to use, can be "max" to automatically use max number of processors per node
+        ms:          MS the command works on, only used in the events
         """
+        job = {'type': commandType, 'log': log, 'ms': ms}
 
         if (log != ''):
             log = self.log_dir + '/' + log
@@ -649,6 +1440,7 @@ class Scheduler():
             self.action_list.append([str(processors), '\'' + cmd + '\''])
         else:
             self.action_list.append(cmd)
+        self.job_list.append(job)
 
         if (log != ""):
             self.log_list.append((log, commandType))
@@ -661,12 +1453,12 @@ class Scheduler():
         """
 
         def worker(queue):
-            for cmd in iter(queue.get, None):
+            for cmd, job in iter(queue.get, None):
                 if self.qsub and self.cluster == "Hamburg":
                     cmd = 'salloc --job-name LBApipe --time=24:00:00 --nodes=1 --tasks-per-node='+cmd[0]+\
                             ' /usr/bin/srun --ntasks=1 --nodes=1 --preserve-env \''+cmd[1]+'\''
                 gc.collect()
-                subprocess.call(cmd, shell = True)
+                call_accounted(cmd, **job)
 
         # limit threads only when qsub doesn't do it
         if (maxThreads == None):
@@ -681,10 +1473,10 @@ class Scheduler():
             t.daemon = True
             t.start()
 
-        for action in self.action_list:
+        for action, job in zip(self.action_list, self.job_list):
             if (self.dry):
                 continue # don't schedule if dry run
-            q.put_nowait(action)
+            q.put_nowait((action, job))
         for _ in threads:
             q.put(None) # signal no more commands
         for t in threads:
@@ -697,6 +1489,7 @@ class Scheduler():
 
         # reset list of commands
         self.action_list = []
+        self.job_list    = []
         self.log_list    = []
 
 
@@ -2,28 +2,156 @@
 
 # create a mask using bdsm of an image
 
-def make_mask(image_name, mask_name=None, threshpix=5, atrous_do=False, rmsbox=(100,10), adaptive_thresh=50,
-              write_srl=False, write_gaul=False, write_ds9=False, mask_combine=None):
+def _box_stats(data, weight, box, step=1):
+    """
+    Weighted mean and rms maps computed with a sliding box of "box" pixels.
+    If step > 1 the statistics are computed on a grid decimated by "step" and linearly interpolated back.
+    """
+    import numpy as np
+    from scipy import ndimage
+
+    ys, xs = data.shape
+    step = max(int(step), 1)
+    wd = data*weight
+    wd2 = data*wd
+    if step > 1:
+        # sum pixels in step x step blocks (padding with zero weights)
+        ny, nx = int(np.ceil(ys/step)), int(np.ceil(xs/step))
+        def block_sum(a):
+            p = np.zeros((ny*step, nx*step), dtype=np.float64)
+            p[:ys,:xs] = a
+            return p.reshape(ny, step, nx, step).sum(axis=(1,3))
+        wd, wd2, weight = block_sum(wd), block_sum(wd2), block_sum(weight)
+        size = max(int(round(box/step)), 1)
+    else:
+        size = box
+
+    # sliding window averages (the normalisation cancels in the ratios)
+    sw = ndimage.uniform_filter(weight.astype(np.float64), size=size, mode='constant')
+    swd = ndimage.uniform_filter(wd.astype(np.float64), size=size, mode='constant')
+    swd2 = ndimage.uniform_filter(wd2.astype(np.float64), size=size, mode='constant')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = swd/sw
+        rms = np.sqrt(np.clip(swd2/sw - mean**2, 0, None))
+
+    if step > 1:
+        zoom = (ys/mean.shape[0], xs/mean.shape[1])
+        mean = ndimage.zoom(np.nan_to_num(mean), zoom, order=1, mode='nearest')[:ys,:xs]
+        rms = ndimage.zoom(np.nan_to_num(rms), zoom, order=1, mode='nearest')[:ys,:xs]
+
+    return mean, rms
+
+
+def _rms_map(data, rmsbox, rmsbox_bright, adaptive_thresh, kappa=3., niter=2):
+    """
+    Clipped rms map with a sliding box of (box, step) pixels.
+    Close to bright sources (SNR > adaptive_thresh) the smaller rmsbox_bright is used (as bdsf adaptive_rms_box).
+    """
+    import numpy as np
+    from scipy import ndimage
+
+    good = np.isfinite(data)
+    data = np.where(good, data, 0.)
+
+    def clipped(box):
+        weight = good.astype(np.float64)
+        for i in range(niter+1):
+            mean, rms = _box_stats(data, weight, box[0], box[1])
+            if i < niter:
+                with np.errstate(invalid='ignore'):
+                    weight = (good & (np.abs(data-mean) <= kappa*rms)).astype(np.float64)
+        return mean, rms
+
+    mean, rms = clipped(rmsbox)
+
+    if adaptive_thresh is not None and rmsbox_bright is not None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bright = data/rms > adaptive_thresh
+        if bright.any():
+            mean_b, rms_b = clipped(rmsbox_bright)
+            near_bright = ndimage.maximum_filter(bright, size=rmsbox_bright[0])
+            mean = np.where(near_bright, mean_b, mean)
+            rms = np.where(near_bright, rms_b, rms)
+
+    # fill blanked or empty regions with the median rms
+    bad = ~np.isfinite(rms) | (rms <= 0)
+    if (~bad).any(): rms[bad] = np.median(rms[~bad])
+    mean[~np.isfinite(mean)] = 0.
+
+    return mean, rms
 
+
+def _make_island_mask_numpy(image_name, mask_name, threshpix, threshisl, rmsbox, rmsbox_bright, adaptive_thresh,
+                            mean_map='zero'):
+    """
+    Write an island mask as bdsf with stop_at='isl' would, using only numpy/scipy:
+    islands are pixels above threshisl*rms connected to at least one pixel above threshpix*rms.
+    """
+    import numpy as np
+    from astropy.io import fits as pyfits
+    from scipy import ndimage
+
+    with pyfits.open(image_name) as fits:
+        header = fits[0].header
+        shape = fits[0].data.shape
+        data = np.squeeze(fits[0].data).astype(np.float64)
+
+    mean, rms = _rms_map(data, rmsbox, rmsbox_bright, adaptive_thresh)
+    if mean_map == 'zero': mean = 0.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        snr = np.nan_to_num((data-mean)/rms)
+
+    blobs, number_of_blobs = ndimage.label(snr > threshisl, structure=np.ones((3,3)))
+    if number_of_blobs > 0:
+        peaks = np.asarray(ndimage.maximum(snr, labels=blobs, index=np.arange(1, number_of_blobs+1)))
+        keep = np.concatenate([[False], peaks > threshpix])
+        mask = keep[blobs]
+    else:
+        mask = np.zeros(data.shape, dtype=bool)
+
+    pyfits.writeto(mask_name, mask.astype(np.float32).reshape(shape), header, overwrite=True)
+
+
+def make_mask(image_name, mask_name=None, threshpix=5, atrous_do=False, rmsbox=(100,10), adaptive_thresh=50,
+              write_srl=False, write_gaul=False, write_ds9=False, mask_combine=None, engine='bdsf'):
+    """
+    engine: 'bdsf' (full source detection) or 'numpy' (sliding-box rms and island growing).
+            The numpy engine can only produce the island mask, with atrous_do or catalogues bdsf is used.
+    """
     import sys, os
     import numpy as np
     from astropy.io import fits as pyfits
-    import bdsf
 
     # wavelets are required to fit gaussians
     if atrous_do or write_srl or write_ds9 or write_gaul: stop_at = None
     else: stop_at = 'isl'
 
-    # DO THE SOURCE DETECTION
-    img = bdsf.process_image(image_name, rms_box=rmsbox, frequency=54e6,
-        thresh_isl=float(threshpix*4/5), thresh_pix=float(threshpix), rms_map=True, mean_map='zero', atrous_do=atrous_do, atrous_jmax=4,
-        adaptive_rms_box=True, adaptive_thresh=adaptive_thresh, rms_box_bright=(30,5),
-        flagging_opts=True, flag_maxsize_fwhm=0.5, stop_at=stop_at, quiet=True, debug=False)
+    if engine == 'numpy' and stop_at is not None:
+        print("Numpy engine only makes island masks, using bdsf.")
+        engine = 'bdsf'
 
-    # WRITE THE MASK FITS
     if mask_name == None: mask_name = image_name+'.newmask'
     if os.path.exists(mask_name): os.system('rm -r ' + mask_name)
-    img.export_image(img_type='island_mask', img_format='fits', outfile=mask_name, clobber=True)
+
+    if engine == 'numpy':
+        _make_island_mask_numpy(image_name, mask_name, threshpix=float(threshpix), threshisl=float(threshpix*4/5),
+                                rmsbox=rmsbox, rmsbox_bright=(30,5), adaptive_thresh=adaptive_thresh)
+        img = None
+
+    elif engine == 'bdsf':
+        import bdsf
+
+        # DO THE SOURCE DETECTION
+        img = bdsf.process_image(image_name, rms_box=rmsbox, frequency=54e6,
+            thresh_isl=float(threshpix*4/5), thresh_pix=float(threshpix), rms_map=True, mean_map='zero', atrous_do=atrous_do, atrous_jmax=4,
+            adaptive_rms_box=True, adaptive_thresh=adaptive_thresh, rms_box_bright=(30,5),
+            flagging_opts=True, flag_maxsize_fwhm=0.5, stop_at=stop_at, quiet=True, debug=False)
+
+        # WRITE THE MASK FITS
+        img.export_image(img_type='island_mask', img_format='fits', outfile=mask_name, clobber=True)
+
+    else:
+        raise ValueError('Unknown mask engine: %s' % engine)
 
     # WRITE CATALOGUE
     if write_srl:
@@ -60,8 +188,9 @@ if __name__=='__main__':
     opt.add_option('-g', '--write_gaul', help='Write bbs gaul skymodel (default=False)', action='store_true', default=False)
     opt.add_option('-d', '--write_ds9', help='Write ds9 regions (default=False)', action='store_true', default=False)
     opt.add_option('-c', '--combinemask', help='Mask name of a mask to add to the found one (default=None)', default=None)
+    opt.add_option('-e', '--engine', help='Mask engine: bdsf or numpy (default=bdsf)', default='bdsf')
     (options, args) = opt.parse_args()
     
     rmsbox = (int(options.rmsbox.split(',')[0]),int(options.rmsbox.split(',')[1]))
     make_mask(args[0].rstrip('/'), options.newmask, options.threshpix, options.atrous_do, rmsbox, options.adaptive_thresh,
-              options.write_srl, options.write_gaul, options.write_ds9, options.combinemask)
+              options.write_srl, options.write_gaul, options.write_ds9, options.combinemask, options.engine)
@@ -1,16 +1,27 @@
 from __future__ import print_function
 from builtins import object
-import sshtunnel
 import socket
 import os
 import datetime
+import atexit
+import threading
+import sqlite3
 from time import sleep
 try:
     import MySQLdb as mdb
     import MySQLdb.cursors as mdbcursors
 except ImportError:
-    import pymysql as mdb
-    import pymysql.cursors as mdbcursors
+    try:
+        import pymysql as mdb
+        import pymysql.cursors as mdbcursors
+    except ImportError:
+        mdb = None # only the SQLite backend is available
+
+# Connections (and ssh tunnels) are kept open and reused by the SurveysDB objects of the same process/thread.
+# Environment variables:
+# DDF_PIPELINE_SQLITE=file.sqlite: use a local SQLite database instead of MySQL (see create_sqlite_db())
+# DDF_PIPELINE_DBLOCK=tables: lock whole tables in write mode (old behaviour) instead of row-level transactions
+_pool = {}
 
 
 def get_next():
@@ -67,6 +78,21 @@ def update_status(name,status,time=None,workdir=None,av=None,survey=None):
         idd['archive_version']=av
       sdb.set_field(idd)
 
+def update_statuses(statuses,time=None,workdir=None,survey=None):
+    # update the status of several fields at once
+    # statuses: dict field name -> status
+    with SurveysDB(survey=survey) as sdb:
+      records=sdb.db_get_many('fields',list(statuses.keys()))
+      for id in statuses:
+          if id not in records:
+              raise RuntimeError('Unable to find database entry for field "%s".' % id)
+      for id,idd in records.items():
+          idd['status']=statuses[id]
+          tag_field(sdb,idd,workdir=workdir)
+          if time is not None and idd[time] is None:
+              idd[time]=datetime.datetime.now()
+      sdb.db_set_many('fields',list(records.values()))
+
 def tag_field(sdb,idd,workdir=None):
     # Add location and user tags
     idd['clustername']=get_cluster()
@@ -98,6 +124,76 @@ def get_cluster():
 def use_database():
     return 'DDF_PIPELINE_DATABASE' in os.environ
 
+def close_pool():
+    # close the pooled connections and tunnels of this process
+    for key in list(_pool.keys()):
+        con,tunnel,pid,inuse=_pool.pop(key)
+        if pid!=os.getpid():
+            continue # belongs to the parent of a fork
+        try:
+            con.close()
+        except Exception:
+            pass
+        if tunnel is not None:
+            tunnel.stop()
+
+atexit.register(close_pool)
+
+sqlite_tables={'fields':'id TEXT PRIMARY KEY, status TEXT, priority INTEGER, ra REAL, decl REAL, gal_l REAL, gal_b REAL, '
+                        'lotss_field INTEGER, clustername TEXT, location TEXT, username TEXT, nodename TEXT, '
+                        'start_date TEXT, end_date TEXT, archive_version INTEGER',
+               'observations':'id INTEGER PRIMARY KEY, field TEXT, status TEXT, location TEXT, calibratordata TEXT, '
+                              'nsb INTEGER, integration REAL, priority INTEGER',
+               'field_obs':'obs_id INTEGER, field_id TEXT',
+               'quality':'id TEXT PRIMARY KEY',
+               'transients':'id TEXT PRIMARY KEY',
+               'reprocessing':'id TEXT PRIMARY KEY, priority INTEGER, fields TEXT, selfcal_status TEXT, extract_status TEXT'}
+
+def create_sqlite_db(filename,survey='lba'):
+    # create an empty SQLite stand-in of the surveys database with the columns used by the pipelines
+    tables={'hba':['fields','observations','quality','transients','reprocessing'],
+            'lba':['fields','observations','field_obs']}[survey]
+    con=sqlite3.connect(filename)
+    for table in tables:
+        con.execute('create table if not exists %s (%s)' % (table,sqlite_tables[table]))
+    if 'field_obs' in tables:
+        con.execute('create index if not exists field_obs_field on field_obs (field_id)')
+    con.commit()
+    con.close()
+
+class _SQLiteCursor(object):
+    ''' A sqlite3 cursor that behaves like a MySQL DictCursor (%s placeholders, rows as dicts) '''
+
+    def __init__(self,con):
+        self.cur=con.cursor()
+
+    def execute(self,query,args=None):
+        # like MySQLdb, placeholders are replaced only if args are given
+        if args is None:
+            return self.cur.execute(query)
+        return self.cur.execute(query.replace('%s','?'),tuple(args))
+
+    def executemany(self,query,args):
+        return self.cur.executemany(query.replace('%s','?'),[tuple(a) for a in args])
+
+    def fetchall(self):
+        return [dict(r) for r in self.cur.fetchall()]
+
+    def fetchone(self):
+        r=self.cur.fetchone()
+        return dict(r) if r is not None else None
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.cur.lastrowid
+
+    def close(self):
+        self.cur.close()
+
 class SurveysDB(object):
     ''' Provides low-level and high-level interfaces to the surveys database '''
 
@@ -105,18 +201,113 @@ class SurveysDB(object):
         return self
 
     def __exit__(self, type, value, tb):
-        self.close()
+        # changes are committed only if the block exited without errors
+        self.close(commit=type is None)
 
-    def __init__(self,readonly=False,verbose=False,survey=None):
+    def __init__(self,readonly=False,verbose=False,survey=None,pooled=True):
 
         if survey is None:
             survey='hba' # preserve old default behaviour
+        self.readonly=readonly
+        self.verbose=verbose
+        self.survey=survey
+        if self.survey=='hba':
+            self.database='surveys'
+            self.tables=['fields','observations','quality','transients','reprocessing']
+        elif self.survey=='lba':
+            self.database='lba'
+            self.tables=['fields','observations','field_obs']
+        else:
+            raise NotImplementedError('Survey "%s" not known' % self.survey)
+
+        self.hostname=socket.gethostname()
+        self.sqlite=os.getenv('DDF_PIPELINE_SQLITE')
+        self.locking=os.getenv('DDF_PIPELINE_DBLOCK','rows')
+        self.usetunnel=False
+        self.tunnel=None
+
+        # reuse a connection of this process/thread, unless it is being used (e.g. nested SurveysDB)
+        self.pooled=pooled
+        self.key=(self.sqlite,self.database,threading.get_ident())
+        con=self.get_pooled()
+        if con is not None:
+            self.con,self.tunnel=con
+            self.usetunnel=self.tunnel is not None
+        else:
+            self.connect()
+            if self.pooled:
+                _pool[self.key]=[self.con,self.tunnel,os.getpid(),True]
+
+        if self.sqlite:
+            self.cur=_SQLiteCursor(self.con)
+        else:
+            self.cur=self.con.cursor()
+        if self.readonly:
+            pass
+            #can't use this feature on lofar's version of MariaDB
+            #self.cur.execute('set session transaction read only')
+        elif self.sqlite:
+            self.cur.execute('begin immediate')
+        elif self.locking=='tables':
+            command='lock table '
+            for table in self.tables:
+                command+=table+' write, '
+            command=command[:-2]
+            self.cur.execute(command)
+        else:
+            # rows are locked by the statements of the transaction (see db_get)
+            self.cur.execute('start transaction')
+        self.closed=False
+
+    def get_pooled(self):
+        # return (connection, tunnel) from the pool if available and alive, otherwise None
+        if not self.pooled or self.key not in _pool:
+            return None
+        con,tunnel,pid,inuse=_pool[self.key]
+        if pid!=os.getpid():
+            # inherited through a fork, the connection cannot be shared with the parent
+            del _pool[self.key]
+            return None
+        if inuse:
+            self.pooled=False
+            return None
+        try:
+            if tunnel is not None and not tunnel.is_active:
+                raise RuntimeError('tunnel down')
+            if not self.sqlite:
+                con.ping()
+        except Exception:
+            if self.verbose:
+                print('Pooled connection lost, reconnecting')
+            del _pool[self.key]
+            try:
+                con.close()
+            except Exception:
+                pass
+            if tunnel is not None:
+                tunnel.stop()
+            return None
+        _pool[self.key][3]=True
+        return con,tunnel
+
+    def connect(self):
+        # open a new connection (and tunnel if needed)
+        if self.sqlite:
+            if self.verbose:
+                print('Using SQLite database',self.sqlite)
+            self.con=sqlite3.connect(self.sqlite,timeout=600,isolation_level=None,check_same_thread=False)
+            self.con.row_factory=sqlite3.Row
+            self.con.execute('PRAGMA journal_mode=WAL')
+            return
+
+        if mdb is None:
+            raise RuntimeError('MySQLdb or pymysql is needed to connect to the database')
         # get the config file -- this must exist
         home=os.getenv("HOME")
         mysql_host=os.getenv('DDF_PIPELINE_MYSQLHOST')
         if not mysql_host:
             mysql_host='lofar-server.data'
-        if verbose:
+        if self.verbose:
             print('MySQL host is',mysql_host)
         cfg=[l.rstrip() for l in open(home+'/.surveys').readlines()]
         self.password=cfg[0]
@@ -130,34 +321,21 @@ class SurveysDB(object):
         except:
             self.ssh_key="id_rsa"
 
-        self.readonly=readonly
-        self.verbose=verbose
-        self.survey=survey
-        if self.survey=='hba':
-            self.database='surveys'
-            self.tables=['fields','observations','quality','transients','reprocessing']
-        elif self.survey=='lba':
-            self.database='lba'
-            self.tables=['fields','observations','field_obs']
-        else:
-            raise NotImplementedError('Survey "%s" not known' % self.survey)
-        
         # set up an ssh tunnel if not running locally
-        self.usetunnel=False
-        self.hostname=socket.gethostname()
         if self.hostname=='lofar-server':
-            if verbose:
+            if self.verbose:
                 print('Using direct connection to localhost')
             self.con=mdb.connect('127.0.0.1', 'survey_user', self.password, self.database, cursorclass=mdbcursors.DictCursor)
         else:
             try:
                 dummy=socket.gethostbyname(mysql_host)
             except socket.gaierror:
-                if verbose:
+                if self.verbose:
                     print('Cannot find host',mysql_host,'will use tunnel')
                 self.usetunnel=True
 
             if self.usetunnel:
+                import sshtunnel
                 self.tunnel=sshtunnel.SSHTunnelForwarder('lofar.herts.ac.uk',
                                                          ssh_username=self.ssh_user,
                                                          ssh_pkey=home+'/.ssh/%s'%self.ssh_key,
@@ -180,33 +358,29 @@ class SurveysDB(object):
                         sleep(20)
                 if not connected:
                     raise RuntimeError("Cannot connect to database server")
-        self.cur = self.con.cursor()
-        if self.readonly:
-            pass
-            #can't use this feature on lofar's version of MariaDB
-            #self.cur.execute('set session transaction read only')
-        else:
-            command='lock table '
-            for table in self.tables:
-                command+=table+' write, '
-            command=command[:-2]
-            self.cur.execute(command)
-        self.closed=False
 
     def execute(self,*args):
         if self.verbose:
             print(args)
         self.cur.execute(*args)
 
-    def close(self):
+    def close(self,commit=True):
         # if 'closed' doesn't exist, then we are most likely being called through __del__ due to a failure in the init call. So skip the rest.
         if hasattr(self,'closed'):
             if not self.closed:
-                if not self.readonly:
-                    self.cur.execute('unlock tables')
-                self.con.close()
-                if self.usetunnel:
-                    self.tunnel.stop()
+                if not self.readonly and not self.sqlite and self.locking=='tables':
+                    self.cur.execute('unlock tables') # also commits
+                elif commit:
+                    self.con.commit()
+                else:
+                    self.con.rollback()
+                self.cur.close()
+                if self.pooled and self.key in _pool:
+                    _pool[self.key][3]=False # back to the pool
+                else:
+                    self.con.close()
+                    if self.usetunnel:
+                        self.tunnel.stop()
                 self.closed=True # prevent del from trying again
     
     def __del__(self):
@@ -219,24 +393,47 @@ class SurveysDB(object):
                 raise RuntimeError('Unknown table %s requested' % table)
         return table
         
+    def for_update(self):
+        # in a write transaction lock the rows that are read, so that they can be safely updated
+        if self.readonly or self.sqlite or self.locking=='tables':
+            return ''
+        return ' for update'
+
     def db_get(self,table,id):
         table=self.check_table(table)
-        self.execute('select * from '+table+' where id=%s',(id,))
+        self.execute('select * from '+table+' where id=%s'+self.for_update(),(id,))
         result=self.cur.fetchall()
         if len(result)==0:
             return None
         else:
             return result[0]
 
+    def db_get_many(self,table,ids):
+        # return a dict id -> record for the ids found
+        table=self.check_table(table)
+        if len(ids)==0:
+            return {}
+        self.execute('select * from '+table+' where id in ('+','.join(['%s']*len(ids))+')'+self.for_update(),tuple(ids))
+        return dict([(r['id'],r) for r in self.cur.fetchall()])
+
     def db_set(self,table,record):
+        self.db_set_many(table,[record])
+
+    def db_set_many(self,table,records):
+        # update several records, one statement per set of updated columns
         if self.readonly: raise RuntimeError('Write requested in read-only mode')
         table=self.check_table(table)
-        id=record['id'];
-        for k in record:
-            if k=='id':
+        batches={}
+        for record in records:
+            keys=tuple(sorted([k for k in record if k!='id' and record[k] is not None]))
+            if len(keys)==0:
                 continue
-            if record[k] is not None:
-                self.execute('update '+table+' set '+k+'=%s where id=%s',(record[k],id))
+            batches.setdefault(keys,[]).append(tuple([record[k] for k in keys])+(record['id'],))
+        for keys,values in batches.items():
+            query='update '+table+' set '+', '.join([k+'=%s' for k in keys])+' where id=%s'
+            if self.verbose:
+                print(query,values)
+            self.cur.executemany(query,values)
 
     def db_create(self,table,id):
         table=self.check_table(table)
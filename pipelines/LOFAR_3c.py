@@ -18,6 +18,7 @@ parset = lib_util.getParset()
 parset_dir = parset.get('LOFAR_3c', 'parset_dir')
 skydb_demix = parset.get('LOFAR_demix','demix_model')
 bl2flag = parset.get('flag', 'stations')
+mask_engine = parset.get('LiLF','mask_engine')
 
 target = os.getcwd().split('/')[-1]
 data_dir = '/home/fdg/lofar5/3Csurvey/%s' % target
@@ -238,7 +239,7 @@ for c in range(100):
 
             # makemask
             im = lib_img.Image(imagename + '-MFS-image.fits', userReg=region)
-            im.makeMask(threshpix=5, rmsbox=(50, 5))
+            im.makeMask(threshpix=5, rmsbox=(50, 5), engine=mask_engine)
             maskfits = imagename + '-mask.fits'
 
             logger.info('Cleaning wide 2...')
@@ -261,7 +262,7 @@ for c in range(100):
         imagename = 'img/img-wideM'
         full_image = lib_img.Image(imagename+'-MFS-image.fits', userReg=region)
         mask_ddcal = full_image.imagename.replace('.fits', '_mask-ddcal.fits')  # this is used to find calibrators
-        full_image.makeMask(threshpix=5, atrous_do=False, maskname=mask_ddcal, write_srl=True, write_ds9=True)
+        full_image.makeMask(threshpix=5, atrous_do=False, maskname=mask_ddcal, write_srl=True, write_ds9=True, engine=mask_engine)
         cal = astrotab.read(mask_ddcal.replace('fits', 'cat.fits'), format='fits')
         cal = cal[np.where(cal['Total_flux'] > 3)]
         cal.sort('Total_flux')
@@ -421,7 +422,7 @@ for c in range(100):
 
         # check if hand-made mask is available
         im = lib_img.Image(imagename+'-MFS-image.fits')
-        im.makeMask( threshpix=5, rmsbox=(50,5), atrous_do=True )
+        im.makeMask( threshpix=5, rmsbox=(50,5), atrous_do=True, engine=mask_engine)
         maskfits = imagename+'-mask.fits'
         if region is not None:
             lib_img.blank_image_reg(maskfits, beam02Reg, blankval = 0.)
@@ -438,7 +439,7 @@ for c in range(100):
     ### DONE
 
     im = lib_img.Image(imagename+'-MFS-image.fits')
-    im.makeMask( threshpix=5, rmsbox=(500,30), atrous_do=False )
+    im.makeMask( threshpix=5, rmsbox=(500,30), atrous_do=False, engine=mask_engine)
     rms_noise = im.getNoise(); mm_ratio = im.getMaxMinRatio()
     logger.info('RMS noise: %f - MM ratio: %f' % (rms_noise, mm_ratio))
     if doamp and rms_noise > 0.99*rms_noise_pre and mm_ratio < 1.01*mm_ratio_pre and c > 6:
@@ -93,7 +93,8 @@ with w.if_todo('cal_pa'):
             log='$nameMS_solPA.log', commandType="DP3")
 
     lib_util.run_losoto(s, 'pa', [ms+'/pa.h5' for ms in MSs.getListStr()],
-            [parset_dir+'/losoto-plot-ph.parset', parset_dir+'/losoto-plot-rot.parset', parset_dir+'/losoto-plot-amp.parset', parset_dir+'/losoto-pa.parset'])
+            [parset_dir+'/losoto-plot-ph.parset', parset_dir+'/losoto-plot-rot.parset', parset_dir+'/losoto-plot-amp.parset', parset_dir+'/losoto-pa.parset'],
+            concurrent=True)
 
     # Pol align correction DATA -> CORRECTED_DATA
     logger.info('Polalign correction...')
@@ -164,7 +165,7 @@ with w.if_todo('cal_bp'):
 
     lib_util.run_losoto(s, 'amp', [ms+'/amp.h5' for ms in MSs.getListStr()],
             [parset_dir + '/losoto-flag.parset', parset_dir+'/losoto-plot-amp.parset',
-             parset_dir+'/losoto-plot-ph.parset', parset_dir+'/losoto-bp.parset'])
+             parset_dir+'/losoto-plot-ph.parset', parset_dir+'/losoto-bp.parset'], concurrent=True)
 
 ### DONE
 
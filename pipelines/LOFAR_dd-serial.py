@@ -28,6 +28,8 @@ maxIter = parset.getint('LOFAR_dd-serial','maxIter')
 min_cal_flux60 = parset.getfloat('LOFAR_dd-serial','minCalFlux60')
 removeExtendedCutoff = parset.getfloat('LOFAR_dd-serial','removeExtendedCutoff')
 target_dir = parset.get('LOFAR_dd-serial','target_dir')
+noise_method = parset.get('LOFAR_dd-serial','noise_method')
+mask_engine = parset.get('LiLF','mask_engine')
 
 def clean(p, MSs, res='normal', size=[1,1], empty=False, imagereg=None):
     """
@@ -88,7 +90,7 @@ def clean(p, MSs, res='normal', size=[1,1], empty=False, imagereg=None):
         # make mask
         im = lib_img.Image(imagename+'-MFS-image.fits', userReg=userReg)
         try:
-            im.makeMask(threshpix=10, rmsbox=(70, 5))
+            im.makeMask(threshpix=10, rmsbox=(70, 5), engine=mask_engine)
         except:
             logger.warning('Fail to create mask for %s.' % imagename+'-MFS-image.fits')
             return
@@ -177,7 +179,7 @@ for cmaj in range(maxIter):
         directions = []
 
         # making skymodel from image
-        full_image.makeMask(threshpix=5, atrous_do=False, maskname=mask_ddcal, write_srl=True, write_ds9=True)
+        full_image.makeMask(threshpix=5, atrous_do=False, maskname=mask_ddcal, write_srl=True, write_ds9=True, engine=mask_engine)
         
         # locating DD-calibrators
         cal = astrotab.read(mask_ddcal.replace('fits','cat.fits'), format='fits')
@@ -432,7 +434,7 @@ for cmaj in range(maxIter):
         
         # get initial noise and set iterators for timeint solutions
         image = lib_img.Image('img/ddcalM-%s-pre-MFS-image.fits' % logstring, userReg=userReg)
-        rms_noise_pre = image.getNoise(); rms_noise_init = rms_noise_pre
+        rms_noise_pre = image.getNoise(method=noise_method); rms_noise_init = rms_noise_pre
         mm_ratio_pre = image.getMaxMinRatio(); mm_ratio_init = mm_ratio_pre
         doamp = False
         # usually there are 3600/32=112 or 3600/16=225 or 3600/8=450 timesteps and \
@@ -546,7 +548,7 @@ for cmaj in range(maxIter):
                 break
 
             # get noise, if larger than prev cycle: break
-            rms_noise = image.getNoise()
+            rms_noise = image.getNoise(method=noise_method)
             mm_ratio = image.getMaxMinRatio()
             d.add_rms_mm(rms_noise, mm_ratio) # track values for debug
             logger.info('RMS noise (cdd:%02i): %f' % (cdd,rms_noise))
@@ -20,6 +20,7 @@ parset_dir = parset.get('LOFAR_ddfacet','parset_dir')
 maxniter = parset.getint('LOFAR_ddfacet','maxniter')
 calFlux = parset.getfloat('LOFAR_ddfacet','calFlux')
 userReg = parset.get('model','userReg')
+mask_engine = parset.get('LiLF','mask_engine')
 uvrange=[0.03,1e6]
 image_robust=-0.15
 ncluster = 5
@@ -80,7 +81,7 @@ sys.exit()
 # make mask
 logger.info('Making mask...')
 maskname = rootimg1+'.app.mask.fits'
-make_mask(rootimg1+'.app.restored.fits', mask_name=maskname, threshisl=5, atrous_do=False, rmsbox=(50,20))
+make_mask(rootimg1+'.app.restored.fits', mask_name=maskname, threshisl=5, atrous_do=False, rmsbox=(50,20), engine=mask_engine)
 
 
 # DIE cleaning (continue)
@@ -96,7 +97,7 @@ lib_ddfacet.ddf_image(s, 'ddf2.log', MSs, rootimg2, cleanmode='SSD', \
 # make source catalogue
 logger.info('Making source catalogue...')
 maskname = rootimg2+'.app.mask.fits'
-make_mask(rootimg2+'.app.restored.fits', mask_name=maskname, threshisl=5, atrous_do=False, rmsbox=(30,10), write_srl=True)
+make_mask(rootimg2+'.app.restored.fits', mask_name=maskname, threshisl=5, atrous_do=False, rmsbox=(30,10), write_srl=True, engine=mask_engine)
 
 logger.info('Grouping...')
 s.add("ClusterCat.py --SourceCat %s.app.restored.pybdsm.srl.fits --DoPlot 0 --NGen 100 --NCluster %i --NCPU %i" % (rootimg2,ncluster,64), \
@@ -156,7 +157,7 @@ for c in range(maxniter):
     # make source catalogue
     logger.info('Making source catalogue...')
     maskname = rootimg+'.app.mask.fits'
-    make_mask(rootimg+'.app.restored.fits', mask_name=maskname, threshisl=5, atrous_do=False, rmsbox=(30,10), write_srl=True)
+    make_mask(rootimg+'.app.restored.fits', mask_name=maskname, threshisl=5, atrous_do=False, rmsbox=(30,10), write_srl=True, engine=mask_engine)
 
     rootimg_old = rootimg
 
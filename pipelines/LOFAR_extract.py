@@ -158,6 +158,7 @@ if phSolMode not in ['tecandphase', 'phase']:
     logger.error('phSolMode {} not supported. Choose tecandphase, phase.')
     sys.exit()
 userReg = parset.get('model','userReg')
+mask_engine = parset.get('LiLF','mask_engine')
 
 ##########
 
@@ -240,7 +241,7 @@ for p in close_pointings:
     dde_h5parm = 'extract/init/'+p+'/interp.h5'
     # make mask for subtraction
     mask_ddcal = wideDD_image.imagename.replace('.fits', '_mask-ddcal.fits')  # this is used to find calibrators
-    wideDD_image.makeMask(threshpix=5, atrous_do=True, maskname=mask_ddcal, write_srl=True, write_ds9=True)
+    wideDD_image.makeMask(threshpix=5, atrous_do=True, maskname=mask_ddcal, write_srl=True, write_ds9=True, engine=mask_engine)
 
     with w.if_todo('predict_rest_'+p):
         # DDF predict+corrupt in MODEL_DATA of everything BUT the calibrator
@@ -21,6 +21,7 @@ parset_dir = parset.get('LOFAR_self','parset_dir')
 sourcedb = parset.get('model','sourcedb')
 apparent = parset.getboolean('model','apparent')
 userReg = parset.get('model','userReg')
+mask_engine = parset.get('LiLF','mask_engine')
 
 #############################################################################
 # Clear
@@ -257,7 +258,7 @@ for c in range(2):
                                  join_channels='', fit_spectral_pol=cc_fit_order, channels_out=MSs.getChout(4.e6),
                                  deconvolution_channels=cc_fit_order)
             im = lib_img.Image(imagename + '-MFS-image.fits', userReg=userReg)
-            im.makeMask(threshpix=5, atrous_do=True)
+            im.makeMask(threshpix=5, atrous_do=True, engine=mask_engine)
 
             kwargs = {'do_predict':True, 'reuse_dirty':imagename, 'reuse_psf':imagename}
         else: 
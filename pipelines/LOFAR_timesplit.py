@@ -10,7 +10,7 @@ from astropy.time import Time
 import casacore.tables as pt
 
 ########################################################
-from LiLF import lib_ms, lib_util, lib_log
+from LiLF import lib_ms, lib_util, lib_log, lib_cache
 logger_obj = lib_log.Logger('pipeline-timesplit.logger')
 logger = lib_log.logger
 s = lib_util.Scheduler(log_dir = logger_obj.log_dir, dry = False)
@@ -23,6 +23,8 @@ data_dir = parset.get('LOFAR_timesplit','data_dir')
 cal_dir = parset.get('LOFAR_timesplit','cal_dir')
 ngroups = parset.getint('LOFAR_timesplit','ngroups')
 initc = parset.getint('LOFAR_timesplit','initc') # initial tc num (useful for multiple observation of same target)
+max_io = parset.getint('LOFAR_timesplit','max_io') # time chunks written at the same time
+direct_timesplit = parset.getboolean('LOFAR_timesplit','direct_timesplit') # concatenate each time chunk directly from the SBs
 bl2flag = parset.get('flag','stations')
 
 #################################################
@@ -47,15 +49,23 @@ MSs = lib_ms.AllMSs( glob.glob('*MS'), s )
 
 ##################################################
 # Find solutions to apply
+cache = lib_cache.from_parset(parset)
 if cal_dir == '':
-    obsid = MSs.getListObj()[0].getObsID()
-    # try standard location
-    cal_dir = glob.glob('../id%i_-_*3[c|C]196' % obsid)+glob.glob('../id%i_-_*3[c|C]295' % obsid)+glob.glob('../id%i_-_*3[c|C]380' % obsid)
-    if len(cal_dir) > 0:
-        cal_dir = cal_dir[0]
+    obsid, antennaset, freqsetup = lib_cache.ms_setup(MSs.getListStr()[0])
+    # try the solution cache first, then the standard location
+    key = cache.find(obsid, antennaset, freqsetup) if cache is not None else None
+    if key is not None and cache.retrieve(key, 'cal-cache'):
+        cal_dir = 'cal-cache'
     else:
-        logger.error('Cannot find solutions.')
-        sys.exit()
+        cal_dir = glob.glob('../id%i_-_*3[c|C]196' % obsid)+glob.glob('../id%i_-_*3[c|C]295' % obsid)+glob.glob('../id%i_-_*3[c|C]380' % obsid)
+        if len(cal_dir) > 0:
+            cal_dir = cal_dir[0]
+            if cache is not None and all([os.path.exists(cal_dir+'/'+f) for f in lib_cache.cal_files]):
+                cache.publish_local(lib_cache.solution_key(obsid, lib_cache.calibrator_name(cal_dir), antennaset, freqsetup),
+                                    [cal_dir+'/'+f for f in lib_cache.cal_files])
+        else:
+            logger.error('Cannot find solutions.')
+            sys.exit()
 else:
     cal_dir = '../'+cal_dir
 
@@ -94,7 +104,14 @@ with w.if_todo('apply'):
 
 ###################################################################################################
 # Create groups
+def mjds2mvtime(time):
+    """
+    MJD in seconds -> casacore MVTime string as used by DP3 msin.starttime/endtime
+    """
+    return Time(time/86400., format='mjd', scale='utc').datetime.strftime('%Y/%m/%d/%H:%M:%S.%f')
+
 groupnames = []
+tc = initc
 logger.info('Concatenating in frequency...')
 for i, msg in enumerate(np.array_split(sorted(glob.glob('*MS')), ngroups)):
    if ngroups == 1:
@@ -118,10 +135,32 @@ for i, msg in enumerate(np.array_split(sorted(glob.glob('*MS')), ngroups)):
        for j in range(num_init, num_fin+1):
            msg.append(prefix+'SB%03i.MS' % j)
 
-       # prepare concatenated mss - SB.MS:CORRECTED_DATA -> group#.MS:DATA (cal corr data, beam corrected)
-       s.add('DP3 '+parset_dir+'/DP3-concat.parset msin="['+','.join(msg)+']"  msout='+groupname+'/'+groupname+'.MS', \
-                   log=groupname+'_DP3_concat.log', commandType='DP3')
-       s.run(check=True)
+       if not direct_timesplit:
+           # prepare concatenated mss - SB.MS:CORRECTED_DATA -> group#.MS:DATA (cal corr data, beam corrected)
+           s.add('DP3 '+parset_dir+'/DP3-concat.parset msin="['+','.join(msg)+']"  msout='+groupname+'/'+groupname+'.MS', \
+                       log=groupname+'_DP3_concat.log', commandType='DP3')
+           s.run(check=True)
+       else:
+           # concatenate each time chunk directly - SB.MS:CORRECTED_DATA -> group#/TC#.MS:DATA (cal corr data, beam corrected)
+           # the time windows are taken from one SB and cut halfway between chunks
+           MS = lib_ms.MS(ms_name_init)
+           starttime, endtime = MS.getTimeRange()
+           hours = (endtime-starttime)/3600.
+           logger.debug(ms_name_init+' has length of '+str(hours)+' h.')
+           chunks = MS.getTimeChunks(max(1, round(hours)))
+           for c, (startrow, nrow, timestart, timeend) in enumerate(chunks):
+               logger.info('%02i - Concatenating timerange %f %f' % (tc, timestart, timeend))
+               cmd = 'DP3 '+parset_dir+'/DP3-concat.parset msin="['+','.join(msg)+']" msout='+groupname+'/TC%02i.MS' % tc
+               if c > 0:
+                   cmd += ' msin.starttime='+mjds2mvtime((chunks[c-1][3]+timestart)/2.)
+               if c < len(chunks)-1:
+                   cmd += ' msin.endtime='+mjds2mvtime((timeend+chunks[c+1][2])/2.)
+               s.add(cmd, log=groupname+'_TC%02i_DP3_concat.log' % tc, commandType='DP3')
+               tc += 1
+           s.run(check=True)
+
+   elif direct_timesplit:
+       tc += len(glob.glob(groupname+'/TC*.MS')) # keep numbering the chunks of the next groups
 
 MSs = lib_ms.AllMSs( glob.glob('mss*/*MS'), s )
 
@@ -149,25 +188,21 @@ with w.if_todo('flag'):
 with w.if_todo('timesplit'):
 
     logger.info('Splitting in time...')
-    tc = initc
     for groupname in groupnames:
         ms = groupname+'/'+groupname+'.MS'
         if not os.path.exists(ms): continue
-        t = pt.table(ms, ack=False)
-        starttime = t[0]['TIME']
-        endtime   = t[t.nrows()-1]['TIME']
+        MS = lib_ms.MS(ms)
+        starttime, endtime = MS.getTimeRange()
         hours = (endtime-starttime)/3600.
         logger.debug(ms+' has length of '+str(hours)+' h.')
 
-        for timerange in np.array_split(sorted(set(t.getcol('TIME'))), round(hours)):
-            logger.info('%02i - Splitting timerange %f %f' % (tc, timerange[0], timerange[-1]))
-            t1 = t.query('TIME >= ' + str(timerange[0]) + ' && TIME <= ' + str(timerange[-1]), sortlist='TIME,ANTENNA1,ANTENNA2')
-            splitms = groupname+'/TC%02i.MS' % tc
-            lib_util.check_rm(splitms)
-            t1.copy(splitms, True)
-            t1.close()
+        # contiguous row blocks of the time-sorted MS, copied concurrently
+        chunks = []
+        for startrow, nrow, timestart, timeend in MS.getTimeChunks(max(1, round(hours))):
+            logger.info('%02i - Splitting timerange %f %f' % (tc, timestart, timeend))
+            chunks.append((groupname+'/TC%02i.MS' % tc, startrow, nrow))
             tc += 1
-        t.close()
+        MS.splitRows(chunks, max_io=max_io)
 
         lib_util.check_rm(ms) # remove not-timesplitted file
 ### DONE
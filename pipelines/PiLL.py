@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
-import os, sys, glob, getpass, socket, re
+import os, sys, glob, getpass, socket, re, time, shutil, multiprocessing
 from LiLF.surveys_db import SurveysDB
-from LiLF import lib_ms, lib_img, lib_util, lib_log
+from LiLF import lib_ms, lib_img, lib_util, lib_log, lib_cache
 logger_obj = lib_log.Logger('PiLL.logger')
 logger = lib_log.logger
 s = lib_util.Scheduler(log_dir = logger_obj.log_dir, dry = False)
@@ -22,6 +22,17 @@ target = parset.get('PiLL','target')
 obsid = parset.get('PiLL','obsid')
 download_file = parset.get('PiLL','download_file')
 if download_file != '': download_file = os.path.abspath(download_file)
+concurrent = parset.getboolean('PiLL','concurrent')
+max_cpu = parset.getint('PiLL','max_cpu')
+if max_cpu == 0: max_cpu = multiprocessing.cpu_count()
+max_mem = parset.getint('PiLL','max_mem')
+if max_mem == 0: max_mem = int(os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/1024**3)
+cpu_per_pipeline = parset.getint('PiLL','cpu_per_pipeline')
+if cpu_per_pipeline == 0: cpu_per_pipeline = max(1, max_cpu//4)
+mem_per_pipeline = parset.getint('PiLL','mem_per_pipeline')
+if mem_per_pipeline == 0: mem_per_pipeline = max_mem//4
+min_disk = parset.getint('PiLL','min_disk')
+cache = lib_cache.from_parset(parset) # calibrator solutions cache
 
 def calibrator_tables_available(obsid):
     """
@@ -53,8 +64,9 @@ def local_calibrator_dirs(searchdir='', obsid=None):
 
 
 def update_status_db(field, status):
+    # the connection to the db is kept open between calls (see surveys_db)
     with SurveysDB(survey='lba',readonly=False) as sdb:
-        r = sdb.execute('UPDATE fields SET status="%s" WHERE id="%s"' % (status,field.upper()))
+        r = sdb.execute('UPDATE fields SET status=%s WHERE id=%s', (status,field.upper()))
 
 
 def check_done(logfile):
@@ -66,7 +78,7 @@ def check_done(logfile):
     if not "Done" in last_line:
         if survey: update_status_db(target, 'Error') 
         logger.error('Something went wrong in the last pipeline call.')
-        sys.exit()
+        sys.exit(1)
 
 def fix_dir_format(working_dir):
     # fix for c##-o##_p##### format
@@ -75,96 +87,33 @@ def fix_dir_format(working_dir):
         if pattern.match(dir):
             os.system('mv '+dir+' '+dir.split('_-_')[0]+'_-_'+dir.split('_')[-1])
 
-####################################################################################
-
-# query the database for data to process
-survey = False
-if download_file == '' and project == '' and target == '' and obsid == '':
-    survey = True
-    project = survey_projects
-    if os.path.exists('target.txt'):
-        with open('target.txt', 'r') as file:
-                target = file.read().replace('\n', '')
-    else:
-        logger.info('### Quering database...')
-        with SurveysDB(survey='lba',readonly=True) as sdb:
-            sdb.execute('SELECT * FROM fields WHERE status="Observed" order by priority desc')
-            r = sdb.cur.fetchall()
-            target = r[0]['id']
-        # save target name
-        with open("target.txt", "w") as file:
-                print(target, file=file)
-
-    with SurveysDB(survey='lba',readonly=True) as sdb:
-        sdb.execute('SELECT * FROM field_obs WHERE field_id="%s"' % target)
-        r = sdb.cur.fetchall()
-        obsid = ','.join([str(x['obs_id']) for x in r])
-
-    logger.info("### Working on target: %s (obsid: %s)" % (target, obsid))
-    # add other info, like cluster, node, user...
-    username = getpass.getuser()
-    clustername = s.cluster
-    nodename = socket.gethostname()
-    with SurveysDB(survey='lba',readonly=False) as sdb:
-        r = sdb.execute('UPDATE fields SET username="%s" WHERE id="%s"' % (username, target))
-        r = sdb.execute('UPDATE fields SET clustername="%s" WHERE id="%s"' % (clustername, target))
-        r = sdb.execute('UPDATE fields SET nodename="%s" WHERE id="%s"' % (nodename, target))
-
-    update_status_db(target, 'Download') 
-
-#######
-# setup
-if not os.path.exists(working_dir):
-    os.makedirs(working_dir)
-if os.path.exists('lilf.config') and os.getcwd() != working_dir: 
-    os.system('cp lilf.config '+working_dir)
-
-os.chdir(working_dir)
-if not os.path.exists(working_dir+'/download'):
-    os.makedirs(working_dir+'/download')
-
-if download_file != '':
-    os.system('cp %s download/html.txt' % download_file)
-
-##########
-# data download
-# here the pipeline downloads only the target, not the calibrator
-with w.if_todo('download'):
-    logger.info('### Starting download... #####################################')
-    os.chdir(working_dir+'/download')
-
-    if download_file == '':
-        cmd = LiLF_dir+'/scripts/LOFAR_stager.py --projects %s --nocal' % project
-        if target != '':
-            cmd += ' --target %s' % target
-        if obsid != '':
-            cmd += ' --obsID %s' % obsid
-        logger.debug("Exec: %s" % cmd)
-        os.system(cmd)
-
-    # TODO: how to be sure all MS were downloaded?
-    os.system(LiLF_dir+'/pipelines/LOFAR_preprocess.py')
-    check_done('pipeline-preprocess.logger')
-    os.system('mv mss/* ../')
-### DONE
-
-os.chdir(working_dir)
-fix_dir_format(working_dir)
-if survey: update_status_db(target, 'Calibrator')
-calibrators = local_calibrator_dirs()
-targets = [t for t in glob.glob('id*') if t not in calibrators]
-logger.debug('CALIBRATORS: %s' % ( ','.join(calibrators) ) )
-logger.debug('TARGET: %s' % (','.join(targets) ) )
-
-for target in targets:
-    
-    ##########
-    # calibrator
-    # here the pipeline checks if the calibrator is available online, otherwise it downloads it
-    # then it also runs the calibrator pipeline
+def run_calibrator(target):
+    """
+    Make the calibrator solutions for the observation of a target.
+    Here the pipeline checks if the calibrator is available online, otherwise it downloads it
+    then it also runs the calibrator pipeline
+    """
     obsid = int(target.split('_-_')[0][2:])
     with w.if_todo('cal_id%i' % obsid):
-        if not survey or redo_cal or not calibrator_tables_available(obsid):
+        # look for solutions already made (here or on another node) for the same observation setup
+        key = None
+        if cache is not None and not redo_cal:
+            target_mss = glob.glob(working_dir+'/'+target+'/*MS') + glob.glob(working_dir+'/'+target+'/data-bkp/*MS')
+            if len(target_mss) > 0:
+                key = cache.find(*lib_cache.ms_setup(target_mss[0]))
+
+        if key is not None:
+            cal_dir = working_dir+'/id%i_-_%s' % (obsid, key.split('_')[1])
+            if not cache.retrieve(key, cal_dir):
+                logger.warning('%s: cannot retrieve %s from cache, running the calibrator.' % (target, key))
+                # an empty dir would be taken for the calibrator data
+                if os.path.isdir(cal_dir) and len(os.listdir(cal_dir)) == 0: os.rmdir(cal_dir)
+                key = None
+
+        if key is not None:
+            logger.info('### %s: Calibrator solutions from cache (%s) #####################################' % (target, key))
+
+        elif not survey or redo_cal or not calibrator_tables_available(obsid):
             logger.info('### %s: Starting calibrator... #####################################' % target)
             # if calibrator not downaloaded, do it
             cal_dir = local_calibrator_dirs(working_dir, obsid)
@@ -185,6 +134,11 @@ for target in targets:
             os.system(LiLF_dir+'/pipelines/LOFAR_cal.py')
             check_done('pipeline-cal.logger')
 
+            if cache is not None:
+                _, antennaset, freqsetup = lib_cache.ms_setup(glob.glob('data-bkp/*MS')[0])
+                cache.publish(lib_cache.solution_key(obsid, lib_cache.calibrator_name(os.getcwd()), antennaset, freqsetup),
+                              lib_cache.cal_files)
+
             if survey: # only backup solutions if survey
                 # copy solutions in the repository
                 cal_dir = os.path.basename(local_calibrator_dirs(working_dir, obsid)[0])
@@ -213,9 +167,11 @@ for target in targets:
             os.system('scp -q %s:%s/cal-*h5 %s' % (location,calibratordata,cal_dir))
     ### DONE
 
-    ##########
-    # timesplit
-    # each target of each observation is then timesplit
+
+def run_timesplit(target):
+    """
+    Each target of each observation is timesplit
+    """
     with w.if_todo('timesplit_%s' % target):
         logger.info('### %s: Starting timesplit... #####################################' % target)
         os.chdir(working_dir+'/'+target)
@@ -227,10 +183,11 @@ for target in targets:
         check_done('pipeline-timesplit.logger')
     ### DONE
 
-# group targets with same name, assuming they are different pointings of the same dir
-grouped_targets = set([t.split('_-_',1)[1] for t in targets])
 
-for grouped_target in grouped_targets:
+def run_grouped_target(grouped_target):
+    """
+    Selfcal and DD-cal of the timesplit targets with the same name
+    """
     if not os.path.exists(working_dir+'/'+grouped_target):
         os.makedirs(working_dir+'/'+grouped_target)
     os.chdir(working_dir+'/'+grouped_target)
@@ -268,7 +225,242 @@ for grouped_target in grouped_targets:
             os.system('scp -q ddcal/c0*/images/wideDD-c*.app.restored.fits herts:/beegfs/lofar/lba/products/%s' % grouped_target)
             os.system('scp -q ddcal/c0*/images/wideDD-c*.int.restored.fits herts:/beegfs/lofar/lba/products/%s' % grouped_target)
             os.system('scp -q ddcal/c01/solutions/interp.h5 herts:/beegfs/lofar/lba/products/%s' % grouped_target)
-### DONE
+    ### DONE
 
     if survey: update_status_db(grouped_target, 'Done')
     logger.info('### %s: Done. #####################################' % grouped_target)
+
+
+def du(path):
+    """
+    Size in GB of a directory
+    """
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try: size += os.lstat(os.path.join(root, f)).st_size
+            except OSError: pass
+    return size/1024**3
+
+
+class Task(object):
+    """
+    A pipeline call for a field, run in a child process
+    """
+    def __init__(self, name, field, funct, args=(), deps=[], ncpu=1, mem=0, disk=0, priority=0):
+        self.name = name
+        self.field = field
+        self.funct = funct
+        self.args = args
+        self.deps = deps
+        self.ncpu = ncpu
+        self.mem = mem # GB
+        self.disk = disk # GB expected to be written
+        self.priority = priority
+        self.status = 'waiting'
+        self.proc = None
+
+    def _run(self):
+        os.environ['LILF_MAX_CPU'] = str(self.ncpu)
+        # the threads writing the events of the parent are not in this process
+        lib_log.restart_events()
+        try:
+            self.funct(*self.args)
+        finally:
+            lib_log.stop_events()
+
+
+class Orchestrator(object):
+    """
+    Run the pipelines of several fields concurrently within a global cpu/memory/disk budget.
+    Ready tasks are started by priority: first calibrators, then the tasks with more fields waiting for them.
+    """
+    def __init__(self, max_cpu, max_mem, min_disk, poll=30):
+        self.max_cpu = max_cpu
+        self.max_mem = max_mem
+        self.min_disk = min_disk
+        self.poll = poll
+        self.tasks = []
+
+    def add(self, task):
+        self.tasks.append(task)
+        return task
+
+    def n_waiting(self, task):
+        """
+        Number of tasks waiting (also indirectly) for task
+        """
+        return len([t for t in self.tasks if t.status == 'waiting' and task in self._all_deps(t)])
+
+    def _all_deps(self, task):
+        deps = set(task.deps)
+        for d in task.deps: deps |= self._all_deps(d)
+        return deps
+
+    def fits(self, task, running):
+        """
+        Check if the task fits in the budget left by the running tasks (one task can always run)
+        """
+        if len(running) == 0: return True
+        if sum([t.ncpu for t in running]) + task.ncpu > self.max_cpu: return False
+        if sum([t.mem for t in running]) + task.mem > self.max_mem: return False
+        free_disk = shutil.disk_usage(working_dir).free/1024**3 - sum([t.disk for t in running])
+        if free_disk - task.disk < self.min_disk: return False
+        return True
+
+    def report(self):
+        """
+        Progress per field
+        """
+        for field in sorted(set([t.field for t in self.tasks])):
+            logger.info('%s: %s' % (field, ' -- '.join(['%s: %s' % (t.name, t.status) for t in self.tasks if t.field == field])))
+
+    def run(self):
+        """
+        Return True if all tasks completed successfully
+        """
+        while True:
+            changed = False
+            running = [t for t in self.tasks if t.status == 'running']
+            for t in running:
+                if not t.proc.is_alive():
+                    t.proc.join()
+                    t.status = 'done' if t.proc.exitcode == 0 else 'failed'
+                    if t.status == 'failed': logger.error('### %s: %s failed.' % (t.field, t.name))
+                    changed = True
+
+            for t in self.tasks:
+                if t.status == 'waiting' and any([d.status in ['failed','blocked'] for d in t.deps]):
+                    t.status = 'blocked'
+                    changed = True
+
+            running = [t for t in self.tasks if t.status == 'running']
+            ready = [t for t in self.tasks if t.status == 'waiting' and all([d.status == 'done' for d in t.deps])]
+            ready.sort(key=lambda t: (-t.priority, -self.n_waiting(t)))
+            for t in ready:
+                if self.fits(t, running):
+                    logger.info('### %s: starting %s (cpu: %i, mem: %i GB)' % (t.field, t.name, t.ncpu, t.mem))
+                    t.proc = multiprocessing.get_context('fork').Process(target=t._run, name=t.name)
+                    with lib_log.events_paused():
+                        t.proc.start()
+                    t.status = 'running'
+                    running.append(t)
+                    changed = True
+
+            if changed: self.report()
+            if len(running) == 0: break
+            time.sleep(self.poll)
+
+        return all([t.status == 'done' for t in self.tasks])
+
+
+####################################################################################
+
+# query the database for data to process
+survey = False
+if download_file == '' and project == '' and target == '' and obsid == '':
+    survey = True
+    project = survey_projects
+    if os.path.exists('target.txt'):
+        with open('target.txt', 'r') as file:
+                target = file.read().replace('\n', '')
+    else:
+        logger.info('### Quering database...')
+        with SurveysDB(survey='lba',readonly=True) as sdb:
+            sdb.execute('SELECT * FROM fields WHERE status="Observed" order by priority desc')
+            r = sdb.cur.fetchall()
+            target = r[0]['id']
+        # save target name
+        with open("target.txt", "w") as file:
+                print(target, file=file)
+
+    with SurveysDB(survey='lba',readonly=True) as sdb:
+        sdb.execute('SELECT * FROM field_obs WHERE field_id="%s"' % target)
+        r = sdb.cur.fetchall()
+        obsid = ','.join([str(x['obs_id']) for x in r])
+
+    logger.info("### Working on target: %s (obsid: %s)" % (target, obsid))
+    # add other info, like cluster, node, user...
+    username = getpass.getuser()
+    clustername = s.cluster
+    nodename = socket.gethostname()
+    with SurveysDB(survey='lba',readonly=False) as sdb:
+        sdb.set_field({'id':target, 'username':username, 'clustername':clustername, 'nodename':nodename})
+
+    update_status_db(target, 'Download') 
+
+#######
+# setup
+if not os.path.exists(working_dir):
+    os.makedirs(working_dir)
+if os.path.exists('lilf.config') and os.getcwd() != working_dir: 
+    os.system('cp lilf.config '+working_dir)
+
+os.chdir(working_dir)
+if not os.path.exists(working_dir+'/download'):
+    os.makedirs(working_dir+'/download')
+
+if download_file != '':
+    os.system('cp %s download/html.txt' % download_file)
+
+##########
+# data download
+# here the pipeline downloads only the target, not the calibrator
+with w.if_todo('download'):
+    logger.info('### Starting download... #####################################')
+    os.chdir(working_dir+'/download')
+
+    if download_file == '':
+        cmd = LiLF_dir+'/scripts/LOFAR_stager.py --projects %s --nocal' % project
+        if target != '':
+            cmd += ' --target %s' % target
+        if obsid != '':
+            cmd += ' --obsID %s' % obsid
+        logger.debug("Exec: %s" % cmd)
+        os.system(cmd)
+
+    # TODO: how to be sure all MS were downloaded?
+    os.system(LiLF_dir+'/pipelines/LOFAR_preprocess.py')
+    check_done('pipeline-preprocess.logger')
+    os.system('mv mss/* ../')
+### DONE
+
+os.chdir(working_dir)
+fix_dir_format(working_dir)
+if survey: update_status_db(target, 'Calibrator')
+calibrators = local_calibrator_dirs()
+targets = [t for t in glob.glob('id*') if t not in calibrators]
+logger.debug('CALIBRATORS: %s' % ( ','.join(calibrators) ) )
+logger.debug('TARGET: %s' % (','.join(targets) ) )
+
+# group targets with same name, assuming they are different pointings of the same dir
+grouped_targets = sorted(set([t.split('_-_',1)[1] for t in targets]))
+
+if not concurrent:
+    for target in targets:
+        run_calibrator(target)
+        run_timesplit(target)
+
+    for grouped_target in grouped_targets:
+        run_grouped_target(grouped_target)
+
+else:
+    logger.info('### Running fields concurrently (cpu: %i, mem: %i GB, min free disk: %i GB)' % (max_cpu, max_mem, min_disk))
+    o = Orchestrator(max_cpu, max_mem, min_disk)
+    # calibrators are shared by targets of the same observation, timesplits start as soon as their solutions are there
+    cals = {}
+    timesplits = {}
+    for target in targets:
+        obsid = int(target.split('_-_')[0][2:])
+        if obsid not in cals:
+            cals[obsid] = o.add(Task('cal_id%i' % obsid, target, run_calibrator, (target,), ncpu=cpu_per_pipeline,
+                                     mem=mem_per_pipeline, priority=1))
+        timesplits[target] = o.add(Task('timesplit', target, run_timesplit, (target,), deps=[cals[obsid]],
+                                        ncpu=cpu_per_pipeline, mem=mem_per_pipeline, disk=du(working_dir+'/'+target)))
+    for grouped_target in grouped_targets:
+        o.add(Task('self+dd', grouped_target, run_grouped_target, (grouped_target,),
+                   deps=[timesplits[t] for t in targets if t.split('_-_',1)[1] == grouped_target],
+                   ncpu=cpu_per_pipeline, mem=mem_per_pipeline))
+    if not o.run():
+        logger.error('Some fields failed, check the logs.')
+        sys.exit(1)
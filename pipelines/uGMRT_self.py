@@ -20,6 +20,7 @@ parset = lib_util.getParset()
 parset_dir = parset.get('uGMRT_self','parset_dir')
 sourcedb = parset.get('model','sourcedb') # relative to tgts dir "./tgts/xxx/model.txt
 userReg = parset.get('model','userReg') # relative to tgts dir "./tgts/xxx/region.ref"
+mask_engine = parset.get('LiLF','mask_engine')
 
 MSs = lib_ms.AllMSs( glob.glob('mss/*.MS'), s )
 
@@ -135,7 +136,7 @@ for c in range(3):
 
     # make mask
     im = lib_img.Image(imagename+'-MFS-image.fits', userReg=userReg)
-    im.makeMask(threshisl=4, atrous_do=False)
+    im.makeMask(threshisl=4, atrous_do=False, engine=mask_engine)
     
     # baseline averaging possible as we cut longest baselines (also it is in time, where smearing is less problematic)
     # TODO: add -parallel-deconvolution=256 when source lists can be saved (https://sourceforge.net/p/wsclean/tickets/141/)
@@ -151,7 +152,7 @@ for c in range(3):
     if c != 2:
 
         im = lib_img.Image(imagename+'-MFS-image.fits', userReg=userReg)
-        im.makeMask(threshisl=5, atrous_do=False)
+        im.makeMask(threshisl=5, atrous_do=False, engine=mask_engine)
         im.selectCC()
 
         # predict - ms: MODEL_DATA
@@ -165,11 +166,11 @@ os.system('mv img/wideM-2-sources.txt self/images')
 
 # final, large self-cal image (used to get the skymodel)
 image_field = lib_img.Image('self/images/wideM-2-MFS-image.fits', userReg=userReg)
-image_field.makeMask(threshisl=5, atrous_do=True)
+image_field.makeMask(threshisl=5, atrous_do=True, engine=mask_engine)
 image_field.selectCC()
 # small self-cal image (used only to define the size of the final mosaic)
 image_small = lib_img.Image('self/images/wideM-1-MFS-image.fits', userReg=userReg)
-image_small.makeMask(threshisl=5, atrous_do=True)
+image_small.makeMask(threshisl=5, atrous_do=True, engine=mask_engine)
 
 # Move DIE-corrected data into CORRECTED_DATA_DIE
 logger.info('Set CORRECTED_DATA_DIE = CORRECTED_DATA...')
@@ -398,7 +399,7 @@ for c in range(3):
     
         # make mask
         im = lib_img.Image(imagename+'-MFS-image.fits', userReg=userReg)
-        im.makeMask(threshisl = 3)
+        im.makeMask(threshisl = 3, engine=mask_engine)
     
         # clean 2
         # TODO: add -parallel-deconvolution when source lists can be saved (https://sourceforge.net/p/wsclean/tickets/141/)
@@ -450,7 +451,7 @@ for c in range(3):
 
     os.system('cp img/*M*MFS-image.fits img/mos-MFS-image.fits img/mos-MFS-residual.fits ddcal/images/c%02i' % c )
     image_field = lib_img.Image('ddcal/images/c%02i/mos-MFS-image.fits' % c, userReg = userReg)
-    image_field.makeMask(threshisl=3, atrous_do=True)
+    image_field.makeMask(threshisl=3, atrous_do=True, engine=mask_engine)
 
     # get noise, if larger than 95% of prev cycle: break
     rms_noise = lib_img.Image(mosaic_residual).getNoise()
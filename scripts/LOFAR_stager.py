@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
-# To do a second run, rename the uris.pickle
+# The state of all uris is kept in stager.sqlite, to do a second run rename it
 
 # Idea of the code:
-# The code crates 4 suprocesses:
+# The code crates these suprocesses:
 # - 1 stager
 # - 1 checker
-# - 2 downlaoders
+# - N downloaders (--ndownloaders), which stream the tarballs straight into the extractor
+# - M verifiers (--nverifiers), which check that the extracted MSs can be opened
 
 import os, sys, time, glob, pickle, argparse, re
 import subprocess, multiprocessing
@@ -16,7 +17,8 @@ from awlofar.main.aweimports import CorrelatedDataProduct, \
 from awlofar.toolbox.LtaStager import LtaStager, LtaStagerError
 import stager_access as stager
 from casacore import tables
-from download_file import download_file
+from download_file import download_extract
+from stager_state import StateStore
 
 #project = 'LC9_017' # 3c first part
 #project = 'LC10_020' # 3c second part
@@ -28,6 +30,11 @@ parser.add_argument('--obsID', '-o', dest='obsID', help='Comma separated list of
 parser.add_argument('--target', '-t', dest='target', help='')
 parser.add_argument('--calonly', '-c', dest='calonly', action='store_true', help='')
 parser.add_argument('--nocal', '-n', dest='nocal', action='store_true', help='')
+parser.add_argument('--ndownloaders', dest='ndownloaders', type=int, default=2, help='Number of concurrent downloads (default: 2)')
+parser.add_argument('--nverifiers', dest='nverifiers', type=int, default=1, help='Number of processes checking the downloaded MSs (default: 1)')
+parser.add_argument('--max_rate', dest='max_rate', type=float, default=None, help='Total bandwidth cap in MB/s, shared among the downloaders (default: none)')
+parser.add_argument('--max_attempts', dest='max_attempts', type=int, default=3, help='Staging requests before giving up on a surl which never comes online (default: 3)')
+parser.add_argument('--download_url', dest='download_url', default=None, help='URL template with a %%s for the surl, to download from a server other than the LTA sites (e.g. for testing)')
 args = parser.parse_args()
 
 if args.projects is None:
@@ -63,84 +70,79 @@ re_cal = re.compile('.*3[c|C](196|295|380).*')
 
 # First: collect all uris
 # This part of the code simply selects the uris to stage starting from the project names and the target name
-if not os.path.exists('uris.pickle'):
-    uris = set() # All URIS to stage
-    for project in projects:
-        print("Quering project: %s" % project)
-        query_observations = Observation.select_all().project_only(project)
-        for observation in query_observations :
-            obsID = int(observation.observationId)
-            if args.obsID is not None:
-                if obsID not in obsIDs:
-                    continue
-            print("Querying ObservationID %i" % obsID, end='')
-            # Instead of querying on the Observations of the DataProduct, all DataProducts could have been queried
-            dataproduct_query = cls.observations.contains(observation)
-            # isValid = 1 means there should be an associated URI
-            dataproduct_query &= cls.isValid == 1
-            #if target is not None: dataproduct_query &= CorrelatedDataProduct.subArrayPointing.targetName == target
-
-            for i, dataproduct in enumerate(dataproduct_query):
-                # apply selections
-                name = dataproduct.subArrayPointing.targetName
-                if re_cal.match(name) and nocal: continue
-                if not re_cal.match(name) and calonly: continue
-                if target is not None and not target in name: continue
-
-                # This DataProduct should have an associated URL
-                fileobject = ((FileObject.data_object == dataproduct) & (FileObject.isValid > 0)).max('creation_date')
-                if fileobject:
-                    uris.add(fileobject.URI)
-                    if i%10 == 0:
-                        print(".", end='')
-                        sys.stdout.flush()
-                else :
-                    print("No URI found for %s with dataProductIdentifier %d" % (dataproduct.__class__.__name__, dataproduct.dataProductIdentifier))
-            print("")
+# On restart the state store is used as is
+store = StateStore('stager.sqlite', max_attempts=args.max_attempts)
+if len(store) == 0:
+    if os.path.exists('uris.pickle'):
+        # run started before the state store existed
+        uris = pickle.load(open('uris.pickle','rb'))
+    else:
+        uris = set() # All URIS to stage
+        for project in projects:
+            print("Quering project: %s" % project)
+            query_observations = Observation.select_all().project_only(project)
+            for observation in query_observations :
+                obsID = int(observation.observationId)
+                if args.obsID is not None:
+                    if obsID not in obsIDs:
+                        continue
+                print("Querying ObservationID %i" % obsID, end='')
+                # Instead of querying on the Observations of the DataProduct, all DataProducts could have been queried
+                dataproduct_query = cls.observations.contains(observation)
+                # isValid = 1 means there should be an associated URI
+                dataproduct_query &= cls.isValid == 1
+                #if target is not None: dataproduct_query &= CorrelatedDataProduct.subArrayPointing.targetName == target
+
+                for i, dataproduct in enumerate(dataproduct_query):
+                    # apply selections
+                    name = dataproduct.subArrayPointing.targetName
+                    if re_cal.match(name) and nocal: continue
+                    if not re_cal.match(name) and calonly: continue
+                    if target is not None and not target in name: continue
+
+                    # This DataProduct should have an associated URL
+                    fileobject = ((FileObject.data_object == dataproduct) & (FileObject.isValid > 0)).max('creation_date')
+                    if fileobject:
+                        uris.add(fileobject.URI)
+                        if i%10 == 0:
+                            print(".", end='')
+                            sys.stdout.flush()
+                    else :
+                        print("No URI found for %s with dataProductIdentifier %d" % (dataproduct.__class__.__name__, dataproduct.dataProductIdentifier))
+                print("")
                 
-                #if len(uris) == 1: break # TEST
-            #break # TEST
-     
-        pickle.dump(uris, open('uris.pickle', 'wb'))
-else:
-    uris = pickle.load(open('uris.pickle','rb'))
-
-# remove files already downloaded/renamed
-downloaded_mss = glob.glob('*MS')
-if os.path.exists('renamed.txt'):
-    with open('renamed.txt','r') as flog:
-        for line in flog:
-            downloaded_mss.append(line[:-1])
-            
-len_all_uris = len(uris)
-uris = [uri for uri in uris if uri.split('/')[-1][:-13] not in downloaded_mss]
-print(("Total URI's: %i (after removal of already downloaded: %i)" % (len_all_uris,len(uris))))
-if len(uris) == 0:
+                    #if len(uris) == 1: break # TEST
+                #break # TEST
+
+    # mark files already downloaded/renamed
+    downloaded_mss = glob.glob('*MS')
+    if os.path.exists('renamed.txt'):
+        with open('renamed.txt','r') as flog:
+            for line in flog:
+                downloaded_mss.append(line[:-1])
+
+    store.add(uris)
+    store.set_state([uri for uri in uris if uri.split('/')[-1][:-13] in downloaded_mss], 'done')
+
+i = store.recover()
+if i > 0: print("Restarting %i interrupted downloads." % i)
+counts = store.counts()
+print(("Total URI's: %i (after removal of already downloaded: %i)" % (len(store), len(store)-counts['done'])))
+if counts['failed'] > 0:
+    print("Failed to stage (not retried): %i (reset them to 'to_stage' in %s to retry)" % (counts['failed'], store.filename))
+if len(store) == counts['done'] + counts['failed']:
     print("Done.")
     sys.exit()
- 
-# Queue of data to stage
-L_toStage = multiprocessing.Manager().list()  # list of surls to download
-L_inStage = multiprocessing.Manager().list()  # list of sids of active staging processes
-
-# Queue of data to download
-L_toDownload = multiprocessing.Manager().list()  # list of surls ready to download
-L_inDownload = multiprocessing.Manager().list()  # list of surls being downloaded
-L_Downloaded = multiprocessing.Manager().list()  # list of surls downlaoded
 
 class Worker(multiprocessing.Process):
     """
     This is a global worker class to be inherited by the 3 specialized workers
     """
-    def __init__(self, stager, L_toStage, L_inStage, L_toDownload, L_inDownload, L_Downloaded):
+    def __init__(self, stager, store):
         multiprocessing.Process.__init__(self)
         self.exit = multiprocessing.Event()
         self.stager = stager
-        self.L_toStage = L_toStage
-        self.L_inStage = L_inStage
-        self.L_toDownload = L_toDownload
-        self.L_inDownload = L_inDownload
-        self.L_Downloaded = L_Downloaded
+        self.store = store
 
     def run(self):
         while not self.exit.is_set():
@@ -157,15 +159,13 @@ class Worker_stager(Worker):
         import time
         while not self.exit.is_set():
             # if there's space add a block of 200
-            if len(self.L_inStage) < 5 and len(self.L_toStage) > 0:
-                uris = self.L_toStage[:200]
-                #uris = [self.L_toStage[0]] # debug to stage 1 uri at a time
+            if self.store.counts()['sids'] < 5 and self.store.count('to_stage') > 0:
+                uris = self.store.get('to_stage', limit=200)
+                #uris = uris[:1] # debug to stage 1 uri at a time
                 print("Stager -- Staging %i uris" % len(uris))
                 try:
-                    sids = self.stager.stage(uris)
-                    self.L_inStage.append( sids )
-                    for uri in uris:
-                        self.L_toStage.remove(uri)
+                    sid = self.stager.stage(uris)
+                    self.store.start_staging(uris, sid)
                 except Exception as e:
                     print("Error at staging...", e)
     
@@ -179,7 +179,7 @@ class Worker_checker(Worker):
     def run(self):
         import time
         while not self.exit.is_set():
-            for sid in self.L_inStage:
+            for sid in self.store.sids():
 
                 try:
                     status = self.stager.get_status(sid)
@@ -189,17 +189,20 @@ class Worker_checker(Worker):
                     surls = []
                     print("Checker -- Failed to get status for sid %i. Continue." % sid)
 
+                # only surls of this run still waiting for staging are passed to the downloaders:
+                # if the process is re-started it might have collected old staging processes,
+                # this prevents us from downloading useless files
                 for surl in surls:
-                    if not surl in self.L_toDownload and not surl in self.L_inDownload and not surl in self.L_Downloaded:
-                        # this should always be the case, but if the process is re-started it might have collected old staging processes,
-                        # this if prevents us from downloading useless files
-                        if surl in uris:
-                            self.L_toDownload.append(surl)
+                    self.store.set_online(surl)
 
                 # pass to download
                 if status == 'success' or status == 'partial success':
                     print("Checker -- Sid %i completed." % sid)
-                    self.L_inStage.remove(sid)
+                    i, failed = self.store.finish_staging(sid)
+                    if i > 0:
+                        print("Checker -- WARNING: %i uris of sid %i were not staged (resubmitted)" % (i, sid))
+                    if failed > 0:
+                        print("Checker -- ERROR: %i uris of sid %i were not staged after %i attempts (failed)" % (failed, sid, self.store.max_attempts))
 
                 elif status == 'in progress' or status == 'new' or status == 'scheduled' or status == '':
                     print("Checker -- WARNING: Sid %i status is: '%s'" % (sid, status) )
@@ -217,17 +220,24 @@ class Worker_downloader(Worker):
     """
     This worker download the data
     """
+    def __init__(self, stager, store, max_rate=None, download_url=None):
+        Worker.__init__(self, stager, store)
+        self.max_rate = max_rate # bytes/s
+        self.download_url = download_url
+
     def run(self):
         import os
         while not self.exit.is_set():
-            if len(self.L_toDownload) > 0:
-                surl = self.L_toDownload.pop()
-                self.L_inDownload.append(surl)
+            surl = self.store.claim('to_download', 'downloading')
+            if surl is not None:
 
                 tar_file = surl.split('/')[-1]  # e.g. .../L769079_SB020_uv.MS_daf24388.tar
                 ms_file = surl.split('/')[-1].split('.MS')[0]+'.MS'  # e.g. .../L769079_SB020_uv.MS
 
-                if 'psnc.pl' in surl:
+                if self.download_url is not None:
+                    url = self.download_url % surl
+                    LTA_site = url.split('/')[2]
+                elif 'psnc.pl' in surl:
                     url = 'https://lta-download.lofar.psnc.pl/lofigrid/SRMFifoGet.py?surl=%s' % surl
                     LTA_site = 'PL'
                 elif 'sara.nl' in surl:
@@ -242,32 +252,52 @@ class Worker_downloader(Worker):
 
                 print("Downloader -- Download: %s (from: %s) " % (tar_file, LTA_site))
 
-                # loop until the sanity check on the downloaded MS is ok
-                while True:
-                    download_file(url, tar_file, login, password)
-                    os.system('tar xf %s' % tar_file)
-                    print(tar_file)
-                    try:
-                        t = tables.table(ms_file, ack=False)
-                        break
-                    except:
-                        print('ERROR opening %s, probably corrupted - redownload it' % ms_file)
-                        #os.system('rm -r %s %s' % (tar_file, ms_file))
-                os.system('rm -r %s' % tar_file)
-
-                self.L_inDownload.remove(surl)
-                self.L_Downloaded.append(surl)
+                # the tarball is extracted while downloading, the sanity check is left to the verifiers
+                os.system('rm -rf %s' % ms_file)
+                try:
+                    download_extract(url, '.', login, password, max_rate=self.max_rate)
+                except Exception as e:
+                    print('Downloader -- ERROR downloading %s (%s) - redownload it' % (tar_file, e))
+                    os.system('rm -rf %s' % ms_file)
+                    self.store.transition(surl, 'downloading', 'to_download')
+                    time.sleep(30)
+                    continue
+
+                self.store.transition(surl, 'downloading', 'to_verify')
 
             time.sleep(2)
 
-# start processes
-w_stager = Worker_stager(stager, L_toStage, L_inStage, L_toDownload, L_inDownload, L_Downloaded)
-w_checker = Worker_checker(stager, L_toStage, L_inStage, L_toDownload, L_inDownload, L_Downloaded)
-w_downloader1 = Worker_downloader(stager, L_toStage, L_inStage, L_toDownload, L_inDownload, L_Downloaded)
-w_downloader2 = Worker_downloader(stager, L_toStage, L_inStage, L_toDownload, L_inDownload, L_Downloaded)
+class Worker_verifier(Worker):
+    """
+    This worker checks that the downloaded MSs can be opened, otherwise they are downloaded again
+    """
+    def run(self):
+        import os
+        while not self.exit.is_set():
+            surl = self.store.claim('to_verify', 'verifying')
+            if surl is not None:
+                ms_file = surl.split('/')[-1].split('.MS')[0]+'.MS'  # e.g. .../L769079_SB020_uv.MS
+                try:
+                    t = tables.table(ms_file, ack=False)
+                    t.close()
+                except:
+                    print('ERROR opening %s, probably corrupted - redownload it' % ms_file)
+                    os.system('rm -rf %s' % ms_file)
+                    self.store.transition(surl, 'verifying', 'to_download')
+                else:
+                    self.store.transition(surl, 'verifying', 'done')
+                continue
 
-# fill the queue with uris
-[L_toStage.append(uri) for uri in uris]
+            time.sleep(2)
+
+# start processes
+# the bandwidth cap is split evenly among the downloaders
+max_rate = args.max_rate*1024**2/args.ndownloaders if args.max_rate else None
+w_stager = Worker_stager(stager, store)
+w_checker = Worker_checker(stager, store)
+w_downloaders = [Worker_downloader(stager, store, max_rate=max_rate, download_url=args.download_url)
+                 for i in range(args.ndownloaders)]
+w_verifiers = [Worker_verifier(stager, store) for i in range(args.nverifiers)]
 
 # add things already staged (here we do the get_progress())
 i=0
@@ -275,12 +305,7 @@ try:
     for sid, _ in stager.get_progress().items():
         sid = int(sid)
         print("Found an active staging process: %i" % sid)
-        for surl in stager.get_surls_online(sid):
-            if surl in L_toStage:
-                L_toStage.remove(surl)
-                if sid not in L_inStage:
-                    L_inStage.append(sid)  # the worker will take care of starting downloads
-                i += 1
+        i += store.start_staging(stager.get_surls_online(sid), sid)  # the worker will take care of starting downloads
     print("Removed %i already staged surls." % i)
 except Exception as e:
     print("Error recovering staged surls...", e)
@@ -288,23 +313,30 @@ except Exception as e:
 
 w_stager.start()
 w_checker.start()
-w_downloader1.start()
-w_downloader2.start()
+for w in w_downloaders + w_verifiers:
+    w.start()
 
 # this part creates some output to monitor the progress
 while True:
-    sys.stdout.write("\r%s: To stage: %i -- In staging: %i (blocks) -- To download: %i -- In downloading: %i || " % \
-            ( time.ctime(), len(L_toStage), len(L_inStage), len(L_toDownload), len(L_inDownload) ) )
-    #print(L_toStage,L_inStage,L_toDownload,L_inDownload)
+    counts = store.counts()
+    sys.stdout.write("\r%s: To stage: %i -- In staging: %i (blocks) -- To download: %i -- In downloading: %i -- To verify: %i || " % \
+            ( time.ctime(), counts['to_stage'], counts['sids'], counts['to_download'], counts['downloading'],
+              counts['to_verify']+counts['verifying'] ) )
     sys.stdout.flush()
     time.sleep(2)
     
     # if all queues are empty, kill children and exit
-    if len(L_toStage) + len(L_toDownload) + len(L_inStage) + len(L_inDownload) == 0 :
+    if counts['to_stage'] + counts['to_download'] + counts['sids'] + counts['downloading'] + \
+       counts['to_verify'] + counts['verifying'] == 0 :
         print("Done.")
         break
 
 w_stager.terminate()
 w_checker.terminate()
-w_downloader1.terminate()
-w_downloader2.terminate()
\ No newline at end of file
+for w in w_downloaders + w_verifiers:
+    w.terminate()
+
+failed = store.get('failed')
+if len(failed) > 0:
+    print("WARNING: %i uris could not be staged after %i attempts:" % (len(failed), store.max_attempts))
+    for surl in failed: print(surl)
@@ -24,12 +24,8 @@ Create a new column in a measumrent set
 
 import optparse, logging
 import casacore.tables as pt
-import numpy
-import logging
 
-logging.basicConfig(level=logging.DEBUG)
-
-def main(options):
+def addcols(options):
     ms = options.ms
     if ms == '':
             logging.error('You have to specify an input MS, use -h for help')
@@ -82,11 +78,19 @@ def main(options):
 
     t.close()
         
-opt = optparse.OptionParser()
-opt.add_option('-m','--ms',help='Input MS [no default].',default='')
-opt.add_option('-c','--cols',help='Output column, comma separated if more than one [no default].',default='')
-opt.add_option('-i','--incol',help='Input column to copy in the output column, otherwise it will be set to 0 [default set to 0].',default='')
-opt.add_option('-d','--dysco',help='Enable dysco dataManager for new columns (copied columns always get the same dataManager of the original)',action="store_true",default=False)
-options, arguments = opt.parse_args()
-main(options)
+def main(argv=None):
+    """
+    Run as from the command line, argv: list of arguments (default: sys.argv[1:])
+    """
+    logging.basicConfig(level=logging.DEBUG)
+
+    opt = optparse.OptionParser()
+    opt.add_option('-m','--ms',help='Input MS [no default].',default='')
+    opt.add_option('-c','--cols',help='Output column, comma separated if more than one [no default].',default='')
+    opt.add_option('-i','--incol',help='Input column to copy in the output column, otherwise it will be set to 0 [default set to 0].',default='')
+    opt.add_option('-d','--dysco',help='Enable dysco dataManager for new columns (copied columns always get the same dataManager of the original)',action="store_true",default=False)
+    options, arguments = opt.parse_args(argv)
+    addcols(options)
 
+if __name__=='__main__':
+    main()
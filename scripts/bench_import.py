@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# compare the startup time of the per-MS python scripts run from the command line (new interpreter + imports)
+# and in process (lib_util.call_inprocess(): fork of a process where the script is already loaded)
+
+import os, sys, time, subprocess
+
+from LiLF import lib_util, lib_ms
+
+def bench_cli(args, ntimes=5):
+    """
+    Return the median time to run "python args" in a new interpreter
+    """
+    times = []
+    for i in range(ntimes):
+        start = time.time()
+        subprocess.call([sys.executable]+args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.time()-start)
+    return sorted(times)[len(times)//2]
+
+def bench_inprocess(module, ntimes=5):
+    """
+    Return the median time to run its main(['--help']) in a forked process
+    """
+    times = []
+    for i in range(ntimes):
+        start = time.time()
+        lib_util.call_inprocess(module, ['--help'], os.devnull)
+        times.append(time.time()-start)
+    return sorted(times)[len(times)//2]
+
+def slowest_imports(path, n=5):
+    """
+    Return the n slowest imports (cumulative time in s, module) of a script, from python -X importtime
+    """
+    out = subprocess.run([sys.executable, '-X', 'importtime', path, '--help'], stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE).stderr.decode()
+    imports = []
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line: continue
+        self_us, cumul_us, module = line[len('import time:'):].split('|')
+        # only top level imports, their time includes the imports they trigger
+        if module.startswith('  '): continue
+        imports.append((int(cumul_us)/1e6, module.strip()))
+    return sorted(imports, reverse=True)[:n]
+
+if __name__=='__main__':
+    import optparse
+    opt = optparse.OptionParser(usage='%prog [options] [script1.py script2.py ...]', version='1.0')
+    opt.add_option('-n', '--ntimes', help='Repetitions of each measure (default=5)', type='int', default=5)
+    opt.add_option('-i', '--imports', help='Also list the slowest imports of each script', action='store_true', default=False)
+    (options, args) = opt.parse_args()
+
+    scripts = args if len(args) > 0 else lib_ms.inprocess_scripts
+    t_python = bench_cli(['-c', 'pass'], options.ntimes)
+    print('Bare interpreter startup: %.3fs' % t_python)
+    print('%-20s %10s %10s %12s %8s' % ('script', 'cli', 'load', 'in process', 'speedup'))
+    for script in scripts:
+        start = time.time()
+        module = lib_util.load_script(script)
+        t_load = time.time()-start
+        if module is None or not hasattr(module, 'main'):
+            print('%-20s not found or without main()' % script)
+            continue
+        t_cli = bench_cli([module.__file__, '--help'], options.ntimes)
+        t_inproc = bench_inprocess(module, options.ntimes)
+        print('%-20s %9.3fs %9.3fs %11.3fs %7.1fx' % (script, t_cli, t_load, t_inproc, t_cli/t_inproc))
+        if options.imports:
+            for t, m in slowest_imports(module.__file__):
+                print('    %-30s %.3fs' % (m, t))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+# compare values and runtime of the bdsf and native noise estimators of lib_img.Image.getNoise()
+
+import os, sys, time, shutil, tempfile
+
+from LiLF import lib_img
+
+def bench_noise(imagename, ncpu=None, boxsize=None):
+    """
+    Return (rms_bdsf, t_bdsf, rms_native, t_native) for a fits image.
+    The image is copied in a temporary dir so that a pre-existing mask is not reused by the bdsf path.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='bench_noise_')
+    try:
+        tmpimage = os.path.join(tmpdir, os.path.basename(imagename))
+        shutil.copy(imagename, tmpimage)
+        im = lib_img.Image(tmpimage)
+
+        start = time.time()
+        rms_bdsf = im.getNoise(boxsize=boxsize, method='bdsf')
+        t_bdsf = time.time() - start
+
+        start = time.time()
+        rms_native = im.getNoise(boxsize=boxsize, method='native', ncpu=ncpu)
+        t_native = time.time() - start
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return rms_bdsf, t_bdsf, rms_native, t_native
+
+if __name__=='__main__':
+    import optparse
+    opt = optparse.OptionParser(usage='%prog [-v|-V] image1.fits [image2.fits ...]', version='1.0')
+    opt.add_option('-n', '--ncpu', help='Threads for the native method (default=all)', type='int', default=None)
+    opt.add_option('-b', '--boxsize', help='Limit to the central box of this pixel size (default=None)', type='int', default=None)
+    (options, args) = opt.parse_args()
+
+    if len(args) == 0:
+        print('Missing images.')
+        sys.exit()
+
+    print('%-50s %12s %10s %12s %10s %8s %8s' % ('image', 'rms_bdsf', 't_bdsf', 'rms_native', 't_native', 'ratio', 'speedup'))
+    for imagename in args:
+        rms_bdsf, t_bdsf, rms_native, t_native = bench_noise(imagename, options.ncpu, options.boxsize)
+        print('%-50s %12.3e %9.2fs %12.3e %9.2fs %8.3f %7.1fx' % (os.path.basename(imagename), rms_bdsf, t_bdsf,
+              rms_native, t_native, rms_native/rms_bdsf, t_bdsf/t_native))
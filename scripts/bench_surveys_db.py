@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# benchmark the surveys database workflow offline, on a local SQLite stand-in (see surveys_db.create_sqlite_db())
+# compare status updates with a new connection each time, with pooled connections and in batches
+
+import os, time, tempfile, shutil
+
+# choose the backend before importing the module
+tmpdir = tempfile.mkdtemp(prefix='bench_surveys_db_')
+os.environ['DDF_PIPELINE_SQLITE'] = os.path.join(tmpdir, 'lba.sqlite')
+
+import surveys_db
+from surveys_db import SurveysDB
+
+def setup(nfields):
+    surveys_db.create_sqlite_db(os.environ['DDF_PIPELINE_SQLITE'], survey='lba')
+    with SurveysDB(survey='lba') as sdb:
+        sdb.cur.executemany('insert into fields (id, status, priority) values (%s, %s, %s)',
+                            [('P%03i' % i, 'Observed', i % 3) for i in range(nfields)])
+        sdb.cur.executemany('insert into field_obs (obs_id, field_id) values (%s, %s)',
+                            [(1000+i, 'P%03i' % i) for i in range(nfields)])
+
+def workflow(fields, pooled):
+    """
+    What PiLL does for each field: pick it, get its observations, tag it and go through the status changes
+    """
+    for field in fields:
+        with SurveysDB(survey='lba', readonly=True, pooled=pooled) as sdb:
+            sdb.execute('SELECT * FROM fields WHERE status="Observed" order by priority desc')
+            sdb.cur.fetchall()
+        with SurveysDB(survey='lba', readonly=True, pooled=pooled) as sdb:
+            sdb.execute('SELECT * FROM field_obs WHERE field_id=%s', (field,))
+            sdb.cur.fetchall()
+        with SurveysDB(survey='lba', pooled=pooled) as sdb:
+            sdb.set_field({'id':field, 'username':'user', 'clustername':'cluster', 'nodename':'node'})
+        for status in ['Download', 'Calibrator', 'Timesplit', 'Self', 'Ddcal', 'Done']:
+            with SurveysDB(survey='lba', pooled=pooled) as sdb:
+                sdb.execute('UPDATE fields SET status=%s WHERE id=%s', (status, field))
+
+def batched(fields):
+    for status in ['Download', 'Calibrator', 'Timesplit', 'Self', 'Ddcal', 'Done']:
+        surveys_db.update_statuses(dict([(field, status) for field in fields]), survey='lba')
+
+if __name__=='__main__':
+    import optparse
+    opt = optparse.OptionParser(usage='%prog [options]', version='1.0')
+    opt.add_option('-n', '--nfields', help='Number of fields (default=200)', type='int', default=200)
+    (options, args) = opt.parse_args()
+
+    try:
+        setup(options.nfields)
+        fields = ['P%03i' % i for i in range(options.nfields)]
+
+        start = time.time()
+        workflow(fields, pooled=False)
+        t_new = time.time()-start
+
+        start = time.time()
+        workflow(fields, pooled=True)
+        t_pooled = time.time()-start
+
+        start = time.time()
+        batched(fields)
+        t_batch = time.time()-start
+
+        with SurveysDB(survey='lba', readonly=True) as sdb:
+            sdb.execute('SELECT count(*) as n FROM fields WHERE status="Done"')
+            assert sdb.cur.fetchall()[0]['n'] == options.nfields
+
+        print('Workflow of %i fields:' % options.nfields)
+        print('new connection each time: %.3fs' % t_new)
+        print('pooled connections:       %.3fs (%.1fx)' % (t_pooled, t_new/t_pooled))
+        print('batched status updates:   %.3fs' % t_batch)
+    finally:
+        surveys_db.close_pool()
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+# check that lib_dd.SkymodelIndex parses the skymodels (default: those in LiLF/models) with the right columns,
+# comparing the positions with lsmtool when available
+# e.g.: check_skymodels.py models/*.skymodel
+
+import os, sys, glob
+import numpy as np
+
+from LiLF.lib_dd import SkymodelIndex
+
+def check(skymodel):
+    """
+    Return a list of problems (empty if fine)
+    """
+    try:
+        index = SkymodelIndex(skymodel)
+    except Exception as e:
+        return ['cannot be parsed: %s' % e]
+    problems = []
+    if np.any(index.dec < -90) or np.any(index.dec > 90): problems.append('Dec out of range')
+    try:
+        import lsmtool
+    except ImportError:
+        return problems
+    s = lsmtool.load(skymodel)
+    ra, dec = s.getColValues('Ra'), s.getColValues('Dec')
+    if len(ra) != len(index):
+        problems.append('%i sources, lsmtool reads %i' % (len(index), len(ra)))
+    elif not np.allclose(np.sort(index.ra), np.sort(ra), atol=1e-5) or not np.allclose(np.sort(index.dec), np.sort(dec), atol=1e-5):
+        problems.append('positions differ from lsmtool')
+    return problems
+
+if __name__=='__main__':
+    skymodels = sys.argv[1:] if len(sys.argv) > 1 else \
+                sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../models/*.skymodel')))
+    failed = False
+    for skymodel in skymodels:
+        problems = check(skymodel)
+        print('%-40s %s' % (os.path.basename(skymodel), 'OK' if len(problems) == 0 else '; '.join(problems)))
+        failed |= len(problems) > 0
+    sys.exit(1 if failed else 0)
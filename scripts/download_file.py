@@ -1,9 +1,10 @@
 #!/usr/bin/python
 # Generic file download with retry and check for length
 
-import os
-from time import sleep
+import os, tarfile
+from time import sleep, time
 import requests
+import urllib3
 
 def download_file(url, filename, login=None, password=None):
 
@@ -58,6 +59,103 @@ def download_file(url, filename, login=None, password=None):
     del response
     return downloaded
 
+class ResumableStream(object):
+    """
+    Read-only file-like object over an http download.
+    If the connection drops, the download is resumed from the current position with a
+    byte-range request. Reading can be capped to max_rate bytes/s.
+    """
+    def __init__(self, url, login=None, password=None, max_rate=None):
+        self.url = url
+        if (login is not None) and (password is not None):
+            self.auth = (login, password)
+        else: self.auth = None
+        self.max_rate = max_rate
+        self.pos = 0
+        self.size = None
+        self.response = None
+        self.t0 = time()
+        self._connect()
+
+    def _connect(self):
+        if self.response is not None:
+            self.response.close()
+        headers = {'Range': 'bytes=%i-' % self.pos} if self.pos > 0 else {}
+        while True:
+            try:
+                response = requests.get(self.url, stream=True, verify=True, timeout=60,
+                                        auth=self.auth, headers=headers)
+                if self.pos > 0 and response.status_code == 200:
+                    raise IOError('Server does not support byte ranges, cannot resume at %i bytes' % self.pos)
+                if response.status_code not in [200, 206]:
+                    print(response.headers)
+                    raise RuntimeError('Code was %i' % response.status_code)
+            except requests.exceptions.ConnectionError:
+                print('Downloader -- Connection error! sleeping 30 seconds before retry...')
+                sleep(30)
+            except (requests.exceptions.Timeout,requests.exceptions.ReadTimeout):
+                print('Downloader -- Timeout! sleeping 30 seconds before retry...')
+                sleep(30)
+            except RuntimeError:
+                sleep(30)
+            else:
+                break
+
+        if 'Content-Length' in response.headers.keys():
+            self.size = self.pos + int(response.headers['Content-Length'])
+        self.response = response
+
+    def read(self, n=-1):
+        while True:
+            try:
+                data = self.response.raw.read(None if n < 0 else n, decode_content=True)
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+                print('Downloader -- Connection error (%s)! Resuming from byte %i' % (e, self.pos))
+                self._connect()
+                continue
+            # premature end of the stream
+            if len(data) == 0 and self.size is not None and self.pos < self.size:
+                print('Downloader -- Download incomplete (expected %i, got %i)! Resuming' % (self.size, self.pos))
+                self._connect()
+                continue
+            break
+
+        self.pos += len(data)
+        if self.max_rate:
+            delay = self.pos / self.max_rate - (time() - self.t0)
+            if delay > 0: sleep(delay)
+        return data
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+
+
+def download_extract(url, path='.', login=None, password=None, max_rate=None):
+    """
+    Download a tarball and extract it on the fly into path, without writing the tar file to disk.
+    Interrupted transfers are resumed by byte range.
+    max_rate: cap on the download speed in bytes/s
+    Return the list of names in the tarball.
+    """
+    stream = ResumableStream(url, login, password, max_rate)
+    # the "tar" filter keeps the previous (tar xf) behaviour and silences the python>=3.12 warning
+    kwargs = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as tar:
+            names = []
+            for member in tar:
+                tar.extract(member, path, **kwargs)
+                names.append(member.name)
+    finally:
+        stream.close()
+    if stream.size is not None:
+        print('Downloader -- Download successful, %i of %i bytes received' % (stream.pos, stream.size))
+    else:
+        print('Downloader -- Download successful, %i bytes (unknown size)' % (stream.pos))
+    return names
+
+
 if __name__=='__main__':
     import sys
     download_file(sys.argv[1],sys.argv[2])
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# aggregate the json-lines events written by lib_log (LILF_EVENTS=1 or Logger(events_file=...))
+# e.g.: events_query.py --by pipeline,step --event step_end pipeline-*.events.jsonl
+#       events_query.py --by ms --event job_end --select pipeline=pipeline-cal,type=DP3 pipeline-cal.events.jsonl
+
+import sys, json
+
+def read_events(filenames, event=None, select={}, since=None):
+    """
+    Yield the events (dicts) of some json-lines files, optionally only those of a kind,
+    with the given values of some fields and after a time (unix seconds)
+    """
+    for filename in filenames:
+        with open(filename) as f:
+            for line in f:
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue # e.g. a truncated last line
+                if event is not None and e.get('event') != event: continue
+                if since is not None and e.get('time', 0) < since: continue
+                if any([str(e.get(k)) != v for k, v in select.items()]): continue
+                yield e
+
+def aggregate(events, by):
+    """
+    Return a dict: tuple of the values of the fields "by" -> dict of aggregated quantities
+    """
+    groups = {}
+    for e in events:
+        key = tuple([str(e.get(k, '-')) for k in by])
+        g = groups.setdefault(key, {'n':0, 'wall':0., 'cpu':0., 'maxrss':0, 'read':0, 'written':0, 'failed':0, 'start':e['time'], 'end':e['time']})
+        g['n'] += 1
+        for k in ['wall', 'cpu', 'read', 'written']:
+            g[k] += e.get(k) or 0
+        g['maxrss'] = max(g['maxrss'], e.get('maxrss') or 0)
+        if e.get('returncode', 0) != 0: g['failed'] += 1
+        g['start'] = min(g['start'], e['time']-(e.get('wall') or 0))
+        g['end'] = max(g['end'], e['time'])
+    return groups
+
+if __name__=='__main__':
+    import optparse, time
+    opt = optparse.OptionParser(usage='%prog [options] events1.jsonl [events2.jsonl ...]', version='1.0')
+    opt.add_option('-b', '--by', help='Comma-separated fields to group by, e.g. pipeline,step,ms,type,host (default=pipeline,step)', default='pipeline,step')
+    opt.add_option('-e', '--event', help='Event to aggregate: job_end or step_end (default=job_end)', default='job_end')
+    opt.add_option('-s', '--select', help='Comma-separated field=value to select events, e.g. step=apply,type=DP3 (default=all)', default='')
+    opt.add_option('--since', help='Only events of the last N hours (default=all)', type='float', default=None)
+    opt.add_option('--sort', help='Quantity to sort on: wall, cpu, maxrss, read, written, n (default=wall)', default='wall')
+    opt.add_option('--csv', help='Print comma-separated values', action='store_true', default=False)
+    (options, args) = opt.parse_args()
+
+    if len(args) == 0:
+        opt.print_help()
+        sys.exit()
+
+    by = options.by.split(',')
+    select = dict([s.split('=', 1) for s in options.select.split(',') if s != ''])
+    since = time.time()-options.since*3600 if options.since is not None else None
+    groups = aggregate(read_events(args, options.event, select, since), by)
+
+    cols = ['n', 'failed', 'wall', 'cpu', 'maxrss', 'read', 'written', 'span', 'MB/s']
+    rows = []
+    for key, g in sorted(groups.items(), key=lambda kg: kg[1][options.sort], reverse=True):
+        span = g['end']-g['start']
+        # throughput over the time span covered by the events (jobs run in parallel)
+        rate = (g['read']+g['written'])/1024.**2/span if span > 0 else 0.
+        rows.append(list(key)+[g['n'], g['failed'], '%.1f' % g['wall'], '%.1f' % g['cpu'], '%.2f' % (g['maxrss']/1024.**2),
+                               '%.2f' % (g['read']/1024.**3), '%.2f' % (g['written']/1024.**3), '%.1f' % span, '%.1f' % rate])
+
+    header = by+[c if c not in ['maxrss', 'read', 'written'] else c+'[GB]' for c in cols]
+    if options.csv:
+        print(','.join(header))
+        for r in rows: print(','.join([str(v) for v in r]))
+    else:
+        widths = [max([len(str(v)) for v in [h]+[r[i] for r in rows]]) for i, h in enumerate(header)]
+        print('  '.join([h.rjust(w) for h, w in zip(header, widths)]))
+        for r in rows: print('  '.join([str(v).rjust(w) for v, w in zip(r, widths)]))
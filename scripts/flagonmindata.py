@@ -20,9 +20,6 @@
 import os, sys, logging, time
 import numpy as np
 from casacore.tables import taql, table
-import matplotlib as mpl
-mpl.use("Agg")
-import matplotlib.pyplot as plt
 
 class MShandler():
     def __init__(self, ms_file):
@@ -31,7 +28,7 @@ class MShandler():
         """
         logging.info('Reading: %s' % ms_file)
         self.ms_file = ms_file
-        self.ms = table(ms_files[0], readonly=False, ack=False)
+        self.ms = table(ms_file[0], readonly=False, ack=False)
 
     def get_flags_aggr(self):
         """
@@ -70,20 +67,23 @@ def flagonmindata(MSh, mode, fract):
     msflag.flush()
 
 
-def readArguments():
+def readArguments(argv=None):
     import argparse
     parser=argparse.ArgumentParser("Flag data that do not come with enough unflagged data.")
     parser.add_argument("-v", "--verbose", help="Be verbose. Default is False", required=False, action="store_true")
     parser.add_argument("-m", "--mode", type=str, help="Mode can be: NO MODE IMPLEMENTED", required=False, default=None)
     parser.add_argument("-f", "--fractbad", type=float, help="Fraction of bad data allowed, if higher flagging is triggered (default 0.5) ", required=False, default=0.5)
     parser.add_argument("ms_files", type=str, help="MeasurementSet name(s).", nargs="+")
-    args=parser.parse_args()
+    args=parser.parse_args(argv)
     return vars(args)
 
-if __name__=="__main__":
+def main(argv=None):
+    """
+    Run as from the command line, argv: list of arguments (default: sys.argv[1:])
+    """
     start_time = time.time()
 
-    args         = readArguments()
+    args         = readArguments(argv)
     verbose      = args["verbose"]
     mode         = args["mode"]
     fract        = args["fractbad"]
@@ -103,3 +103,6 @@ if __name__=="__main__":
     flagonmindata(MSh, mode, fract)
 
     logging.debug('Running time %.0f s' % (time.time()-start_time))
+
+if __name__=="__main__":
+    main()
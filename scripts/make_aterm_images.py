@@ -67,10 +67,178 @@ def guassian_image(A, x, y, xsize, ysize, gsize):
     return im
 
 
+def interpolate_solutions(vals, times, freqs, times_out, freqs_out, axis_names,
+                          kind='nearest', log=False):
+    """Interpolate solutions to new times and frequencies
+
+    Parameters
+    ----------
+    vals : array
+        Solution values
+    times, freqs : array
+        Times and frequencies of the solutions
+    times_out, freqs_out : array
+        Times and frequencies to interpolate to
+    axis_names : list
+        Axis names of vals
+    kind : str, optional
+        Any kind supported by scipy.interpolate.interp1d. Axes with a single
+        solution are repeated instead
+    log : bool, optional
+        If True, interpolate in log space (for amplitudes)
+    """
+    if log:
+        vals = np.log10(vals)
+    for axis, x, x_out in (('time', times, times_out), ('freq', freqs, freqs_out)):
+        ind = axis_names.index(axis)
+        if len(x) == 1:
+            vals = np.repeat(vals, len(x_out), axis=ind)
+        else:
+            f = si.interp1d(x, vals, axis=ind, kind=kind, fill_value='extrapolate')
+            vals = f(x_out)
+    if log:
+        vals = 10**vals
+
+    return vals
+
+
+def gain_values(vals, vals_ph, t, f, s, d, haspol):
+    """Return the real XX, imaginary XX, real YY and imaginary YY gain values
+    for a given time, frequency, station and direction index
+    """
+    if haspol:
+        val_amp_xx = vals[t, f, s, d, 0]
+        val_amp_yy = vals[t, f, s, d, 1]
+        val_phase_xx = vals_ph[t, f, s, d, 0]
+        val_phase_yy = vals_ph[t, f, s, d, 1]
+    else:
+        val_amp_xx = val_amp_yy = vals[t, f, s, d]
+        val_phase_xx = val_phase_yy = vals_ph[t, f, s, d]
+
+    return (val_amp_xx * np.cos(val_phase_xx), val_amp_xx * np.sin(val_phase_xx),
+            val_amp_yy * np.cos(val_phase_yy), val_amp_yy * np.sin(val_phase_yy))
+
+
+def aterm_chunks(tind, get_solutions, polygons, cell_pixels, xy, imsize, nfreqs, nants,
+                 aterm_type='gain', haspol=True, smooth_pix=0, gsize_pix=0,
+                 chunk_ntimes=15, time_avg_factor=1):
+    """Generate the a-term images one chunk of times at a time
+
+    Parameters
+    ----------
+    tind : array
+        Time indices to image
+    get_solutions : function
+        Returns the (amplitude, phase) solutions for an array of time indices
+    polygons : list
+        Voronoi cells, with .index set to the direction index
+    cell_pixels : list
+        Pixel indices of each cell (as returned by np.where)
+    xy : list
+        Pixel coordinates of the directions
+    imsize : int
+        Size of the images in pixels
+    nfreqs, nants : int
+        Number of frequencies and stations
+    aterm_type : str, optional
+        One of 'tec' or 'gain'
+    haspol : bool, optional
+        If True, the gain solutions have a pol axis
+    smooth_pix : float, optional
+        Size of smoothing kernel in pixels
+    gsize_pix : float, optional
+        FWHM in pixels of Gaussian to add at patch locations
+    chunk_ntimes : int, optional
+        Number of times per chunk (a multiple of time_avg_factor)
+    time_avg_factor : int, optional
+        Averaging factor in time (gain only)
+
+    Yields
+    ------
+    data : array
+        Images of the chunk as [RA, DEC, ANTENNA, FREQ, TIME].T for tec and
+        [RA, DEC, MATRIX, ANTENNA, FREQ, TIME].T for gain
+    """
+    # Only patches inside the region of interest are used to add Gaussians
+    xy_inside = [(i, x, y) for i, (x, y) in enumerate(xy)
+                 if int(x) >= 0 and int(x) < imsize and int(y) >= 0 and int(y) < imsize]
+
+    for c_start in range(0, len(tind), chunk_ntimes):
+        chunk = tind[c_start:c_start+chunk_ntimes]
+        vals, vals_ph = get_solutions(chunk)
+
+        if aterm_type == 'tec':
+            # TEC solutions
+            # input data are [time, ant, dir, freq]
+            data = np.zeros((len(chunk), nfreqs, nants, imsize, imsize), dtype=np.float32)
+            for t in range(len(chunk)):
+                for f in range(nfreqs):
+                    for s in range(nants):
+                        for poly, ind in zip(polygons, cell_pixels):
+                            data[t, f, s, ind[0], ind[1]] = vals_ph[t, s, poly.index, 0]
+
+                        # Smooth if desired
+                        if smooth_pix > 0:
+                            data[t, f, s, :, :] = ndimage.gaussian_filter(data[t, f, s, :, :],
+                                                  sigma=(smooth_pix, smooth_pix), order=0)
+
+                        # Add Gaussians at patch positions if desired
+                        if gsize_pix > 0:
+                            for i, x, y in xy_inside:
+                                A = vals_ph[t, s, i, 0] - data[t, f, s, int(y), int(x)]
+                                data[t, f, s, :, :] += guassian_image(A, x, y, imsize, imsize, gsize_pix)
+
+        else:
+            # Gain solutions
+            # input data are [time, freq, ant, dir, pol] for slow gains (complexgain)
+            # and [time, freq, ant, dir] for fast (non-tec) phases (scalarphase)
+            # the matrix dimension has 4 elements: real XX, imaginary XX, real YY
+            # and imaginary YY
+            data = np.zeros((len(chunk), nfreqs, nants, 4, imsize, imsize), dtype=np.float32)
+            for t in range(len(chunk)):
+                for f in range(nfreqs):
+                    for s in range(nants):
+                        for poly, ind in zip(polygons, cell_pixels):
+                            matrix = gain_values(vals, vals_ph, t, f, s, poly.index, haspol)
+                            for p in range(4):
+                                data[t, f, s, p, ind[0], ind[1]] = matrix[p]
+
+                        # Smooth if desired
+                        if smooth_pix > 0:
+                            data[t, f, s, :, :, :] = ndimage.gaussian_filter(data[t, f, s, :, :, :], sigma=(0, smooth_pix, smooth_pix), order=0)
+
+                        # Add Gaussians at patch positions if desired
+                        if gsize_pix > 0:
+                            for i, x, y in xy_inside:
+                                matrix = gain_values(vals, vals_ph, t, f, s, i, haspol)
+                                for p in range(4):
+                                    A = matrix[p] - data[t, f, s, p, int(y), int(x)]
+                                    data[t, f, s, p, :, :] += guassian_image(A, x, y, imsize, imsize, gsize_pix)
+
+            # Average in time if desired (chunks are aligned to the averaging factor)
+            if time_avg_factor > 1:
+                ntimes = int(np.ceil(len(chunk) / time_avg_factor))
+                data_avg = np.empty((ntimes,) + data.shape[1:], dtype=np.float32)
+                for t in range(ntimes):
+                    data_avg[t] = np.nanmean(data[t*time_avg_factor:(t+1)*time_avg_factor], axis=0)
+                data = data_avg
+
+            # Ensure there are no NaNs in the images, as WSClean will produced uncorrected,
+            # uncleaned images if so. We replace NaNs with 1.0 and 0.0 for real and
+            # imaginary parts, respectively
+            for p in range(4):
+                nanval = 0.0 if p % 2 else 1.0
+                plane = data[:, :, :, p, :, :]
+                plane[np.isnan(plane)] = nanval
+
+        yield data
+
+
 def main(h5parmfile, soltabname='phase000', outroot='', bounds_deg=None,
          bounds_mid_deg=None, skymodel=None, solsetname='sol000',
          ressoltabname='', padding_fraction=1.4, cellsize_deg=0.1, smooth_deg=0,
-         gsize_deg=0, time_avg_factor=1, fasth5parm=None, interp_kind='nearest'):
+         gsize_deg=0, time_avg_factor=1, fasth5parm=None, interp_kind='nearest',
+         max_mem_gb=4.0):
     """
     Make a-term FITS images
 
@@ -109,6 +277,10 @@ def main(h5parmfile, soltabname='phase000', outroot='', bounds_deg=None,
     interp_kind : str, optional
         Kind of interpolation to use, if fasth5parm is given. Can be any
         supported by scipy.interpolate.interp1d
+    max_mem_gb : float, optional
+        Memory budget in GB for the images held in memory. The images are
+        made and appended to the output files in chunks of times that fit
+        in this budget
 
     Returns
     -------
@@ -158,58 +330,28 @@ def main(h5parmfile, soltabname='phase000', outroot='', bounds_deg=None,
     axis_names = soltab.getAxesNames()
     source_names = soltab.dir[:]
 
-    # Load fast-phase solutions if needed and combine with slow gains by interpolating
-    # the slow gains to the fast time grid
+    # Load fast-phase solutions if needed. The slow gains are interpolated to the
+    # fast time grid only for the chunk of times being imaged (see get_solutions())
+    vals_fast = None
     if 'amplitude' in soltab.getType() and fasth5parm is not None:
         H_fast = h5parm(fasth5parm)
         solset_fast = H_fast.getSolset('sol000')
         soltab_fast = solset_fast.getSoltab('phase000')
-        times_fast = soltab_fast.time
-        freqs_fast = soltab_fast.freq
-
-        # Interpolate the slow gains to the fast times and frequencies
-        axis_names = soltab.getAxesNames()
-        time_ind = axis_names.index('time')
-        freq_ind = axis_names.index('freq')
-        if len(times) == 1:
-            # If just a single time, we just repeat the values as needed
-            fast_axis_names = soltab_fast.getAxesNames()
-            fast_time_ind = fast_axis_names.index('time')
-            fast_freq_ind = fast_axis_names.index('freq')
-            new_shape = list(vals.shape)
-            new_shape[time_ind] = soltab_fast.val.shape[fast_time_ind]
-            new_shape[freq_ind] = soltab_fast.val.shape[fast_freq_ind]
-            vals = np.resize(vals, new_shape)
-            vals_ph = np.resize(vals, new_shape)
-        else:
-            # Interpolate (in log space for amps)
-            logvals = np.log10(vals)
-            f = si.interp1d(times, logvals, axis=time_ind, kind=interp_kind, fill_value='extrapolate')
-            logvals = f(times_fast)
-            f = si.interp1d(freqs, logvals, axis=freq_ind, kind=interp_kind, fill_value='extrapolate')
-            logvals = f(freqs_fast)
-            vals = 10**(logvals)
-            f = si.interp1d(times, vals_ph, axis=time_ind, kind=interp_kind, fill_value='extrapolate')
-            vals_ph = f(times_fast)
-            f = si.interp1d(freqs, vals_ph, axis=freq_ind, kind=interp_kind, fill_value='extrapolate')
-            vals_ph = f(freqs_fast)
-        for p in range(2):
-            vals_ph[:, :, :, :, p] += soltab_fast.val
-        freqs = freqs_fast
-        times = times_fast
+        vals_fast = soltab_fast.val
+        times_slow = times
+        freqs_slow = freqs
+        times = soltab_fast.time
+        freqs = soltab_fast.freq
 
-    # Make blank output FITS file (type does not matter at this point)
+    # Make blank output header (type does not matter at this point)
     midRA = bounds_mid_deg[0]
     midDec = bounds_mid_deg[1]
-    temp_image = outroot + '.tmp'
     imsize = (bounds_deg[3] - bounds_deg[1])  # deg
     imsize = int(imsize / cellsize_deg)  # pix
-    misc.make_template_image(temp_image, midRA, midDec, ximsize=imsize,
-                             yimsize=imsize, cellsize_deg=cellsize_deg, freqs=freqs,
-                             times=[0.0], antennas=soltab.ant, aterm_type='tec')
-    hdu = pyfits.open(temp_image, memmap=False)
-    data = hdu[0].data
-    w = wcs.WCS(hdu[0].header)
+    header = misc.make_template_header(midRA, midDec, ximsize=imsize,
+                                       yimsize=imsize, cellsize_deg=cellsize_deg, freqs=freqs,
+                                       times=[0.0], antennas=soltab.ant, aterm_type='tec')
+    w = wcs.WCS(header)
     RAind = w.axis_type_names.index('RA')
     Decind = w.axis_type_names.index('DEC')
 
@@ -263,7 +405,6 @@ def main(h5parmfile, soltabname='phase000', outroot='', bounds_deg=None,
     polygons = [poly for poly in shapely.ops.polygonize(lines)]
 
     # Index polygons to directions
-    ind = []
     for i, xypos in enumerate(xy):
         for poly in polygons:
             if poly.contains(Point(xypos)):
@@ -271,8 +412,8 @@ def main(h5parmfile, soltabname='phase000', outroot='', bounds_deg=None,
 
     # Rasterize the polygons to an array, with the value being equal to the
     # polygon's index+1
-    data_template = np.ones(data[0, 0, 0, :, :].shape)
-    data_rasertize_template = np.zeros(data[0, 0, 0, :, :].shape)
+    data_template = np.ones((imsize, imsize))
+    data_rasertize_template = np.zeros((imsize, imsize))
     for poly in polygons:
         verts_xy = poly.exterior.xy
         verts = []
@@ -282,16 +423,30 @@ def main(h5parmfile, soltabname='phase000', outroot='', bounds_deg=None,
         filled = np.where(poly_raster > 0)
         data_rasertize_template[filled] = poly_raster[filled]
 
+    # The cells do not change with time, frequency or station, so cache the pixel
+    # indices of each cell once instead of searching the template for every plane
+    cell_pixels = [np.where(data_rasertize_template == poly.index+1) for poly in polygons]
+
     # Identify any duplicate times and remove
     delta_times = times[1:] - times[:-1]  # time at center of solution interval
-    nodupind = np.where(delta_times > 0.1)
+    nodupind = np.where(delta_times > 0.1)[0]
+    times_all = times
     times = times[nodupind]
-    if 'pol' in axis_names:
-        vals = np.squeeze(vals[nodupind, :, :, :, :])
-        vals_ph = np.squeeze(vals_ph[nodupind, :, :, :, :])
-    else:
-        vals = np.squeeze(vals[nodupind, :, :, :])
-        vals_ph = np.squeeze(vals_ph[nodupind, :, :, :])
+
+    def get_solutions(tind):
+        """
+        Return the amplitudes and phases for the given (deduplicated) time indices
+        """
+        tind = nodupind[tind]
+        if vals_fast is None:
+            return vals[tind], vals_ph[tind]
+        chunk_vals = interpolate_solutions(vals, times_slow, freqs_slow, times_all[tind],
+                                           freqs, axis_names, kind=interp_kind, log=True)
+        chunk_vals_ph = interpolate_solutions(vals_ph, times_slow, freqs_slow, times_all[tind],
+                                              freqs, axis_names, kind=interp_kind)
+        for p in range(2):
+            chunk_vals_ph[:, :, :, :, p] += vals_fast[tind]
+        return chunk_vals, chunk_vals_ph
 
     # Identify any gaps in time (frequency gaps are not allowed), as we need to
     # output a separate FITS file for each time chunk
@@ -301,194 +456,51 @@ def main(h5parmfile, soltabname='phase000', outroot='', bounds_deg=None,
     gaps_ind = gaps[0] + 1
     gaps_ind = np.append(gaps_ind, np.array([len(times)]))
 
-    # Add additional breaks to gaps_ind to keep memory use within that available
-    # From experience, making a (30, 46, 62, 4, 146, 146) aterm image needs around
-    # 30 GB of memory
-    if soltab.getType() == 'tec':
-        max_ntimes = 15 * 46 * 4
+    # Images are made and written a chunk of times at a time, so the number of
+    # times per file is not limited by memory. The chunk size is set by max_mem_gb
+    # (a factor of two is allowed for the temporary arrays used in smoothing and
+    # averaging)
+    aterm_type = 'tec' if soltab.getType() == 'tec' else 'gain'
+    if aterm_type == 'tec':
+        time_avg_factor = 1
+        slot_bytes = len(freqs) * len(ants) * imsize * imsize * 4
     else:
-        max_ntimes = 15
-    # TODO: adjust max_ntimes depending on available memory and time_avg_factor
-    check_gaps = True
-    while check_gaps:
-        check_gaps = False
-        g_start = 0
-        gaps_ind_copy = gaps_ind.copy()
-        for gnum, g_stop in enumerate(gaps_ind_copy):
-            if g_stop - g_start > max_ntimes:
-                new_gap = g_start + int((g_stop - g_start) / 2)
-                gaps_ind = np.insert(gaps_ind, gnum, np.array([new_gap]))
-                check_gaps = True
-                break
-            g_start = g_stop
-
-    if soltab.getType() == 'tec':
-        # TEC solutions
-        # input data are [time, ant, dir, freq]
-        # output data are [RA, DEC, ANTENNA, FREQ, TIME].T
-        # Now loop over stations, frequencies, and times and fill in the correct
-        # values
-        outfiles = []
-        g_start = 0
-        for gnum, g_stop in enumerate(gaps_ind):
+        slot_bytes = len(freqs) * len(ants) * 4 * imsize * imsize * 4
+    chunk_ntimes = max(1, int(float(max_mem_gb) * 1024**3 / (2 * slot_bytes)))
+    chunk_ntimes = max(1, chunk_ntimes // time_avg_factor) * time_avg_factor
+
+    outfiles = []
+    g_start = 0
+    for gnum, g_stop in enumerate(gaps_ind):
+        if aterm_type == 'tec':
             outfile = '{0}_{1}.fits'.format(outroot, gnum)
-            misc.make_template_image(temp_image, midRA, midDec, ximsize=imsize,
-                                     yimsize=imsize, cellsize_deg=cellsize_deg,
-                                     times=times[g_start:g_stop],
-                                     freqs=freqs, antennas=soltab.ant,
-                                     aterm_type='tec')
-            hdu = pyfits.open(temp_image, memmap=False)
-            data = hdu[0].data
-            w = wcs.WCS(hdu[0].header)
-            for t, time in enumerate(times[g_start:g_stop]):
-                for f, freq in enumerate(freqs):
-                    for s, stat in enumerate(ants):
-                        for poly in polygons:
-                            ind = np.where(data_rasertize_template == poly.index+1)
-                            data[t, f, s, ind[0], ind[1]] = vals[t+g_start, s, poly.index, 0]
-
-                        # Smooth if desired
-                        if smooth_pix > 0:
-                            data[t, f, s, :, :] = ndimage.gaussian_filter(data[t, f, s, :, :],
-                                                  sigma=(smooth_pix, smooth_pix), order=0)
-
-                        # Add Gaussians at patch positions if desired
-                        if gsize_pix > 0:
-                            for i, (x, y) in enumerate(xy):
-                                # Only do this if patch is inside the region of interest
-                                if int(x) >= 0 and int(x) < data.shape[4] and int(y) >= 0 and int(y) < data.shape[3]:
-                                    A = vals[t+g_start, s, i, 0] - data[t, f, s, int(y), int(x)]
-                                    data[t, f, s, :, :] += guassian_image(A, x, y, data.shape[4],
-                                                                          data.shape[3], gsize_pix)
-            g_start = g_stop
-
-            # Write FITS file
-            hdu[0].data = data
-            hdu.writeto(outfile, overwrite=True)
-            outfiles.append(outfile)
-            os.remove(temp_image)
-
-        outfile = open(outroot+'.txt', 'w')
-        outfile.writelines([o+'\n' for o in outfiles])
-        outfile.close()
-
-    else:
-        # Gain solutions
-        # input data are [time, freq, ant, dir, pol] for slow gains (complexgain)
-        # and [time, freq, ant, dir] for fast (non-tec) phases (scalarphase)
-        # output data are [RA, DEC, MATRIX, ANTENNA, FREQ, TIME].T
-        # Now loop over stations, frequencies, and times and fill in the correct
-        # matrix values (matrix dimension has 4 elements: real XX, imaginary XX,
-        # real YY and imaginary YY)
-        outfiles = []
-        g_start = 0
-        for gnum, g_stop in enumerate(gaps_ind):
+        else:
             outfile = '{0}_{1:04}.fits'.format(outroot, gnum)
-            misc.make_template_image(temp_image, midRA, midDec, ximsize=imsize,
-                                     yimsize=imsize, cellsize_deg=cellsize_deg,
-                                     times=times[g_start:g_stop],
-                                     freqs=freqs, antennas=soltab.ant,
-                                     aterm_type='gain')
-            hdu = pyfits.open(temp_image, memmap=False)
-            data = hdu[0].data
-            w = wcs.WCS(hdu[0].header)
-            for t, time in enumerate(times[g_start:g_stop]):
-                for f, freq in enumerate(freqs):
-                    for s, stat in enumerate(ants):
-                        for p, poly in enumerate(polygons):
-                            ind = np.where(data_rasertize_template == poly.index+1)
-                            if 'pol' in axis_names:
-                                val_amp_xx = vals[t+g_start, f, s, poly.index, 0]
-                                val_amp_yy = vals[t+g_start, f, s, poly.index, 1]
-                                val_phase_xx = vals_ph[t+g_start, f, s, poly.index, 0]
-                                val_phase_yy = vals_ph[t+g_start, f, s, poly.index, 1]
-                            else:
-                                val_amp_xx = vals[t+g_start, f, s, poly.index]
-                                val_amp_yy = vals[t+g_start, f, s, poly.index]
-                                val_phase_xx = vals_ph[t+g_start, f, s, poly.index]
-                                val_phase_yy = vals_ph[t+g_start, f, s, poly.index]
-                            data[t, f, s, 0, ind[0], ind[1]] = val_amp_xx * np.cos(val_phase_xx)
-                            data[t, f, s, 2, ind[0], ind[1]] = val_amp_yy * np.cos(val_phase_yy)
-                            data[t, f, s, 1, ind[0], ind[1]] = val_amp_xx * np.sin(val_phase_xx)
-                            data[t, f, s, 3, ind[0], ind[1]] = val_amp_yy * np.sin(val_phase_yy)
-
-                        # Smooth if desired
-                        if smooth_pix > 0:
-                            data[t, f, s, :, :, :] = ndimage.gaussian_filter(data[t, f, s, :, :, :], sigma=(0, smooth_pix, smooth_pix), order=0)
-
-                        # Add Gaussians at patch positions if desired
-                        if gsize_pix > 0:
-                            for i, (x, y) in enumerate(xy):
-                                # Only do this if patch is inside the region of interest
-                                if int(x) >= 0 and int(x) < data.shape[4] and int(y) >= 0 and int(y) < data.shape[3]:
-                                    if 'pol' in axis_names:
-                                        val_amp_xx = vals[t+g_start, f, s, i, 0]
-                                        val_amp_yy = vals[t+g_start, f, s, i, 1]
-                                        val_phase_xx = vals_ph[t+g_start, f, s, i, 0]
-                                        val_phase_yy = vals_ph[t+g_start, f, s, i, 1]
-                                    else:
-                                        val_amp_xx = vals[t+g_start, f, s, i]
-                                        val_amp_yy = vals[t+g_start, f, s, i]
-                                        val_phase_xx = vals_ph[t+g_start, f, s, i]
-                                        val_phase_yy = vals_ph[t+g_start, f, s, i]
-                                    A = val_amp_xx * np.cos(val_phase_xx) - data[t, f, s, 0, int(y), int(x)]
-                                    data[t, f, s, 0, :, :] += guassian_image(A, x, y, data.shape[5], data.shape[4], gsize_pix)
-                                    A = val_amp_yy * np.cos(val_phase_yy) - data[t, f, s, 2, int(y), int(x)]
-                                    data[t, f, s, 2, :, :] += guassian_image(A, x, y, data.shape[5], data.shape[4], gsize_pix)
-                                    A = val_amp_xx * np.sin(val_phase_xx) - data[t, f, s, 1, int(y), int(x)]
-                                    data[t, f, s, 1, :, :] += guassian_image(A, x, y, data.shape[5], data.shape[4], gsize_pix)
-                                    A = val_amp_yy * np.sin(val_phase_yy) - data[t, f, s, 3, int(y), int(x)]
-                                    data[t, f, s, 3, :, :] += guassian_image(A, x, y, data.shape[5], data.shape[4], gsize_pix)
-
-            # If averaging in time, make a new template image with
-            # fewer times and write to that instead
-            if time_avg_factor > 1:
-                times_avg = times[g_start:g_stop:time_avg_factor]
-                ntimes = len(times_avg)
-                misc.make_template_image(temp_image+'.avg', midRA, midDec, ximsize=imsize,
-                                         yimsize=imsize, cellsize_deg=cellsize_deg,
-                                         times=times_avg,
-                                         freqs=freqs, antennas=soltab.ant,
-                                         aterm_type='gain')
-                hdu = pyfits.open(temp_image+'.avg', memmap=False)
-                data_avg = hdu[0].data
-
-                # Average
-                for t, time in enumerate(times_avg):
-                    incr = min(time_avg_factor, len(times[g_start:g_stop])-t*time_avg_factor)
-                    data_avg[t, :, :, :, :, :] = np.nanmean(data[t:t+incr, :, :, :, :, :], axis=0)
-                data = data_avg
-            else:
-                ntimes = len(times[g_start:g_stop])
-
-            # Ensure there are no NaNs in the images, as WSClean will produced uncorrected,
-            # uncleaned images if so. We replace NaNs with 1.0 and 0.0 for real and
-            # imaginary parts, respectively
-            # Note: we iterate over time to reduce memory usage
-            for t in range(ntimes):
-                for p in range(4):
-                    if p % 2:
-                        # Imaginary elements
-                        nanval = 0.0
-                    else:
-                        # Real elements
-                        nanval = 1.0
-                    data[t, :, :, p, :, :][np.isnan(data[t, :, :, p, :, :])] = nanval
-
-            # Write FITS file
-            hdu[0].data = data
-            hdu.writeto(outfile, overwrite=True)
-            outfiles.append(outfile)
-            os.remove(temp_image)
-            hdu = None
-            data = None
-
-            # Update start time index
-            g_start = g_stop
-
-        outfile = open(outroot+'.txt', 'w')
-        outfile.writelines([o+'\n' for o in outfiles])
-        outfile.close()
+        header = misc.make_template_header(midRA, midDec, ximsize=imsize,
+                                           yimsize=imsize, cellsize_deg=cellsize_deg,
+                                           times=times[g_start:g_stop:time_avg_factor],
+                                           freqs=freqs, antennas=soltab.ant,
+                                           aterm_type=aterm_type)
+
+        # StreamingHDU would append a new HDU to an existing file
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        hdu = pyfits.StreamingHDU(outfile, header)
+        for data in aterm_chunks(np.arange(g_start, g_stop), get_solutions, polygons,
+                                 cell_pixels, xy, imsize, len(freqs), len(ants),
+                                 aterm_type=aterm_type, haspol=('pol' in axis_names),
+                                 smooth_pix=smooth_pix, gsize_pix=gsize_pix,
+                                 chunk_ntimes=chunk_ntimes, time_avg_factor=time_avg_factor):
+            hdu.write(data)
+        hdu.close()
+        outfiles.append(outfile)
+
+        # Update start time index
+        g_start = g_stop
+
+    outfile = open(outroot+'.txt', 'w')
+    outfile.writelines([o+'\n' for o in outfiles])
+    outfile.close()
 
 
 if __name__ == '__main__':
@@ -509,6 +521,7 @@ if __name__ == '__main__':
     parser.add_argument('--gsize_deg', help='Gaussian size in degree', type=float, default=0.0)
     parser.add_argument('--time_avg_factor', help='Averaging factor', type=int, default=1)
     parser.add_argument('--fasth5parm', help='Filename of input fast h5parm', type=str, default=None)
+    parser.add_argument('--max_mem_gb', help='Memory budget for the images in GB', type=float, default=4.0)
     args = parser.parse_args()
     main(args.h5parmfile, soltabname=args.soltabname, outroot=args.outroot,
          bounds_deg=args.bounds_deg, bounds_mid_deg=args.bounds_mid_deg,
@@ -516,4 +529,4 @@ if __name__ == '__main__':
          ressoltabname=args.ressoltabname, padding_fraction=args.padding_fraction,
          cellsize_deg=args.cellsize_deg, smooth_deg=args.smooth_deg,
          gsize_deg=args.gsize_deg, time_avg_factor=args.time_avg_factor,
-         fasth5parm=args.fasth5parm)
+         fasth5parm=args.fasth5parm, max_mem_gb=args.max_mem_gb)
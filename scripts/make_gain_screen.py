@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
 import os, sys, optparse
+import multiprocessing
 import numpy as np
-from scipy.interpolate import Rbf
+from scipy.linalg import lu_factor, lu_solve
 import matplotlib.pyplot as plt
 from matplotlib.pyplot import figure
 from astropy.io import fits
@@ -30,14 +31,46 @@ def plot_screen(img, prefix='', title='', suffix='', wcs=None):
     del fig
 
 
+def rbf_operator(X, Y, size):
+    ''' Precompute the radial basis function interpolation operator from the nodes (X, Y) to the size x size grid.
+
+    This is the same interpolation done by scipy.interpolate.Rbf(X, Y, g, smooth=0.0) (multiquadric kernel with the default epsilon),
+    but the kernel matrix is factorized once and the grid-to-node kernel evaluation is applied as a single matrix,
+    so that screen = operator.dot(g) for any set of nodal values g.
+
+    Args:
+        X, Y (ndarray): pixel coordinates of the nodes (directions).
+        size (int): size of the screen in pixels.
+
+    Returns:
+        operator (ndarray): (size*size, ndir) matrix.
+    '''
+    nodes = np.asarray([X, Y], dtype=np.float64)
+    # default epsilon of Rbf: "average distance between nodes" based on the bounding box
+    edges = np.amax(nodes, axis=1) - np.amin(nodes, axis=1)
+    edges = edges[np.nonzero(edges)]
+    epsilon = np.power(np.prod(edges)/nodes.shape[1], 1.0/edges.size)
+    multiquadric = lambda r: np.sqrt((r/epsilon)**2 + 1)
+
+    # kernel matrix between nodes, factorized once
+    A = multiquadric(np.hypot(nodes[0][:, np.newaxis] - nodes[0], nodes[1][:, np.newaxis] - nodes[1]))
+    lu_piv = lu_factor(A)
+
+    # kernel between grid and nodes: E.dot(A^-1) = (A^-T.dot(E^T))^T
+    yy, xx = np.mgrid[0:size, 0:size]
+    E = multiquadric(np.hypot(xx.reshape(-1, 1) - nodes[0], yy.reshape(-1, 1) - nodes[1]))
+    return lu_solve(lu_piv, E.T, trans=1).T
+
+
 # Interpolate the grid using a nearest neighbour approach.
 # https://stackoverflow.com/questions/5551286/filling-gaps-in-a-numpy-array
-def interpolate_station(antname, ifstep, h5_stations, size, data, wcs, RA, DEC, gains, names):
+def interpolate_station(antname, ifstep, h5_stations, size, data, wcs, RA, DEC, gains, names, operator=None):
     ''' Interpolate the solutions of a given antenna into a smooth screen using radial basis function interpolation.
 
     Args:
         antname (str): name of the antenna to interpolate.
         ifstep (int): index of the frequency slot to be interpolated.
+        operator (ndarray): interpolation operator from rbf_operator(), computed if not given.
 
     Returns:
         antindex (int): index of the antenna being processed.
@@ -45,33 +78,25 @@ def interpolate_station(antname, ifstep, h5_stations, size, data, wcs, RA, DEC,
     '''
     # print('Processing antenna {:s}.'.format(antname))
     interpidx = h5_stations.index(antname)
-    # These will be the new coordinates to evaluate the screen over.
-    x = np.arange(size)
-    y = np.arange(size)
-    xx, yy = np.meshgrid(x, y)
-    # Do radial basis function interpolation for each time step.
-    # First axis of data is time.
-    screen = np.empty((data.shape[0], 1, 1, 4, size, size))
     X, Y = np.around(wcs.wcs_world2pix(RA, DEC, 0)).astype(int)
+    if operator is None:
+        operator = rbf_operator(X, Y, size)
     # data has shape (time, freq, ant, matrix, y, x)
     # gains has shape (time, freq, ant, dir, pol)
-    # Iterate over all timeslots.
-    for itstep in range(data.shape[0]):
-        # Interpolate the gains, not the Re/Im or Amp/Phase separately.
-        # gains: ['time', 'freq', 'ant', 'dir', 'pol']
-        gXX = gains[itstep, ifstep, interpidx, :, 0]
-        gYY = gains[itstep, ifstep, interpidx, :, -1]
-        rbfXX = Rbf(X, Y, gXX, smooth=0.0)
-        rbfYY = Rbf(X, Y, gYY, smooth=0.0)
-        tinterpXX = rbfXX(xx, yy)
-        tinterpYY = rbfYY(xx, yy)
-        if not np.allclose(tinterpXX[Y, X], gXX, rtol=1e-5):
-            raise ValueError('Interpolated screen for polarization XX does not go through nodal points.')
-        if not np.allclose(tinterpYY[Y, X], gYY, rtol=1e-5):
-            raise ValueError('Interpolated screen for polarization YY does not go through nodal points.')
-        del gXX, gYY
-        matrix = np.asarray([np.real(tinterpXX), np.imag(tinterpXX), np.real(tinterpYY), np.imag(tinterpYY)])
-        screen[itstep, 0, 0, :, :, :] = matrix
+    # Interpolate the gains, not the Re/Im or Amp/Phase separately, all timeslots and XX/YY at once.
+    g = gains[:, ifstep, interpidx, :, :][..., [0, -1]] # time, dir, pol
+    ntimes, ndir = g.shape[0], g.shape[1]
+    tinterp = operator.dot(np.moveaxis(g, 1, 0).reshape(ndir, -1)) # (y*x, time*pol)
+    tinterp = np.moveaxis(tinterp.reshape(size, size, ntimes, 2), (2, 3), (0, 1)) # time, pol, y, x
+    if not np.allclose(tinterp[:, 0, Y, X], g[..., 0], rtol=1e-5):
+        raise ValueError('Interpolated screen for polarization XX does not go through nodal points.')
+    if not np.allclose(tinterp[:, 1, Y, X], g[..., 1], rtol=1e-5):
+        raise ValueError('Interpolated screen for polarization YY does not go through nodal points.')
+    screen = np.empty((ntimes, 1, 1, 4, size, size))
+    screen[:, 0, 0, 0] = np.real(tinterp[:, 0])
+    screen[:, 0, 0, 1] = np.imag(tinterp[:, 0])
+    screen[:, 0, 0, 2] = np.real(tinterp[:, 1])
+    screen[:, 0, 0, 3] = np.imag(tinterp[:, 1])
     '''
     didx = directions.index('P470')
     fig = figure()
@@ -106,12 +131,64 @@ def interpolate_station(antname, ifstep, h5_stations, size, data, wcs, RA, DEC,
     '''
     return names.index(antname), screen
 
+def create_fits_memmap(filename, header, shape, dtype, overwrite=False):
+    ''' Write the header of a FITS file with a preallocated data section and return it as a writable memory map.
+
+    Args:
+        filename (str): output FITS file.
+        header (Header): header, NAXIS and BITPIX are set from shape and dtype.
+        shape (tuple): data shape (numpy order).
+        dtype: np.float32 or np.float64.
+
+    Returns:
+        data (memmap): memory map of the data section (big endian, as FITS).
+    '''
+    if os.path.exists(filename):
+        if overwrite: os.remove(filename)
+        else: raise OSError('File {:s} already exists.'.format(filename))
+    dtype = np.dtype(dtype).newbyteorder('>')
+    header = header.copy()
+    header['BITPIX'] = -8*dtype.itemsize
+    header['NAXIS'] = len(shape)
+    for i, n in enumerate(shape[::-1]):
+        key = 'NAXIS{:d}'.format(i+1)
+        if key in header: header[key] = n
+        else: header.insert('NAXIS{:d}'.format(i) if i > 0 else 'NAXIS', (key, n), after=True)
+    header_bytes = header.tostring().encode()
+    nbytes = int(np.prod(shape))*dtype.itemsize
+    with open(filename, 'wb') as f:
+        f.write(header_bytes)
+        # data is padded to a multiple of 2880 bytes (sparse file, not actually written)
+        f.seek(len(header_bytes) + int(np.ceil(nbytes/2880.))*2880 - 1)
+        f.write(b'\0')
+    return np.memmap(filename, dtype=dtype, mode='r+', offset=len(header_bytes), shape=shape)
+
+
+# shared with the worker processes (set by _init_screen_worker)
+_screen_worker_args = {}
+
+def _init_screen_worker(filename, offset, shape, dtype, kwargs):
+    _screen_worker_args.update(kwargs)
+    _screen_worker_args['out'] = np.memmap(filename, dtype=dtype, mode='r+', offset=offset, shape=shape)
+
+def _screen_worker(ifreq, station):
+    ''' Interpolate one antenna/frequency and write it directly in the output memory map. '''
+    a = _screen_worker_args
+    antenna, screen = interpolate_station(station, ifreq, a['h5_stations'], a['size'], None, a['wcs'], a['RA'], a['DEC'],
+                                          a['gains'], a['names'], a['operator'])
+    a['out'][:, ifreq, antenna, :, :, :] = screen[:, 0, 0, ...]
+    a['out'].flush()
+    return ifreq, station
+
+
 def main(options):
 
     size = options.size
     ms = options.ms
     h5p = options.h5parm
     output = options.output
+    ncpu = options.ncpu
+    dtype_out = np.float32 if options.float32 else np.float64
     
     with ct.taql('SELECT NAME FROM {ms:s}::ANTENNA'.format(ms=ms)) as t:
         names = t.getcol('NAME')
@@ -183,7 +260,8 @@ CDELT6  = {dtime:f}'''.format(size=size, centerpix=int(round(size/2)), pixelsize
     # FITS is transposed compared to Numpy.
     # 4 is the "matrix" entry containing Re(XX), Im(XX), Re(YY), Im(YY)
     print (Ntimes, Nfreqs, Nantenna, 4, size, size)
-    data = np.empty((Ntimes, Nfreqs, Nantenna, 4, size, size), dtype=np.float32)
+    data = create_fits_memmap(output+'_raw.fits', fits.Header.fromstring(header, sep='\n'),
+                              (Ntimes, Nfreqs, Nantenna, 4, size, size), np.float32, overwrite=True)
     
     # Read in h5parm.
     h5 = h5parm.h5parm(h5p)
@@ -245,24 +323,31 @@ CDELT6  = {dtime:f}'''.format(size=size, centerpix=int(round(size/2)), pixelsize
             data[:, :, istation, :, Y, X] = matrix[:, :, idx, :, diridx]
             del matrix
     
-    hdu = fits.PrimaryHDU(header=H)
-    hdu.data = data
-    hdu.writeto(output+'_raw.fits', overwrite=True)
+    data.flush()
     RA = np.asarray(RA)
     DEC = np.asarray(DEC)
     
     # Inspired by https://stackoverflow.com/questions/38309535/populate-numpy-array-through-concurrent-futures-multiprocessing
-    data_int = np.empty(data.shape)
+    # each (frequency, antenna) screen is written directly in the preallocated output file
+    data_int = create_fits_memmap(output+'_rbf.fits', H, data.shape, dtype_out)
     print('Making Gain screen.')
-    for ifreq in range(data.shape[1]):
-        print('Processing frequency slot {:d}'.format(ifreq))
-        for station in names:
-            antenna, screen = interpolate_station(station, ifreq, h5_stations, size, data, wcs, RA, DEC, gains, names)
-            data_int[:, ifreq, antenna, :, :, :] = screen[:, 0, 0, ...]
-    
-    hdu = fits.PrimaryHDU(header=H)
-    hdu.data = data_int
-    hdu.writeto(output+'_rbf.fits')
+    # the nodes are the same for all times, frequencies and antennas
+    X, Y = np.around(wcs.wcs_world2pix(RA, DEC, 0)).astype(int)
+    operator = rbf_operator(X, Y, size)
+    worker_args = (data_int.filename, data_int.offset, data_int.shape, data_int.dtype,
+                   dict(h5_stations=h5_stations, size=size, wcs=wcs, RA=RA, DEC=DEC, gains=gains, names=names, operator=operator))
+    del data_int
+    tasks = [(ifreq, station) for ifreq in range(data.shape[1]) for station in names]
+    if ncpu > 1:
+        with multiprocessing.get_context('fork').Pool(ncpu, initializer=_init_screen_worker, initargs=worker_args) as pool:
+            for ifreq, station in pool.starmap(_screen_worker, tasks):
+                print('Processed frequency slot {:d} antenna {:s}'.format(ifreq, station))
+    else:
+        _init_screen_worker(*worker_args)
+        for ifreq, station in tasks:
+            _screen_worker(ifreq, station)
+            print('Processed frequency slot {:d} antenna {:s}'.format(ifreq, station))
+        _screen_worker_args.clear()
     print('Finished interpolating.')
 
 opt = optparse.OptionParser()
@@ -270,5 +355,7 @@ opt.add_option('-m','--ms',help='Input MS [no default].',default='')
 opt.add_option('-p','--h5parm',help='Input h5parm [no default].',default='')
 opt.add_option('-s','--size', type=int, help='Size of the output screen in pixels [default: 256].',default=256)
 opt.add_option('-o','--output',help='Output root name [default: output].',default='output')
+opt.add_option('-n','--ncpu', type=int, help='Number of processes used to make the screens [default: 1].',default=1)
+opt.add_option('--float32', action='store_true', help='Write the interpolated screens as float32 instead of float64 [default: False].',default=False)
 options, arguments = opt.parse_args()
 main(options)
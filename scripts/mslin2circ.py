@@ -21,7 +21,6 @@ import optparse
 import numpy
 import sys
 import casacore.tables as pt
-from casacore.quanta import quantity
 
 def checkfile(inms):
   if inms == '':
@@ -148,6 +147,7 @@ def updatehistory(outms):
   """
   Update history to show that this script has modified original data
   """
+  from casacore.quanta import quantity
   tc = pt.table(outms,readonly=False)
   th = pt.table(tc.getkeyword('HISTORY'), readonly=False, ack=False)
   nr=th.nrows()
@@ -156,39 +156,48 @@ def updatehistory(outms):
   tr.put(nr,{'TIME': quantity('today').get('s').get_value(), 'OBSERVATION_ID':0,'MESSAGE': ' ', 'PRIORITY': ' ', 'ORIGIN': ' ','OBJECT_ID':0, 'APPLICATION':'mslin2circ','CLI_COMMAND':[''],'APP_PARAMS': ['']})
 
 
-opt = optparse.OptionParser()
-opt.add_option('-i','--inms',help='Input MS (format: ms:COLUMN, default column: DATA)',default='')
-opt.add_option('-o','--outms',help='Output MS (format: ms:COLUMN, default ms: InputMS, default column: DATA)',default='')
-opt.add_option('-r','--reverse',action="store_true",default=False,help='Convert from circular to linear')
-opt.add_option('-s','--skipmetadata',action="store_true",default=False,help='Skip setting the metadata correctly')
-opt.add_option('-w','--weights',action="store_true",default=False,help='Weights are updated to reflect the combined polarization (cannot be undone with -r)')
-options, arguments = opt.parse_args()
-
-if options.outms == '':
-    options.outms = options.inms.split(':')[0]
-
-if len( options.inms.split(':') ) == 2:
-    incolumn = options.inms.split(':')[1]
-else:
-    incolumn = 'DATA'
-
-if len( options.outms.split(':') ) == 2:
-    outcolumn = options.outms.split(':')[1]
-else:
-    outcolumn = 'DATA'
-
-inms = options.inms.split(':')[0]
-outms = options.outms.split(':')[0]
-checkfile(inms)
-outms = setupiofiles(inms, outms, incolumn, outcolumn)
-
-print("INFO: inms: "+inms+" (column: "+incolumn+")")
-print("INFO: outms: "+outms+" (column: "+outcolumn+")")
-
-if options.reverse == True:
-   mscirc2lin(incolumn, outcolumn, outms, options.skipmetadata)
-else:
-   mslin2circ(incolumn, outcolumn, outms, options.skipmetadata)
-if options.weights: mergeweights(outms)
-mergeflags(outms)
-updatehistory(outms)
+def main(argv=None):
+    """
+    Run as from the command line, argv: list of arguments (default: sys.argv[1:])
+    """
+    global options # used by checkfile()
+
+    opt = optparse.OptionParser()
+    opt.add_option('-i','--inms',help='Input MS (format: ms:COLUMN, default column: DATA)',default='')
+    opt.add_option('-o','--outms',help='Output MS (format: ms:COLUMN, default ms: InputMS, default column: DATA)',default='')
+    opt.add_option('-r','--reverse',action="store_true",default=False,help='Convert from circular to linear')
+    opt.add_option('-s','--skipmetadata',action="store_true",default=False,help='Skip setting the metadata correctly')
+    opt.add_option('-w','--weights',action="store_true",default=False,help='Weights are updated to reflect the combined polarization (cannot be undone with -r)')
+    options, arguments = opt.parse_args(argv)
+
+    if options.outms == '':
+        options.outms = options.inms.split(':')[0]
+
+    if len( options.inms.split(':') ) == 2:
+        incolumn = options.inms.split(':')[1]
+    else:
+        incolumn = 'DATA'
+
+    if len( options.outms.split(':') ) == 2:
+        outcolumn = options.outms.split(':')[1]
+    else:
+        outcolumn = 'DATA'
+
+    inms = options.inms.split(':')[0]
+    outms = options.outms.split(':')[0]
+    checkfile(inms)
+    outms = setupiofiles(inms, outms, incolumn, outcolumn)
+
+    print("INFO: inms: "+inms+" (column: "+incolumn+")")
+    print("INFO: outms: "+outms+" (column: "+outcolumn+")")
+
+    if options.reverse == True:
+       mscirc2lin(incolumn, outcolumn, outms, options.skipmetadata)
+    else:
+       mslin2circ(incolumn, outcolumn, outms, options.skipmetadata)
+    if options.weights: mergeweights(outms)
+    mergeflags(outms)
+    updatehistory(outms)
+
+if __name__=='__main__':
+    main()
@@ -26,9 +26,6 @@
 import os, sys, logging, time
 import numpy as np
 from casacore.tables import taql, table
-import matplotlib as mpl
-mpl.use("Agg")
-import matplotlib.pyplot as plt
 
 class Timer(object):
     """
@@ -47,13 +44,13 @@ class Timer(object):
     def __enter__(self):
         self.log.debug("--> Starting \'" + self.step + "\'.")
         self.start = time.time()
-        self.startcpu = time.clock()
+        self.startcpu = time.process_time()
 
     def __exit__(self, exit_type, value, tb):
 
         # if not an error
         if exit_type is None:
-            self.log.debug("<-- Time for %s step: %i s (cpu: %i s)." % ( self.step, ( time.time() - self.start), (time.clock() - self.startcpu) ))
+            self.log.debug("<-- Time for %s step: %i s (cpu: %i s)." % ( self.step, ( time.time() - self.start), (time.process_time() - self.startcpu) ))
 
 
 class MShandler():
@@ -210,6 +207,10 @@ def reweight(MSh, mode):
         ms_bl.flush()
 
 def plot(MSh, antennas):
+    # matplotlib is slow to import, load it only when plotting
+    import matplotlib as mpl
+    mpl.use("Agg")
+    import matplotlib.pyplot as plt
 
     if antennas is not None:
         for antenna in antennas:
@@ -396,7 +397,7 @@ def plot(MSh, antennas):
         fig.savefig(imagename, bbox_inches='tight', additional_artists=leg, dpi=250)
         fig.clf()
 
-def readArguments():
+def readArguments(argv=None):
     import argparse
     parser=argparse.ArgumentParser("Plot/Update weights for LOFAR")
     parser.add_argument("-v", "--verbose", help="Be verbose. Default is False", required=False, action="store_true")
@@ -406,13 +407,16 @@ def readArguments():
     parser.add_argument("-w", "--wcolname", type=str, help="Name of the weights column. Default: WEIGHT_SPECTRUM.", required=False, default="WEIGHT_SPECTRUM")
     parser.add_argument("-a", "--antennas", type=str, help="List of antennas to plot (comma separated). Default: all antennas", required=False, default=None)
     parser.add_argument("ms_files", type=str, help="MeasurementSet name(s).", nargs="+")
-    args=parser.parse_args()
+    args=parser.parse_args(argv)
     return vars(args)
 
-if __name__=="__main__":
+def main(argv=None):
+    """
+    Run as from the command line, argv: list of arguments (default: sys.argv[1:])
+    """
     start_time = time.time()
 
-    args         = readArguments()
+    args         = readArguments(argv)
     verbose      = args["verbose"]
     do_plot      = args["plot"]
     mode         = args["mode"]
@@ -449,3 +453,6 @@ if __name__=="__main__":
         plot(MSh, antennas)
 
     logging.debug('Running time %.0f s' % (time.time()-start_time))
+
+if __name__=="__main__":
+    main()
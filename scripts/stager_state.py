@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# Journaled state store for LOFAR_stager.py
+#
+# Every surl is a row of a local SQLite database with one of the states:
+# to_stage -> staging -> to_download -> downloading -> to_verify -> verifying -> done
+# or failed, for surls which did not come online after max_attempts staging requests
+# Transitions are atomic (compare-and-set on the current state) so the stager, checker
+# and downloader processes can share the store, and a restart resumes exactly where
+# the previous run stopped.
+
+import os, sqlite3
+
+STATES = ('to_stage', 'staging', 'to_download', 'downloading', 'to_verify', 'verifying', 'done', 'failed')
+
+class StateStore(object):
+    """
+    SQLite-backed state of the surls handled by the stager.
+    Each process opens its own connection on first use, so the object can be passed to
+    multiprocessing workers.
+    """
+    def __init__(self, filename='stager.sqlite', max_attempts=3):
+        """
+        max_attempts: number of staging requests after which a surl which never came online is marked failed
+        """
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self._conn = None
+        self._pid = None
+        with self.transaction() as c:
+            c.execute('CREATE TABLE IF NOT EXISTS surls (surl TEXT PRIMARY KEY, state TEXT NOT NULL, sid INTEGER, '
+                      'attempts INTEGER NOT NULL DEFAULT 0)')
+            # stores created before the attempt counter
+            if 'attempts' not in [r[1] for r in c.execute('PRAGMA table_info(surls)')]:
+                c.execute('ALTER TABLE surls ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            c.execute('CREATE INDEX IF NOT EXISTS surls_state ON surls (state)')
+            c.execute('CREATE INDEX IF NOT EXISTS surls_sid ON surls (sid)')
+            c.execute('CREATE TABLE IF NOT EXISTS sids (sid INTEGER PRIMARY KEY)')
+
+    @property
+    def conn(self):
+        # connections cannot be shared across a fork
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.filename, timeout=600, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._pid = os.getpid()
+        return self._conn
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'max_attempts': self.max_attempts, '_conn': None, '_pid': None}
+
+    def transaction(self):
+        return _Transaction(self.conn)
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM surls').fetchone()[0]
+
+    def add(self, surls, state='to_stage'):
+        """
+        Add new surls (already known surls are left untouched)
+        """
+        with self.transaction() as c:
+            c.executemany('INSERT OR IGNORE INTO surls (surl, state) VALUES (?, ?)', [(surl, state) for surl in surls])
+
+    def set_state(self, surls, state):
+        """
+        Force the state of some surls
+        """
+        with self.transaction() as c:
+            c.executemany('UPDATE surls SET state=?, sid=NULL WHERE surl=?', [(state, surl) for surl in surls])
+
+    def get(self, state, limit=-1):
+        """
+        Return the surls in a state
+        """
+        return [r[0] for r in self.conn.execute('SELECT surl FROM surls WHERE state=? ORDER BY surl LIMIT ?', (state, limit))]
+
+    def count(self, state):
+        return self.conn.execute('SELECT COUNT(*) FROM surls WHERE state=?', (state,)).fetchone()[0]
+
+    def counts(self):
+        """
+        Return a dict with the number of surls per state and the number of active staging requests
+        """
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.conn.execute('SELECT state, COUNT(*) FROM surls GROUP BY state').fetchall())
+        counts['sids'] = self.conn.execute('SELECT COUNT(*) FROM sids').fetchone()[0]
+        return counts
+
+    def transition(self, surl, state_from, state_to):
+        """
+        Atomically move a surl from state_from to state_to.
+        Return True if the surl was in state_from.
+        """
+        with self.transaction() as c:
+            return c.execute('UPDATE surls SET state=? WHERE surl=? AND state=?', (state_to, surl, state_from)).rowcount == 1
+
+    def claim(self, state_from, state_to):
+        """
+        Atomically take one surl in state_from and move it to state_to.
+        Return the surl or None if there are none.
+        """
+        with self.transaction() as c:
+            r = c.execute('SELECT surl FROM surls WHERE state=? LIMIT 1', (state_from,)).fetchone()
+            if r is None: return None
+            c.execute('UPDATE surls SET state=? WHERE surl=?', (state_to, r[0]))
+            return r[0]
+
+    ### staging requests
+    def sids(self):
+        return [r[0] for r in self.conn.execute('SELECT sid FROM sids')]
+
+    def start_staging(self, surls, sid):
+        """
+        Record that surls waiting to be staged are being staged by the request sid.
+        Return the number of surls affected.
+        """
+        with self.transaction() as c:
+            n = c.executemany('UPDATE surls SET state=\'staging\', sid=?, attempts=attempts+1 WHERE surl=? AND state=\'to_stage\'',
+                              [(sid, surl) for surl in surls]).rowcount
+            if n > 0:
+                c.execute('INSERT OR IGNORE INTO sids (sid) VALUES (?)', (sid,))
+            return n
+
+    def set_online(self, surl):
+        """
+        A staged surl is ready to be downloaded. Unknown surls (e.g. of old staging requests)
+        and surls already downloading/downloaded are ignored.
+        Return True if the surl was moved to to_download.
+        """
+        with self.transaction() as c:
+            return c.execute('UPDATE surls SET state=\'to_download\' WHERE surl=? AND state IN (\'to_stage\', \'staging\')',
+                             (surl,)).rowcount == 1
+
+    def finish_staging(self, sid):
+        """
+        The staging request sid is completed: surls of that request which never came online
+        are put back to be staged again, or marked failed after max_attempts requests.
+        Return the number of (resubmitted, failed) surls.
+        """
+        with self.transaction() as c:
+            c.execute('DELETE FROM sids WHERE sid=?', (sid,))
+            failed = c.execute('UPDATE surls SET state=\'failed\', sid=NULL WHERE sid=? AND state=\'staging\' AND attempts>=?',
+                               (sid, self.max_attempts)).rowcount
+            resubmitted = c.execute('UPDATE surls SET state=\'to_stage\', sid=NULL WHERE sid=? AND state=\'staging\'', (sid,)).rowcount
+            return resubmitted, failed
+
+    def recover(self):
+        """
+        After a crash/restart, interrupted downloads and verifications are started again.
+        Return the number of recovered surls.
+        """
+        with self.transaction() as c:
+            return c.execute('UPDATE surls SET state=\'to_download\' WHERE state=\'downloading\'').rowcount + \
+                   c.execute('UPDATE surls SET state=\'to_verify\' WHERE state=\'verifying\'').rowcount
+
+class _Transaction(object):
+    """
+    Context manager for an immediate (write-locking) transaction
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
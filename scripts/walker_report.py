@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# report on the time and resources used by the steps of a pipeline, from the history kept by lib_util.Walker
+# e.g.: walker_report.py pipeline-cal.walker --baseline 3
+
+import os, sys, time, sqlite3
+
+def fmt_time(s):
+    if s is None: return '-'
+    if s < 60: return '%.1fs' % s
+    if s < 3600: return '%.1fm' % (s/60.)
+    return '%.2fh' % (s/3600.)
+
+def fmt_size(b, unit=1):
+    if b is None: return '-'
+    b *= unit
+    for u in ['B', 'kB', 'MB', 'GB']:
+        if b < 1024: return '%.1f%s' % (b, u)
+        b /= 1024.
+    return '%.1fTB' % b
+
+def get_runs(conn):
+    """
+    Return a list of (run, start, host, nsteps, total wall time) of the runs which executed at least one step
+    """
+    return conn.execute('SELECT runs.run, runs.start, runs.host, COUNT(*), SUM(history.wall) FROM runs '
+                        'JOIN history ON runs.run = history.run GROUP BY runs.run ORDER BY runs.run').fetchall()
+
+def get_steps(conn, run):
+    """
+    Return a dict step -> (wall, cpu, maxrss, written) for a run (last execution if a step ran more than once)
+    """
+    return dict([(r[0], r[1:]) for r in conn.execute('SELECT step, wall, cpu, maxrss, written FROM history '
+                                                     'WHERE run=? ORDER BY start', (run,))])
+
+def get_latest(conn, step, before=None):
+    """
+    Return the latest (run, wall) of step, optionally before a run
+    """
+    if before is None: before = sys.maxsize
+    return conn.execute('SELECT run, wall FROM history WHERE step=? AND run<? ORDER BY start DESC LIMIT 1', (step, before)).fetchone()
+
+def report(filename, run=None, baseline=None, top=10, ntrend=5, threshold=1.2, min_diff=10.):
+    """
+    Print the slowest steps of a run (default: last), their trend over the previous runs and the
+    regressions with respect to a baseline run (default: for each step its previous execution)
+    """
+    conn = sqlite3.connect(filename)
+    runs = get_runs(conn)
+    if len(runs) == 0:
+        print('No history in %s.' % filename)
+        return
+
+    print('### Runs')
+    print('%5s %20s %-20s %6s %10s' % ('run', 'start', 'host', 'steps', 'wall'))
+    for r, start, host, nsteps, wall in runs:
+        print('%5i %20s %-20s %6i %10s' % (r, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)), host, nsteps, fmt_time(wall)))
+
+    if run is None: run = runs[-1][0]
+    steps = get_steps(conn, run)
+    if len(steps) == 0:
+        print('Run %i did not execute any step.' % run)
+        return
+
+    print('\n### Slowest steps of run %i' % run)
+    print('%-30s %10s %10s %10s %10s' % ('step', 'wall', 'cpu', 'peak rss', 'written'))
+    slowest = sorted(steps, key=lambda step: steps[step][0], reverse=True)[:top]
+    for step in slowest:
+        wall, cpu, maxrss, written = steps[step]
+        print('%-30s %10s %10s %10s %10s' % (step, fmt_time(wall), fmt_time(cpu), fmt_size(maxrss, 1024), fmt_size(written)))
+
+    print('\n### Trend of the slowest steps (wall time, oldest to newest)')
+    for step in slowest:
+        walls = [r[0] for r in conn.execute('SELECT wall FROM history WHERE step=? AND run<=? ORDER BY start DESC LIMIT ?',
+                                            (step, run, ntrend))][::-1]
+        print('%-30s %s' % (step, ' -> '.join([fmt_time(w) for w in walls])))
+
+    if baseline is not None:
+        print('\n### Regressions with respect to run %i (>%.0f%% and >%s slower)' % (baseline, (threshold-1)*100, fmt_time(min_diff)))
+        base_steps = get_steps(conn, baseline)
+        base = dict([(step, base_steps[step][0]) for step in steps if step in base_steps])
+    else:
+        print('\n### Regressions with respect to the previous execution (>%.0f%% and >%s slower)' % ((threshold-1)*100, fmt_time(min_diff)))
+        base = {}
+        for step in steps:
+            latest = get_latest(conn, step, before=run)
+            if latest is not None: base[step] = latest[1]
+
+    regressions = [(step, base[step], steps[step][0]) for step in base
+                   if steps[step][0] > threshold*base[step] and steps[step][0]-base[step] > min_diff]
+    if len(regressions) == 0:
+        print('None.')
+    for step, old, new in sorted(regressions, key=lambda r: r[2]-r[1], reverse=True):
+        print('%-30s %10s -> %10s (%+.0f%%)' % (step, fmt_time(old), fmt_time(new), (new/old-1)*100 if old > 0 else 0))
+
+if __name__=='__main__':
+    import optparse
+    opt = optparse.OptionParser(usage='%prog [options] pipeline.walker', version='1.0')
+    opt.add_option('-r', '--run', help='Run to report on (default=last)', type='int', default=None)
+    opt.add_option('-b', '--baseline', help='Baseline run for the regressions (default=previous execution of each step)', type='int', default=None)
+    opt.add_option('-n', '--top', help='Number of slowest steps (default=10)', type='int', default=10)
+    opt.add_option('-t', '--trend', help='Number of runs in the trend (default=5)', type='int', default=5)
+    opt.add_option('--threshold', help='Slowdown factor to flag a regression (default=1.2)', type='float', default=1.2)
+    opt.add_option('--min_diff', help='Minimum slowdown in seconds to flag a regression (default=10)', type='float', default=10.)
+    (options, args) = opt.parse_args()
+
+    if len(args) != 1:
+        opt.print_help()
+        sys.exit()
+
+    filename = args[0] if args[0].endswith('.db') else args[0]+'.db'
+    if not os.path.exists(filename):
+        print('Missing history file %s.' % filename)
+        sys.exit(1)
+
+    report(filename, run=options.run, baseline=options.baseline, top=options.top, ntrend=options.trend,
+           threshold=options.threshold, min_diff=options.min_diff)